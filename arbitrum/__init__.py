@@ -17,6 +17,7 @@ from .value import AVMCodePoint
 from .vm import VM, AVMOp
 from .compiler import compile_program, compile_block
 from .annotation import modifies_stack
-from .vm_runner import run_vm_once
+from .vm_runner import run_vm_once, run_vm, run_until
+from .block_compiler import run_blocks
 from . import marshall
 from . import evm
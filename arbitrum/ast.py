@@ -28,6 +28,74 @@ class ASTNode:
         self.path.append(typ)
 
 
+class SourcePath:
+    """Path of an op in a flattened program, as a node of a prefix tree
+
+    The path is the path of parent followed by label, the root has no
+    parent. Children are interned, so ops under the same blocks share their
+    path and it is only built as a list when it is iterated, indexed or
+    printed.
+    """
+    __slots__ = ["parent", "label", "children"]
+
+    def __init__(self, parent=None, label=None):
+        self.parent = parent
+        self.label = label
+        self.children = {}
+
+    def child(self, label):
+        try:
+            key = label
+            node = self.children.get(key)
+        except TypeError:
+            # Unhashable labels are only shared by the same object
+            key = ("id", id(label))
+            node = self.children.get(key)
+        if node is None:
+            node = SourcePath(self, label)
+            self.children[key] = node
+        return node
+
+    def extend(self, labels):
+        node = self
+        for label in labels:
+            node = node.child(label)
+        return node
+
+    def to_list(self):
+        labels = []
+        node = self
+        while node.parent is not None:
+            labels.append(node.label)
+            node = node.parent
+        labels.reverse()
+        return labels
+
+    def __reduce__(self):
+        return (_source_path, (self.to_list(),))
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __len__(self):
+        length = 0
+        node = self
+        while node.parent is not None:
+            length += 1
+            node = node.parent
+        return length
+
+    def __getitem__(self, index):
+        return self.to_list()[index]
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+
+def _source_path(labels):
+    return SourcePath().extend(labels)
+
+
 def add_label_to_ast(node, label):
     node.add_node(label)
     return node
@@ -16,6 +16,8 @@
 # Credit to https://github.com/ethereum/pyethereum/blob/master/ethereum/vm.py
 # for EVM-like implementation details
 
+from collections import deque
+
 from eth_utils import big_endian_to_int
 from . import instructions
 from .ast import AVMLabeledCodePoint
@@ -35,11 +37,52 @@ class VMBlocked(Exception):
     pass
 
 
+class VMBudgetExceeded(VMBlocked):
+    """VM ran out of the step or cost budget for the current message"""
+    pass
+
+
 class VMBlockedAdvance(Exception):
     """VM tried to run opcode that blocks"""
     pass
 
 
+FAULT_BUFFER_SIZE = 64
+
+
+def summarize_value(val):
+    if isinstance(val, int):
+        return val
+    if isinstance(val, value.Tuple):
+        return "Tuple({})".format(len(val))
+    if isinstance(val, value.AVMCodePoint):
+        return "CodePoint({})".format(val.pc)
+    return type(val).__name__
+
+
+class FaultRecord:
+    """An error raised by the op at pc
+
+    stack_top summarizes the top items of the stack after the error, with
+    tuples and code points reduced to their length and pc.
+    """
+    def __init__(self, pc, op_code, error_type, message, stack_top):
+        self.pc = pc
+        self.op_code = op_code
+        self.error_type = error_type
+        self.message = message
+        self.stack_top = stack_top
+
+    def __repr__(self):
+        return "FaultRecord(pc {}, {} {}: {}, stack {})".format(
+            self.pc,
+            instructions.OP_NAMES.get(self.op_code, self.op_code),
+            self.error_type.__name__,
+            self.message,
+            self.stack_top
+        )
+
+
 class VMEnv:
     def __init__(self):
         self.messages = value.Tuple([])
@@ -63,29 +106,109 @@ class VMEnv:
 
 
 class Stack:
+    """Value stack with the top stored at the end of the backing list
+
+    Indexing and the items property are still top-first, so stack[0] is
+    the top of the stack.
+    """
     def __init__(self, items=None):
         if items is None:
             items = []
         self.items = items
 
+    @property
+    def items(self):
+        # A top-first copy, changing it doesn't change the stack. Assign to
+        # items to replace the contents, and use stack[i] to read a single
+        # item without copying.
+        return self._items[::-1]
+
+    @items.setter
+    def items(self, items):
+        self._items = list(items)[::-1]
+
     def __len__(self):
-        return len(self.items)
+        return len(self._items)
 
-    def __getitem__(self, *args):
-        return self.items.__getitem__(*args)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._items[::-1][index]
+        return self._items[-1 - index]
 
     def push(self, val):
-        self.items.insert(0, val)
+        self._items.append(val)
 
     def pop(self, typehint=None):
-        val = self.items[0]
+        val = self._items[-1]
         if typehint and not typehint.accepts(val):
             raise Exception("Pop expected {}, but got {}".format(typehint, val))
-        del self.items[0]
+        self._items.pop()
         return val
 
     def peak(self):
-        return self.items[0]
+        return self._items[-1]
+
+    def top(self, count):
+        if count > len(self._items):
+            raise IndexError("Stack has fewer than {} items".format(count))
+        return self._items[:-count - 1:-1]
+
+    def replace_top(self, count, items):
+        # Replace the top count items with items, which is top-first
+        del self._items[len(self._items) - count:]
+        self._items.extend(reversed(items))
+
+    def snapshot(self):
+        return list(self._items)
+
+    def restore(self, snapshot):
+        self._items[:] = snapshot
+
+
+class VMCheckpoint:
+    """VM state saved by BasicVM.checkpoint
+
+    Values are immutable so only the stacks are copied. logs and
+    sent_messages are only ever appended to, so just their lengths are
+    saved.
+    """
+    def __init__(self, vm):
+        self.pc = vm.pc
+        self.stack = vm.stack.snapshot()
+        self.aux_stack = vm.aux_stack.snapshot()
+        self.register = vm.register
+        self.static = vm.static
+        self.err_handler = vm.err_handler
+        self.atomic_count = vm.atomic_count
+        self.halted = vm.halted
+        self.messages = vm.env.messages
+        self.pending_messages = vm.env.pending_messages
+        self.time_bounds = vm.env.time_bounds
+        self.logs = vm.logs
+        self.log_count = len(vm.logs)
+        self.sent_messages = vm.sent_messages
+        self.sent_count = len(vm.sent_messages)
+
+    def restore(self, vm):
+        vm.pc = self.pc
+        vm.stack.restore(self.stack)
+        vm.aux_stack.restore(self.aux_stack)
+        vm.register = self.register
+        vm.static = self.static
+        vm.err_handler = self.err_handler
+        vm.atomic_count = self.atomic_count
+        vm.halted = self.halted
+        vm.env.messages = self.messages
+        vm.env.pending_messages = self.pending_messages
+        vm.env.time_bounds = self.time_bounds
+        if vm.logs is self.logs:
+            del vm.logs[self.log_count:]
+        else:
+            vm.logs = self.logs[:self.log_count]
+        if vm.sent_messages is self.sent_messages:
+            del vm.sent_messages[self.sent_count:]
+        else:
+            vm.sent_messages = self.sent_messages[:self.sent_count]
 
 
 class BasicVM:
@@ -102,6 +225,44 @@ class BasicVM:
         self.halted = False
         self.sent_messages = []
         self.logs = []
+        self.meter = None
+        self.faults = deque(maxlen=FAULT_BUFFER_SIZE)
+        self.verbose_errors = False
+        # Every engine turns on value.hash_consing while running this VM
+        self.hash_consing = False
+
+    def record_fault(self, err):
+        op = self.pc.op
+        self.faults.append(FaultRecord(
+            self.pc.pc,
+            op if isinstance(op, int) else op.get_op(),
+            type(err),
+            str(err),
+            tuple(
+                summarize_value(self.stack[i])
+                for i in range(min(len(self.stack), 3))
+            )
+        ))
+
+    def memory_footprint(self):
+        """Bytes held by the stack, aux stack, register and static
+
+        Values are counted by value.value_size, so a value shared between
+        them is counted every time it appears.
+        """
+        return sum(
+            value.value_size(val)
+            for val in self.stack._items + self.aux_stack._items + [
+                self.register,
+                self.static
+            ]
+        )
+
+    def checkpoint(self):
+        return VMCheckpoint(self)
+
+    def restore(self, checkpoint):
+        checkpoint.restore(self)
 
     def log(self):
         self.logs.append(self.stack.pop())
@@ -126,6 +287,8 @@ class BasicVM:
 
         self.stack.pop()
         self.stack.push(self.env.messages)
+        if self.meter is not None:
+            self.meter.start_message()
 
     def send(self):
         msg = self.stack.pop()
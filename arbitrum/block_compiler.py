@@ -0,0 +1,634 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Optional engine that compiles vm.code into one Python function per basic
+# block.
+#
+# Blocks start at every code point that can be jumped to (code points in
+# immediates or in the static value and pcpush locations) and end after
+# jump, cjump and errset. A block function keeps the stack items it works
+# on in local variables and only writes back to the VM once every
+# instruction in the block has succeeded. If anything raises, the VM is
+# untouched and the block is rerun one instruction at a time with
+# run_vm_once so the error happens at the same pc with the same stack.
+# Blocks containing inbox, breakpoint or ops that always raise are never
+# compiled.
+#
+# The compiled code can be cached on disk by passing cache_dir, or setting
+# ARBC_BLOCK_CACHE for the default. The cache key covers every op and every
+# int immediate, the only parts of the code the generated source depends
+# on, so it doesn't rely on the code point hashes being up to date.
+
+import hashlib
+import importlib.util
+import marshal
+import os
+
+from eth_utils import big_endian_to_int
+
+from .ast import ImmediateOp, AVMLabeledCodePoint
+from .basic_vm import TT256, TT256M1, to_signed
+from .instructions import OP_NAMES
+from .vm_runner import run_vm_once
+from . import value
+
+CACHE_VERSION = 1
+# No caching unless asked for
+DEFAULT_CACHE_DIR = os.environ.get("ARBC_BLOCK_CACHE")
+
+# Blocks with a single instruction gain nothing from being compiled
+MIN_BLOCK_LENGTH = 2
+
+TERMINATORS = {"jump", "cjump", "errset"}
+UNCOMPILED = {"inbox", "breakpoint", "error", "halt", "debug", "smod"}
+
+BINARY_OPS = {
+    "add": "({0} + {1}) & TT256M1",
+    "sub": "({0} - {1}) & TT256M1",
+    "mul": "({0} * {1}) & TT256M1",
+    "exp": "pow({0}, {1}, TT256)",
+    "lt": "int({0} < {1})",
+    "gt": "int({0} > {1})",
+    "eq": "int({0} == {1})",
+    "bitwise_and": "{0} & {1}",
+    "bitwise_or": "{0} | {1}",
+    "bitwise_xor": "{0} ^ {1}",
+    "div": "_div({0}, {1})",
+    "sdiv": "_sdiv({0}, {1})",
+    "mod": "_mod({0}, {1})",
+    "slt": "_slt({0}, {1})",
+    "sgt": "_sgt({0}, {1})",
+    "signextend": "_signextend({0}, {1})",
+    "byte": "_byte({0}, {1})",
+    "tget": "_tget({0}, {1})",
+}
+
+UNARY_OPS = {
+    "iszero": "int({0} == 0)",
+    "bitwise_not": "TT256M1 - {0}",
+    "hash": "big_endian_to_int(value_hash({0}))",
+    "type": "_type({0})",
+    "tlen": "_tlen({0})",
+}
+
+TERNARY_OPS = {
+    "addmod": "({0} + {1}) % {2} if {2} else 0",
+    "mulmod": "({0} * {1}) % {2} if {2} else 0",
+    "tset": "_tset({0}, {1}, {2})",
+}
+
+
+# Helpers used by the generated code. They compute the same results as the
+# ops in basic_vm and raise whenever those would.
+
+def _div(op1, op2):
+    if op2 != 0:
+        return op1 // op2
+    raise Exception("Can't divide by zero")
+
+
+def _sdiv(op1, op2):
+    s0, s1 = to_signed(op1), to_signed(op2)
+    if s1 != 0:
+        return (abs(s0) // abs(s1) * (-1 if s0 * s1 < 0 else 1)) & TT256M1
+    raise Exception("Can't divide by zero")
+
+
+def _mod(op1, op2):
+    if op2 != 0:
+        return op1 % op2
+    raise Exception("Can't mod by zero")
+
+
+def _slt(op1, op2):
+    return 1 if to_signed(op1) < to_signed(op2) else 0
+
+
+def _sgt(op1, op2):
+    return 1 if to_signed(op1) > to_signed(op2) else 0
+
+
+def _signextend(op1, op2):
+    if op1 <= 31:
+        testbit = op1 * 8 + 7
+        if op2 & (1 << testbit):
+            return op2 | (TT256 - (1 << testbit))
+        return op2 & ((1 << testbit) - 1)
+    return op2
+
+
+def _byte(op1, op2):
+    if op1 >= 32:
+        return 0
+    return (op2 // 256 ** (31 - op1)) % 256
+
+
+def _type(item):
+    if isinstance(item, int):
+        return 0
+    if isinstance(item, value.Tuple):
+        return 3
+    return 1
+
+
+def _tlen(tup):
+    if not isinstance(tup, value.Tuple):
+        raise Exception("tlen expected tuple, but got {}".format(tup))
+    return len(tup)
+
+
+def _tget(index, tup):
+    if not isinstance(index, int) or not isinstance(tup, value.Tuple):
+        raise Exception("tget expected int and tuple")
+    if not tup.has_member_at_index(index):
+        raise Exception("Tried to get index {} from tuple {}".format(index, tup))
+    return tup.get_tup(index)
+
+
+def _tset(index, tup, val):
+    if not isinstance(index, int) or not isinstance(tup, value.Tuple):
+        raise Exception("tset expected int and tuple")
+    return tup.set_tup_val(index, val)
+
+
+def _code_point(dest):
+    if isinstance(dest, value.AVMCodePoint):
+        return dest
+    if isinstance(dest, AVMLabeledCodePoint):
+        return dest.pc
+    raise Exception("Jump insn requires codepoint but recieved " + str(dest))
+
+
+def _jump_dest(dest, index, code_len):
+    # Jumps that the interpreter treats as not having moved the pc or that
+    # run off the end of the code are left to run_vm_once
+    if dest.pc == index or dest.pc >= code_len:
+        raise Exception("Jump to {} must be interpreted".format(dest.pc))
+    return dest
+
+
+def _namespace(code, immediates):
+    return {
+        "TT256": TT256,
+        "TT256M1": TT256M1,
+        "big_endian_to_int": big_endian_to_int,
+        "value_hash": value.value_hash,
+        "_div": _div,
+        "_sdiv": _sdiv,
+        "_mod": _mod,
+        "_slt": _slt,
+        "_sgt": _sgt,
+        "_signextend": _signextend,
+        "_byte": _byte,
+        "_type": _type,
+        "_tlen": _tlen,
+        "_tget": _tget,
+        "_tset": _tset,
+        "_code_point": _code_point,
+        "_jump_dest": _jump_dest,
+        "C": code,
+        "V": immediates,
+    }
+
+
+def _decode(code_point):
+    instr = code_point.op
+    if isinstance(instr, ImmediateOp):
+        val = instr.val
+        if isinstance(val, list):
+            val = value.Tuple(val)
+        return OP_NAMES.get(instr.op.op_code), True, val
+    if isinstance(instr, int):
+        return OP_NAMES.get(instr), False, None
+    return OP_NAMES.get(instr.op_code), False, None
+
+
+def _add_targets(val, targets, seen):
+    vals = [val]
+    while vals:
+        val = vals.pop()
+        if isinstance(val, value.Tuple):
+            if id(val) not in seen:
+                seen.add(id(val))
+                vals.extend(val.val)
+        elif isinstance(val, list):
+            vals.extend(val)
+        elif isinstance(val, value.AVMCodePoint):
+            targets.add(val.pc)
+        elif isinstance(val, AVMLabeledCodePoint):
+            if isinstance(val.pc, value.AVMCodePoint):
+                targets.add(val.pc.pc)
+
+
+def split_blocks(code, ops, static):
+    """Return the start pcs of the basic blocks of code"""
+    code_len = len(code)
+    leaders = {0}
+    seen = set()
+    _add_targets(static, leaders, seen)
+    for i, (name, has_immediate, val) in enumerate(ops):
+        if has_immediate:
+            _add_targets(val, leaders, seen)
+        if name == "pcpush":
+            leaders.add(i)
+        if name in TERMINATORS:
+            leaders.add(i + 1)
+        if name is None or name in UNCOMPILED:
+            leaders.add(i)
+            leaders.add(i + 1)
+    return sorted(pc for pc in leaders if 0 <= pc < code_len)
+
+
+def _changed_top(prefix, inputs, outputs):
+    # Inputs that end up where they started don't need to be written back
+    outputs = list(outputs)
+    while inputs and outputs and outputs[0] == "{}{}".format(prefix, inputs - 1):
+        outputs.pop(0)
+        inputs -= 1
+    return inputs, outputs
+
+
+class _BlockWriter:
+    """Generates the source of the function for a single block
+
+    Stack items pushed inside the block are tracked symbolically as the
+    names of locals. Items that were on the stack before the block are
+    read into i0, i1, ... and items from the aux stack into a0, a1, ...
+    """
+    def __init__(self, start, end, code_len):
+        self.start = start
+        self.end = end
+        self.code_len = code_len
+        self.lines = []
+        self.args = []
+        self.stack = []
+        self.inputs = 0
+        self.aux = []
+        self.aux_inputs = 0
+        self.temps = 0
+        self.uses_depth = False
+        self.uses_aux_depth = False
+        self.uses_register = False
+        self.sets_register = False
+        self.logs = []
+        self.sends = []
+        self.err_handler = None
+        self.next_pc = None
+
+    def emit(self, line):
+        self.lines.append("    " + line)
+
+    def arg(self, name, source):
+        arg = "{}=" + source
+        self.args.append(arg.format(name))
+        return name
+
+    def temp(self, expr):
+        name = "t{}".format(self.temps)
+        self.temps += 1
+        self.emit("{} = {}".format(name, expr))
+        return name
+
+    def constant(self, pc, val):
+        if isinstance(val, int):
+            return repr(val)
+        return self.arg("v{}".format(pc), "V[{}]".format(pc))
+
+    def pop(self):
+        if self.stack:
+            return self.stack.pop()
+        name = "i{}".format(self.inputs)
+        self.inputs += 1
+        return name
+
+    def push(self, name):
+        self.stack.append(name)
+
+    def depth(self):
+        return "(depth - {} + {})".format(self.inputs, len(self.stack))
+
+    def aux_pop(self):
+        if self.aux:
+            return self.aux.pop()
+        name = "a{}".format(self.aux_inputs)
+        self.aux_inputs += 1
+        return name
+
+    def aux_depth(self):
+        return "(aux_depth - {} + {})".format(self.aux_inputs, len(self.aux))
+
+    def write_op(self, pc, name):
+        if name in BINARY_OPS:
+            op1 = self.pop()
+            op2 = self.pop()
+            self.push(self.temp(BINARY_OPS[name].format(op1, op2)))
+        elif name in UNARY_OPS:
+            self.push(self.temp(UNARY_OPS[name].format(self.pop())))
+        elif name in TERNARY_OPS:
+            op1 = self.pop()
+            op2 = self.pop()
+            op3 = self.pop()
+            self.push(self.temp(TERNARY_OPS[name].format(op1, op2, op3)))
+        elif name == "pop":
+            self.pop()
+        elif name in ("dup0", "dup1", "dup2"):
+            count = int(name[3]) + 1
+            items = [self.pop() for _ in range(count)]
+            for item in reversed(items):
+                self.push(item)
+            self.push(items[-1])
+        elif name in ("swap1", "swap2"):
+            count = int(name[4]) + 1
+            items = [self.pop() for _ in range(count)]
+            self.push(items[0])
+            for item in reversed(items[1:-1]):
+                self.push(item)
+            self.push(items[-1])
+        elif name == "spush":
+            self.push(self.temp("vm.static"))
+        elif name == "rpush":
+            self.uses_register = True
+            self.push(self.temp("reg"))
+        elif name == "rset":
+            self.uses_register = True
+            self.sets_register = True
+            self.emit("reg = {}".format(self.pop()))
+        elif name == "auxpush":
+            self.aux.append(self.pop())
+        elif name == "auxpop":
+            self.push(self.aux_pop())
+        elif name == "stackempty":
+            self.uses_depth = True
+            self.push(self.temp("int({} == 0)".format(self.depth())))
+        elif name == "auxstackempty":
+            self.uses_aux_depth = True
+            self.push(self.temp("int({} == 0)".format(self.aux_depth())))
+        elif name == "pcpush":
+            self.push(self.arg("c{}".format(pc), "C[{}]".format(pc)))
+        elif name == "errpush":
+            self.push(self.temp("vm.err_handler"))
+        elif name == "gettime":
+            self.push(self.temp("vm.env.time_bounds"))
+        elif name == "log":
+            self.logs.append(self.pop())
+        elif name == "send":
+            self.sends.append(self.pop())
+        elif name == "nbsend":
+            self.sends.append(self.pop())
+            self.push("1")
+        elif name == "nop":
+            pass
+        elif name == "jump":
+            dest = self.pop()
+            self.next_pc = self.temp("_jump_dest(_code_point({}), {}, {})".format(
+                dest,
+                pc,
+                self.code_len
+            ))
+        elif name == "cjump":
+            dest = self.temp("_code_point({})".format(self.pop()))
+            cond = self.pop()
+            self.next_pc = self.temp("_jump_dest({}, {}, {}) if {} != 0 else {}".format(
+                dest,
+                pc,
+                self.code_len,
+                cond,
+                self.fallthrough()
+            ))
+        elif name == "errset":
+            self.err_handler = self.temp("_code_point({})".format(self.pop()))
+        else:
+            raise Exception("Can't compile op {}".format(name))
+
+    def fallthrough(self):
+        return self.arg("c{}".format(self.end + 1), "C[{}]".format(self.end + 1))
+
+    def source(self):
+        if self.next_pc is None:
+            self.next_pc = self.fallthrough()
+        prologue = []
+        if self.inputs:
+            prologue.append("{}, = vm.stack.top({})".format(
+                ", ".join("i{}".format(i) for i in range(self.inputs)),
+                self.inputs
+            ))
+        if self.uses_depth:
+            prologue.append("depth = len(vm.stack)")
+        if self.aux_inputs:
+            prologue.append("{}, = vm.aux_stack.top({})".format(
+                ", ".join("a{}".format(i) for i in range(self.aux_inputs)),
+                self.aux_inputs
+            ))
+        if self.uses_aux_depth:
+            prologue.append("aux_depth = len(vm.aux_stack)")
+        if self.uses_register:
+            prologue.append("reg = vm.register")
+
+        # Everything below here can't raise
+        commit = []
+        inputs, outputs = _changed_top("i", self.inputs, self.stack)
+        if inputs or outputs:
+            commit.append("vm.stack.replace_top({}, [{}])".format(
+                inputs,
+                ", ".join(reversed(outputs))
+            ))
+        inputs, outputs = _changed_top("a", self.aux_inputs, self.aux)
+        if inputs or outputs:
+            commit.append("vm.aux_stack.replace_top({}, [{}])".format(
+                inputs,
+                ", ".join(reversed(outputs))
+            ))
+        if self.sets_register:
+            commit.append("vm.register = reg")
+        for log in self.logs:
+            commit.append("vm.logs.append({})".format(log))
+        for msg in self.sends:
+            commit.append("vm.sent_messages.append({})".format(msg))
+        if self.err_handler is not None:
+            commit.append("vm.err_handler = {}".format(self.err_handler))
+        commit.append("vm.pc = {}".format(self.next_pc))
+
+        header = "def block_{}({}):".format(
+            self.start,
+            ", ".join(["vm"] + self.args)
+        )
+        body = ["    " + line for line in prologue] + self.lines
+        body += ["    " + line for line in commit]
+        return "\n".join([header] + body)
+
+
+def _compilable(ops, start, end, code_len):
+    if end - start + 1 < MIN_BLOCK_LENGTH:
+        return False
+    for name, _, _ in ops[start:end + 1]:
+        if name is None or name in UNCOMPILED:
+            return False
+    # Every block except one ending in jump continues to the next code point
+    return ops[end][0] == "jump" or end + 1 < code_len
+
+
+def generate_source(code, ops, starts):
+    """Return the Python source of the functions for the given blocks"""
+    code_len = len(code)
+    functions = []
+    bounds = starts[1:] + [code_len]
+    for start, next_start in zip(starts, bounds):
+        end = next_start - 1
+        if not _compilable(ops, start, end, code_len):
+            continue
+        writer = _BlockWriter(start, end, code_len)
+        for pc in range(start, end + 1):
+            name, has_immediate, val = ops[pc]
+            if has_immediate:
+                writer.push(writer.constant(pc, val))
+            writer.write_op(pc, name)
+        functions.append(writer.source())
+    return "\n\n\n".join(functions) + "\n"
+
+
+def _cache_key(ops, starts):
+    # Other immediates are only read from the namespace at run time
+    key = hashlib.sha256()
+    key.update(str(CACHE_VERSION).encode())
+    key.update(importlib.util.MAGIC_NUMBER)
+    key.update(";".join(
+        "{}:{}".format(
+            name,
+            (repr(val) if isinstance(val, int) else "v") if has_immediate else ""
+        )
+        for name, has_immediate, val in ops
+    ).encode())
+    key.update(",".join(str(start) for start in starts).encode())
+    return key.hexdigest()
+
+
+def _load_cached(path):
+    try:
+        with open(path, "rb") as f:
+            return marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _store_cached(path, compiled):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(marshal.dumps(compiled))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+class CompiledProgram:
+    """vm.code split into basic blocks with compiled block functions
+
+    runs[i] is the function for the block starting at code point i and
+    lengths[i] the number of instructions in it. Both are None for code
+    points that don't start a compiled block.
+    """
+    def __init__(self, vm, cache_dir=DEFAULT_CACHE_DIR):
+        self.code = vm.code
+        code_len = len(self.code)
+        ops = [_decode(code_point) for code_point in self.code]
+        immediates = [val for _, _, val in ops]
+        starts = split_blocks(self.code, ops, vm.static)
+
+        self.key = _cache_key(ops, starts)
+        self.from_cache = False
+        compiled = None
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, self.key + ".avmblocks")
+            compiled = _load_cached(path)
+            self.from_cache = compiled is not None
+        if compiled is None:
+            compiled = compile(
+                generate_source(self.code, ops, starts),
+                "<avm blocks {}>".format(self.key[:16]),
+                "exec"
+            )
+            if path is not None:
+                _store_cached(path, compiled)
+
+        namespace = _namespace(self.code, immediates)
+        exec(compiled, namespace)
+        self.runs = [None] * code_len
+        self.lengths = [None] * code_len
+        bounds = starts[1:] + [code_len]
+        for start, next_start in zip(starts, bounds):
+            run = namespace.get("block_{}".format(start))
+            if run is not None:
+                self.runs[start] = run
+                self.lengths[start] = next_start - start
+        self.block_count = len(starts)
+        self.compiled_count = sum(run is not None for run in self.runs)
+
+    def matches(self, vm):
+        return self.code is vm.code
+
+
+def compile_blocks(vm, cache_dir=DEFAULT_CACHE_DIR):
+    program = vm.compiled_blocks
+    if program is None or not program.matches(vm):
+        program = CompiledProgram(vm, cache_dir)
+        vm.compiled_blocks = program
+    return program
+
+
+def run_blocks(vm, max_steps=None, cache_dir=DEFAULT_CACHE_DIR):
+    """Run the VM using compiled blocks until it blocks
+
+    Behaves like calling run_vm_once until it returns False or max_steps
+    steps have run, and returns the number of steps run.
+    """
+    if vm.halted:
+        raise Exception("Can't run VM since it is halted")
+    program = compile_blocks(vm, cache_dir)
+    if vm.hash_consing:
+        with value.hash_consing():
+            return _run_blocks(vm, program, max_steps)
+    return _run_blocks(vm, program, max_steps)
+
+
+def _run_blocks(vm, program, max_steps):
+    code = program.code
+    runs = program.runs
+    lengths = program.lengths
+    code_len = len(code)
+
+    steps = 0
+    while max_steps is None or steps < max_steps:
+        pc = vm.pc
+        index = pc.pc
+        # Metered VMs are charged per instruction by run_vm_once
+        if vm.meter is None and 0 <= index < code_len and code[index] is pc:
+            run = runs[index]
+            if run is not None and (
+                    max_steps is None or
+                    steps + lengths[index] <= max_steps
+            ):
+                try:
+                    run(vm)
+                except Exception:
+                    # Nothing was written back, so interpret the block
+                    pass
+                else:
+                    steps += lengths[index]
+                    continue
+        if not run_vm_once(vm):
+            break
+        steps += 1
+    return steps
@@ -13,10 +13,10 @@
 # limitations under the License.
 
 from collections import Counter
-
-import networkx as nx
+import heapq
 
 from . import ast, instructions, value
+from .basic_vm import BasicVM
 from .std.bigstruct import BigStruct
 from .vm import VM
 
@@ -37,10 +37,64 @@ def build_bst(items):
     return value.Tuple(tree)
 
 
-def generate_code_pointers(insns):
+def _same_op(insn, old, pc_shift, index):
+    if isinstance(insn, ast.BasicOp):
+        if isinstance(old, int):
+            return old == insn.op_code
+        return isinstance(old, ast.BasicOp) and old.op_code == insn.op_code
+    if not isinstance(insn, ast.ImmediateOp):
+        return False
+    if not isinstance(old, ast.ImmediateOp) or old.op.op_code != insn.op.op_code:
+        return False
+    if isinstance(insn.val, ast.AVMLabeledPos):
+        # Only labels inside the matching suffix keep their hash
+        return (
+            isinstance(old.val, value.AVMCodePoint) and
+            insn.val.pc > index and
+            old.val.pc == insn.val.pc + pc_shift
+        )
+    if isinstance(old.val, value.AVMCodePoint):
+        return False
+    return old.val == insn.val
+
+
+def matching_suffix(insns, previous):
+    """Return how many instructions at the end of insns compile to the same
+    code points as the end of the code point list previous
+    """
+    pc_shift = len(previous) - len(insns)
+    first = max(0, -pc_shift)
+    count = 0
+    for index in range(len(insns) - 1, first - 1, -1):
+        if not _same_op(insns[index], previous[index + pc_shift].op, pc_shift, index):
+            break
+        count += 1
+    return count
+
+
+def generate_code_pointers(insns, previous=None):
+    """Build the code points of insns and their next_hash chain
+
+    If previous holds the code points of an earlier compile, the hashes of
+    the longest matching suffix are taken from it and only the code points
+    before it are hashed.
+    """
     code_points = []
+    code_hashes = []
     prev_hash = b''
     total = len(insns)
+    if previous:
+        reused = matching_suffix(insns, previous)
+        pc_shift = len(previous) - total
+    else:
+        reused = 0
+    # Code points pushed as immediates are hashed as part of the chain
+    immediates = [
+        insn.val for insn in insns[:total - reused]
+        if isinstance(insn, ast.ImmediateOp) and
+        not isinstance(insn.val, ast.AVMLabeledPos)
+    ]
+    immediate_hashes = value.value_hash_many(immediates)
     for i in range(len(insns) - 1, -1, -1):
         if isinstance(insns[i], ast.BasicOp):
             code_point = value.AVMCodePoint(
@@ -49,6 +103,8 @@ def generate_code_pointers(insns):
                 prev_hash,
                 insns[i].path
             )
+            if i < total - reused:
+                code_hash = value.code_point_hash(insns[i].op_code, prev_hash)
         elif isinstance(insns[i], ast.ImmediateOp):
             val = insns[i].val
             if isinstance(val, ast.AVMLabeledPos):
@@ -56,6 +112,10 @@ def generate_code_pointers(insns):
                 if immediate.pc != val.pc:
                     raise Exception("Error calculating code points: Non matching pc {} and {}".format(immediate.pc, val.pc))
                 assert immediate.pc == val.pc
+                immediate_hash = code_hashes[total - val.pc - 1]
+            elif i < total - reused:
+                immediate = val
+                immediate_hash = immediate_hashes.pop()
             else:
                 immediate = val
             code_point = value.AVMCodePoint(
@@ -64,14 +124,38 @@ def generate_code_pointers(insns):
                 prev_hash,
                 insns[i].path
             )
+            if i < total - reused:
+                code_hash = value.code_point_hash(
+                    insns[i].op.op_code,
+                    prev_hash,
+                    immediate_hash
+                )
         else:
             raise Exception("Can't generate code pointer at {} from unexpected value {}".format(i, insns[i]))
-        prev_hash = value.value_hash(code_point)
+        if i >= total - reused:
+            # The hash of a code point is the next_hash of the one before
+            old_pc = i + pc_shift
+            if old_pc > 0:
+                code_hash = previous[old_pc - 1].next_hash
+            else:
+                code_hash = value.value_hash(previous[0])
+        prev_hash = code_hash
         code_points.append(code_point)
+        code_hashes.append(code_hash)
     assert len(code_points) == len(insns)
     return code_points[::-1]
 
 
+def update_code_pointers(insns, static, previous):
+    """Build the code points of insns reusing the hashes of the code points
+    of an earlier compile in previous
+
+    Returns the code points and static with its code points replaced.
+    """
+    code_points = generate_code_pointers(insns, previous)
+    return code_points, replace_code_points(static, code_points)
+
+
 def check_compiled(insns):
     for i, insn in enumerate(insns):
         if not isinstance(
@@ -99,41 +183,131 @@ def replace_code_points(x, block):
     return x
 
 
-def build_call_graph(compiled_funcs):
-    digraph = nx.DiGraph()
-    for func in compiled_funcs:
-        counter = CallCounter()
-        compiled_funcs[func].modify_ast(counter)
-        for dep in counter.call_counts:
-            digraph.add_edge(func, dep)
-    return digraph
-
-
-def get_non_recursive(compiled_funcs):
-    digraph = build_call_graph(compiled_funcs)
+class CallGraph:
+    """Calls between the functions of a program
 
-    while True:
-        cycles = [cycle for cycle in nx.simple_cycles(digraph)]
-        bad_nodes = [x for cycle in cycles for x in cycle]
-        if not bad_nodes:
-            break
-        digraph.remove_nodes_from(bad_nodes)
-    return set(x for x in digraph.nodes)
+    calls[caller][callee] is the number of call statements to callee in
+    caller. The graph is built once per compile and kept up to date as
+    functions are inlined. Functions are visited in name order, so the
+    results don't depend on hash randomization.
+    """
+    def __init__(self, compiled_funcs):
+        self.calls = {}
+        self.callers = {}
+        for func in compiled_funcs:
+            counter = CallCounter()
+            compiled_funcs[func].modify_ast(counter)
+            self.add_func(func)
+            for dep, count in counter.call_counts.items():
+                self.add_call(func, dep, count)
+
+    def add_func(self, func):
+        self.calls.setdefault(func, Counter())
+        self.callers.setdefault(func, set())
+
+    def add_call(self, caller, callee, count=1):
+        self.add_func(caller)
+        self.add_func(callee)
+        self.calls[caller][callee] += count
+        self.callers[callee].add(caller)
+
+    def nodes(self):
+        """Functions that call or are called by another, in name order"""
+        return sorted(
+            func for func in self.calls
+            if self.calls[func] or self.callers[func]
+        )
 
+    def call_count(self, func):
+        return sum(self.calls[caller][func] for caller in self.callers[func])
+
+    def strongly_connected_components(self):
+        """Tarjan's algorithm, without recursion"""
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in self.nodes():
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(sorted(self.calls[root])))]
+            while work:
+                func, deps = work[-1]
+                for dep in deps:
+                    if dep not in index:
+                        index[dep] = low[dep] = len(index)
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(sorted(self.calls[dep]))))
+                        break
+                    if dep in on_stack:
+                        low[func] = min(low[func], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[-1][0]
+                        low[caller] = min(low[caller], low[func])
+                    if low[func] == index[func]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.remove(member)
+                            component.append(member)
+                            if member == func:
+                                break
+                        components.append(sorted(component))
+        return components
+
+    def recursive(self):
+        """Functions that can call themselves"""
+        return set(
+            func
+            for component in self.strongly_connected_components()
+            for func in component
+            if len(component) > 1 or func in self.calls[func]
+        )
 
-def topological_sort(compiled_funcs):
-    digraph = build_call_graph(compiled_funcs)
-    cycle_nodes = []
-    while True:
-        cycles = [cycle for cycle in nx.simple_cycles(digraph)]
-        bad_nodes = [x for cycle in cycles for x in cycle]
-        if not bad_nodes:
-            break
-        cycle_nodes += bad_nodes
-        digraph.remove_nodes_from(bad_nodes)
-    cycle_nodes = sorted(list(set(cycle_nodes)))
-    sorted_nodes = list(nx.lexicographical_topological_sort(digraph))
-    return cycle_nodes + sorted_nodes
+    def inline(self, func):
+        """Replace the calls to func by the calls it makes
+
+        func must not be recursive.
+        """
+        deps = self.calls.pop(func)
+        for caller in self.callers.pop(func):
+            count = self.calls[caller].pop(func)
+            for dep, dep_count in deps.items():
+                self.calls[caller][dep] += count * dep_count
+                self.callers[dep].add(caller)
+        for dep in deps:
+            self.callers[dep].discard(func)
+
+    def topological_order(self):
+        """Recursive functions in name order, then the others with callers
+        before the functions they call, smallest name first
+        """
+        recursive = self.recursive()
+        nodes = [func for func in self.nodes() if func not in recursive]
+        in_degree = {func: 0 for func in nodes}
+        for func in nodes:
+            for dep in self.calls[func]:
+                if dep in in_degree:
+                    in_degree[dep] += 1
+        ready = [func for func in nodes if not in_degree[func]]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            func = heapq.heappop(ready)
+            order.append(func)
+            for dep in self.calls[func]:
+                if dep in in_degree:
+                    in_degree[dep] -= 1
+                    if not in_degree[dep]:
+                        heapq.heappush(ready, dep)
+        return sorted(recursive) + order
 
 
 class StaticTracker:
@@ -475,28 +649,80 @@ def compile_block(func):
     return ast.BlockStatement(compiler.block)
 
 
-def transform_code_block(code, code_pass, op_count=1):
-    i = 0
-    while i + op_count - 1 < len(code):
-        ops = code[i:i + op_count]
-        if op_count > 1:
-            new_code = code_pass(ops, i)
+class PeepholeRule:
+    """Rewrite of windows of window consecutive ops
+
+    rewrite is called with the list of ops in the window and the position
+    of its first op in the rewritten code. It returns None to leave them
+    alone or the list of ops to replace them with.
+    """
+    def __init__(self, rewrite, window=1):
+        self.rewrite = rewrite
+        self.window = window
+
+    def __repr__(self):
+        return "PeepholeRule({}, {})".format(self.rewrite.__name__, self.window)
+
+
+# Optimizations applied by compile_program when should_optimize is set, each
+# in its own pass in this order
+PEEPHOLE_RULES = []
+
+
+def peephole_rule(window):
+    """Register a rewrite function as an optimization in PEEPHOLE_RULES"""
+    def register(rewrite):
+        PEEPHOLE_RULES.append(PeepholeRule(rewrite, window))
+        return rewrite
+    return register
+
+
+def rewrite_code(code, rules):
+    """Apply rules to code in a single pass and return the new code
+
+    Ops are moved one at a time from code to the output, and after each
+    one the rules are tried on the window at the end of the output. Ops
+    produced by a rewrite are moved back to the input, so they are matched
+    again together with the ops before them. A rule must not keep matching
+    its own output.
+    """
+    output = []
+    pending = []
+    index = 0
+    code_len = len(code)
+    while pending or index < code_len:
+        if pending:
+            output.append(pending.pop())
         else:
-            new_code = code_pass(ops[0], i)
-        code[i:i + op_count] = new_code
-        if new_code == ops:
-            i += 1
+            output.append(code[index])
+            index += 1
+        for rule in rules:
+            window = rule.window
+            if len(output) < window:
+                continue
+            start = len(output) - window
+            new_ops = rule.rewrite(output[start:], start)
+            if new_ops is not None:
+                del output[start:]
+                pending.extend(reversed(new_ops))
+                break
+    return output
 
 
+@peephole_rule(2)
 def remove_nop_swaps(ops, i):
-    if ops[0] == ops[1] and (
-            ops[0].op_code == instructions.OPS["swap1"] or
-            ops[0].op_code == instructions.OPS["swap2"]):
+    if (
+            isinstance(ops[0], ast.BasicOp) and
+            ops[0] == ops[1] and (
+                ops[0].op_code == instructions.OPS["swap1"] or
+                ops[0].op_code == instructions.OPS["swap2"]
+            )
+    ):
         return []
-
-    return ops
+    return None
 
 
+@peephole_rule(2)
 def compress_pushes(ops, i):
     if (
             isinstance(ops[0], ast.ImmediateOp) and
@@ -505,18 +731,204 @@ def compress_pushes(ops, i):
             ops[1].get_op() != instructions.OPS["pcpush"]
     ):
         return [ast.ImmediateOp(ops[1], ops[0].val, ops[1].path)]
-    else:
-        return ops
+    return None
+
+
+# Ops that only depend on their operands, which constant folding may run at
+# compile time
+FOLDABLE_OPS = {
+    instructions.OPS[op_name] for op_name in [
+        "add", "mul", "sub", "div", "sdiv", "mod", "smod", "addmod",
+        "mulmod", "exp", "signextend", "lt", "gt", "slt", "sgt", "eq",
+        "iszero", "bitwise_and", "bitwise_or", "bitwise_xor", "bitwise_not",
+        "byte", "hash", "type", "tget", "tset", "tlen"
+    ]
+}
+
+# The only foldable ops that take tuple operands, the rest are only folded
+# when every operand is an int
+TUPLE_OPS = {
+    instructions.OPS[op_name] for op_name in [
+        "eq", "hash", "type", "tget", "tset", "tlen"
+    ]
+}
+
+
+def _is_constant(val):
+    # Ints and tuples of them, not labels or code points
+    vals = [val]
+    while vals:
+        val = vals.pop()
+        if isinstance(val, value.Tuple):
+            vals.extend(val.val)
+        elif not isinstance(val, int):
+            return False
+    return True
+
+
+def _is_constant_push(op):
+    return (
+        isinstance(op, ast.ImmediateOp) and
+        op.op.op_code == instructions.OPS["nop"] and
+        _is_constant(op.val)
+    )
+
+
+def _is_int_push(op):
+    return _is_constant_push(op) and isinstance(op.val, int)
+
+
+def _push(val, path):
+    return ast.ImmediateOp(ast.BasicOp(instructions.OPS["nop"]), val, path)
+
+
+def _fold_rule(window):
+    # Folds window - 1 constant pushes and a foldable op using all of them,
+    # or window - 2 pushes and the op with its last operand as immediate
+    def fold_constants(ops, i):
+        op = ops[-1]
+        if not all(_is_constant_push(push) for push in ops[:-1]):
+            return None
+        operands = [push.val for push in ops[:-1]]
+        if isinstance(op, ast.ImmediateOp):
+            op_code = op.op.op_code
+            if not _is_constant(op.val):
+                return None
+            operands.append(op.val)
+        elif isinstance(op, ast.BasicOp):
+            op_code = op.op_code
+        else:
+            return None
+        if (
+                op_code not in FOLDABLE_OPS or
+                len(instructions.OF_INFO[op_code]["pop"]) != len(operands)
+        ):
+            return None
+        if op_code not in TUPLE_OPS and not all(
+                isinstance(operand, int) for operand in operands
+        ):
+            return None
+        vm = BasicVM()
+        for operand in operands:
+            vm.stack.push(operand)
+        try:
+            getattr(vm, instructions.OP_NAMES[op_code])()
+        except Exception:
+            # Errors like division by zero are left for run time
+            return None
+        return [_push(vm.stack.pop(), op.path)]
+    return PeepholeRule(fold_constants, window)
+
+
+def _is_op(op, op_name):
+    return isinstance(op, ast.BasicOp) and op.op_code == instructions.OPS[op_name]
+
+
+def drop_constant_pops(ops, i):
+    if _is_constant_push(ops[0]) and _is_op(ops[1], "pop"):
+        return []
+    return None
+
+
+def swap_constants(ops, i):
+    if (
+            _is_constant_push(ops[0]) and
+            _is_constant_push(ops[1]) and
+            _is_op(ops[2], "swap1")
+    ):
+        return [ops[1], ops[0]]
+    return None
+
+
+def dup_constants(ops, i):
+    # Only ints, so large tuples aren't copied into the code
+    if _is_op(ops[-1], "dup0") and _is_int_push(ops[-2]):
+        return ops[-3:-1] + [_push(ops[-2].val, ops[-1].path)]
+    if (
+            _is_op(ops[-1], "dup1") and
+            _is_int_push(ops[-3]) and
+            _is_constant_push(ops[-2])
+    ):
+        return [ops[-3], ops[-2], _push(ops[-3].val, ops[-1].path)]
+    return None
+
+
+# Rules run together in one pass by fold_constants. Each sees constants
+# pushed right before an op, and rewrites are matched again with the ops
+# before them, so chains of constant ops fold to a single push.
+CONSTANT_FOLDING_RULES = [
+    _fold_rule(1),
+    _fold_rule(2),
+    _fold_rule(3),
+    _fold_rule(4),
+    PeepholeRule(drop_constant_pops, 2),
+    PeepholeRule(swap_constants, 3),
+    PeepholeRule(dup_constants, 3)
+]
+
+
+def fold_constants(code):
+    return rewrite_code(code, CONSTANT_FOLDING_RULES)
+
+
+# Ops after which the next op only runs if something jumps to it
+BLOCK_END_OPS = {
+    instructions.OPS[op_name] for op_name in ["jump", "halt", "error"]
+}
+
+
+def remove_unreachable(code):
+    """Drop the ops between a jump, halt or error and the next label
+
+    Labels are kept, since any of them can be a jump target. Run before
+    labels are resolved, after that the number of instructions can't
+    change.
+    """
+    ret = []
+    reachable = True
+    for op in code:
+        if isinstance(op, (ast.AVMLabel, ast.AVMUniqueLabel)):
+            reachable = True
+        if not reachable:
+            continue
+        ret.append(op)
+        if isinstance(op, ast.ImmediateOp):
+            reachable = op.op.op_code not in BLOCK_END_OPS
+        elif isinstance(op, ast.BasicOp):
+            reachable = op.op_code not in BLOCK_END_OPS
+    return ret
+
+
+def reduction_report(before, after):
+    """Compare the instruction counts of two versions of flattened code
+
+    Instructions are grouped by the first entry of their path, like
+    EVMContract(...) for EVM contracts or FuncDefinition(...) for
+    functions. Returns (group, before, after) rows, largest reduction
+    first.
+    """
+    counts = {}
+    for column, code in enumerate([before, after]):
+        for op in code:
+            if isinstance(op, (ast.AVMLabel, ast.AVMUniqueLabel)):
+                continue
+            group = str(op.path[0]) if len(op.path) else ""
+            counts.setdefault(group, [0, 0])[column] += 1
+    return sorted(
+        ((group, old, new) for group, (old, new) in counts.items()),
+        key=lambda row: (row[2] - row[1], row[0])
+    )
 
 
 def resolve_labels(static_tracker):
-    def impl(op, i):
+    def impl(ops, i):
+        op = ops[0]
         if not isinstance(op, (ast.AVMLabel, ast.AVMUniqueLabel)):
-            return [op]
+            return None
         static_tracker.resolve_label(op, ast.AVMLabeledPos(op.name, i))
         return []
 
-    return impl
+    return PeepholeRule(impl)
 
 
 def resolve_immediate_ops(static_tracker):
@@ -537,15 +949,12 @@ def resolve_immediate_ops(static_tracker):
         else:
             return val
 
-    def impl(op, i):
-        if isinstance(op, ast.ImmediateOp):
-            if contains_label(op.val):
-                return [ast.ImmediateOp(op.op, transform_val(op.val), op.path)]
-            else:
-                return [op]
-        else:
-            return [op]
-    return impl
+    def impl(ops, i):
+        op = ops[0]
+        if isinstance(op, ast.ImmediateOp) and contains_label(op.val):
+            return [ast.ImmediateOp(op.op, transform_val(op.val), op.path)]
+        return None
+    return PeepholeRule(impl)
 
 
 class VMCompiler:
@@ -622,17 +1031,97 @@ def expectation_dependencies(expectations):
 
 
 def flatten_block(op):
-    if not isinstance(op, ast.BlockStatement):
-        return [op]
+    """Return the ops inside op with the nested BlockStatements removed
+
+    The path of every op becomes an ast.SourcePath of the paths of the
+    blocks around it followed by its own path.
+    """
     ret = []
-    for sub_op in op.code:
-        ret += flatten_block(sub_op)
-    for sub_op in ret:
-        sub_op.path = list(op.path) + sub_op.path
+    # (op, path of the blocks around it), the next op is on top
+    stack = [(op, ast.SourcePath())]
+    while stack:
+        op, path = stack.pop()
+        path = path.extend(op.path)
+        if isinstance(op, ast.BlockStatement):
+            stack.extend((sub_op, path) for sub_op in reversed(op.code))
+        else:
+            op.path = path
+            ret.append(op)
     return ret
 
 
-def compile_program(initialization, body, should_optimize=True):
+def inline_call(compiled_funcs, call_graph, definition):
+    # Only the callers of the function have calls to replace
+    for func in sorted(call_graph.callers[definition.name]):
+        compiled_funcs[func] = compiled_funcs[func].modify_ast(
+            InlineCallTransformer(definition)
+        )
+    call_graph.inline(definition.name)
+
+
+# Steps run for every call that isn't inlined once pushes are compressed:
+# auxpush of the return label, loading the function's code point from the
+# static (two steps in most programs) and jump at the call site, then auxpop
+# and jump at the end of the function
+CALL_DISPATCH_STEPS = 6
+
+# Default number of instructions profile guided inlining may add
+INLINE_BUDGET = 2000
+
+
+def inline_hot_calls(compiled_funcs, call_graph, candidates, profile, budget):
+    """Inline the most called functions of candidates while the code they
+    add fits in budget
+
+    profile maps function names to the number of calls run, like
+    Profiler.call_counts. Returns (function, call sites, calls, added
+    instructions, dispatch steps saved) rows for the inlined functions.
+    """
+    report = []
+    hot = sorted(
+        (func for func in candidates if profile.get(func, 0) > 0),
+        key=lambda func: (-profile[func], func)
+    )
+    for func in hot:
+        sites = call_graph.call_count(func)
+        if not sites:
+            continue
+        # The definition goes away once every call site has a copy
+        added = len(compiled_funcs[func]) * (sites - 1)
+        if added > budget:
+            continue
+        budget -= added
+        func_to_inline = compiled_funcs[func]
+        del compiled_funcs[func]
+        inline_call(compiled_funcs, call_graph, func_to_inline)
+        candidates.remove(func)
+        report.append((
+            func,
+            sites,
+            profile[func],
+            added,
+            profile[func] * CALL_DISPATCH_STEPS
+        ))
+    return report
+
+
+def compile_program(
+        initialization,
+        body,
+        should_optimize=True,
+        previous=None,
+        profile=None,
+        inline_budget=INLINE_BUDGET
+):
+    """Compile a program to a VM
+
+    previous is a VM from an earlier compile of a similar program whose
+    code point hashes can be reused. If profile is given, calls that ran
+    most in it are inlined as described in inline_hot_calls, and the report
+    is left in vm.inline_report. When optimizing, constants are folded and
+    unreachable code removed, vm.optimization_report has the
+    reduction_report of that.
+    """
     compiled_funcs = {}
 
     # Iteratively resolve all function calls
@@ -714,30 +1203,27 @@ def compile_program(initialization, body, should_optimize=True):
             CastRemover()
         )
 
+    call_graph = CallGraph(compiled_funcs)
+    inline_report = []
     if should_optimize:
-        # use cycle checking to figure out which functions are safe to inline
-        non_recursive = get_non_recursive(compiled_funcs)
-        non_recursive = [x for x in non_recursive if compiled_funcs[x].is_callable]
+        # only functions outside of call cycles are safe to inline
+        recursive = call_graph.recursive()
+        non_recursive = [
+            x for x in call_graph.nodes()
+            if x not in recursive and compiled_funcs[x].is_callable
+        ]
         # IMPORTANT: Inling requires code cloning which only currently works
         #            if the ast in the code includes no labels.
-        # # count how many times each function is called
-        counter = CallCounter()
-        for func in compiled_funcs:
-            compiled_funcs[func].modify_ast(counter)
 
         # inline non-recursive functions that are called a single time
         single_call = [
-            x for x in counter.call_counts
-            if counter.call_counts[x] == 1 and x in non_recursive
+            x for x in non_recursive if call_graph.call_count(x) == 1
         ]
         for single_func in single_call:
             func_to_inline = compiled_funcs[single_func]
-            for func in compiled_funcs:
-                compiled_funcs[func] = compiled_funcs[func].modify_ast(
-                    InlineCallTransformer(func_to_inline)
-                )
-            non_recursive.remove(single_func)
             del compiled_funcs[single_func]
+            inline_call(compiled_funcs, call_graph, func_to_inline)
+            non_recursive.remove(single_func)
 
         # inline short non-recursive functions
         while True:
@@ -751,18 +1237,24 @@ def compile_program(initialization, body, should_optimize=True):
                 break
             func_to_inline = compiled_funcs[shortest_non_recursive]
             del compiled_funcs[shortest_non_recursive]
-            for func in compiled_funcs:
-                compiled_funcs[func] = compiled_funcs[func].modify_ast(
-                    InlineCallTransformer(func_to_inline)
-                )
+            inline_call(compiled_funcs, call_graph, func_to_inline)
             non_recursive.remove(shortest_non_recursive)
 
+        if profile:
+            inline_report = inline_hot_calls(
+                compiled_funcs,
+                call_graph,
+                non_recursive,
+                profile,
+                inline_budget
+            )
+
     for func in compiled_funcs:
         compiled_funcs[func] = compiled_funcs[func].modify_ast(
             FlowControlTransformer(label_gen)
         )
 
-    function_order = topological_sort(compiled_funcs)
+    function_order = call_graph.topological_order()
     other_funcs = sorted([x for x in compiled_funcs if x not in function_order])
     function_order += other_funcs
 
@@ -792,17 +1284,29 @@ def compile_program(initialization, body, should_optimize=True):
     full_code = full_code.modify_ast(PushTransformer(static_tracker))
     full_code = flatten_block(full_code)
 
+    optimization_report = []
     if should_optimize:
-        transform_code_block(full_code, remove_nop_swaps, 2)
-        transform_code_block(full_code, compress_pushes, 2)
+        flat_code = full_code
+        full_code = remove_unreachable(fold_constants(full_code))
+        optimization_report = reduction_report(flat_code, full_code)
+        # One pass per rule, so a push isn't fused with a swap that a later
+        # op would have cancelled
+        for rule in PEEPHOLE_RULES:
+            full_code = rewrite_code(full_code, [rule])
 
     # replace all labels with code points
     # Warning: After this pass the number of instructions can't change
-    transform_code_block(full_code, resolve_labels(static_tracker))
-    transform_code_block(full_code, resolve_immediate_ops(static_tracker))
-    code_pointers = generate_code_pointers(full_code)
+    full_code = rewrite_code(full_code, [resolve_labels(static_tracker)])
+    full_code = rewrite_code(full_code, [resolve_immediate_ops(static_tracker)])
+    # A VM from an earlier compile lets unchanged code keep its hashes
+    code_pointers, static = update_code_pointers(
+        full_code,
+        static_tracker.get_arb_value(),
+        previous.code if previous is not None else None
+    )
     vm = VM(code_pointers)
-    vm.static = static_tracker.get_arb_value()
-    vm.static = replace_code_points(vm.static, code_pointers)
+    vm.static = static
+    vm.inline_report = inline_report
+    vm.optimization_report = optimization_report
     # print(vm.static)
     return vm
@@ -50,7 +50,7 @@ def make_empty():
     call_frame.set_val("logs")(vm)
     call_frame.set_val("return_data")(vm)
     call_frame.set_val("sent_queue")(vm)
-    return vm.stack.items[0]
+    return vm.stack[0]
 
 @modifies_stack([call_frame.typ], [types.contract_state.typ])
 def lookup_current_state(vm):
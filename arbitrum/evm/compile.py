@@ -537,4 +537,7 @@ def generate_contract_code(label, code, code_tuple, contract_id, code_size, code
         block.add_node("EthOp({}, {})".format(insn, insn.pc))
         contract_code.append(block)
 
-    return BlockStatement(contract_code)
+    return BlockStatement(
+        contract_code,
+        ["EVMContract({})".format(hex(contract_id))]
+    )
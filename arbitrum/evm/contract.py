@@ -18,6 +18,7 @@ import eth_abi
 
 from .compile import generate_evm_code
 from .. import value, compile_program
+from ..compiler import INLINE_BUDGET
 from ..std import sized_byterange, stack
 
 
@@ -271,7 +272,13 @@ def create_output_handler(contracts):
     return output_handler
 
 
-def create_evm_vm(contracts, should_optimize=True):
+def create_evm_vm(
+        contracts,
+        should_optimize=True,
+        previous=None,
+        profile=None,
+        inline_budget=INLINE_BUDGET
+):
     code = {}
     storage = {}
     for contract in contracts:
@@ -279,7 +286,14 @@ def create_evm_vm(contracts, should_optimize=True):
         storage[contract.address] = contract.storage
 
     initial_block, code = generate_evm_code(code, storage)
-    vm = compile_program(initial_block, code, should_optimize)
+    vm = compile_program(
+        initial_block,
+        code,
+        should_optimize,
+        previous,
+        profile,
+        inline_budget
+    )
     vm.output_handler = create_output_handler(contracts)
 
     return vm
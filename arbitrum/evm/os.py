@@ -65,7 +65,7 @@ def make_global_exec_state():
     global_exec_state.set_val("block_number")(vm)
     global_exec_state.set_val("timestamp")(vm)
     global_exec_state.set_val("txhash")(vm)
-    return vm.stack.items[0]
+    return vm.stack[0]
 
 
 @modifies_stack(
@@ -213,7 +213,7 @@ def create_initial_evm_state(contracts):
     chain_state.set_val("sender_seq")(vm)
     chain_state.set_val("inbox")(vm)
     chain_state.set_val("contracts")(vm)
-    return vm.stack.items[0]
+    return vm.stack[0]
 
 
 def initialize(vm, contracts):
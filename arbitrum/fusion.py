@@ -0,0 +1,325 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Superinstructions for the decoded interpreter in vm_runner.
+#
+# A fusion replaces the handler of the first code point of a common
+# sequence with a single Python function that runs the whole sequence and
+# moves the pc past it. vm.code itself is never modified, so pcs, code
+# point hashes and marshalled output are unchanged and jumps into the
+# middle of a fused sequence still run the original handlers.
+#
+# Every fused handler first checks that none of the fused instructions can
+# fail. If one could, it runs only the first instruction's normal handler
+# and lets the interpreter continue one instruction at a time, so errors
+# are raised at the same pc with the same stack as without fusion. A fused
+# handler returns the number of instructions it ran.
+
+from .ast import ImmediateOp, AVMLabeledCodePoint
+from .instructions import OPS
+from . import value
+
+NO_IMMEDIATE = object()
+
+
+def _decode(code_point):
+    instr = code_point.op
+    if isinstance(instr, ImmediateOp):
+        return instr.op.op_code, instr.val
+    if isinstance(instr, int):
+        return instr, NO_IMMEDIATE
+    return instr.op_code, NO_IMMEDIATE
+
+
+def _resolve_code_point(dest):
+    if isinstance(dest, value.AVMCodePoint):
+        return dest
+    if isinstance(dest, AVMLabeledCodePoint):
+        return dest.pc
+    return None
+
+
+class FusionSite:
+    def __init__(self, name, pc, length):
+        self.name = name
+        self.pc = pc
+        self.length = length
+        self.hits = 0
+
+
+class Fusion:
+    def __init__(self, name, match, build):
+        self.name = name
+        # match(ops, i) returns the length of the sequence starting at i
+        # or 0 if it doesn't match
+        self.match = match
+        # build(vm, code, i, length, fallback, site) returns the handler
+        self.build = build
+
+
+def _match_is_equal(ops, i):
+    if (
+            i + 1 < len(ops) and
+            ops[i] == (OPS["dup0"], NO_IMMEDIATE) and
+            ops[i + 1][0] == OPS["eq"] and
+            ops[i + 1][1] is not NO_IMMEDIATE
+    ):
+        return 2
+    return 0
+
+
+# dup0; eq(val)
+def _build_is_equal(vm, code, i, length, fallback, site):
+    stack = vm.stack
+    val = _decode(code[i + 1])[1]
+    next_pc = code[i + length]
+
+    def is_equal():
+        if not len(stack):
+            return fallback()
+        stack.push(int(val == stack.peak()))
+        site.hits += 1
+        vm.pc = next_pc
+        return length
+    return is_equal
+
+
+def _match_const_op(first_op, second_op):
+    def impl(ops, i):
+        if (
+                i + 1 < len(ops) and
+                ops[i][0] == OPS[first_op] and
+                isinstance(ops[i][1], int) and
+                ops[i][1] != 0 and
+                ops[i + 1] == (OPS[second_op], NO_IMMEDIATE)
+        ):
+            return 2
+        return 0
+    return impl
+
+
+# dup1(c); mod which is push c; dup1; mod
+def _build_mod_const(vm, code, i, length, fallback, site):
+    stack = vm.stack
+    const = _decode(code[i])[1]
+    next_pc = code[i + length]
+
+    def mod_const():
+        if not len(stack) or not isinstance(stack.peak(), int):
+            return fallback()
+        stack.push(stack.peak() % const)
+        site.hits += 1
+        vm.pc = next_pc
+        return length
+    return mod_const
+
+
+# swap1(c); div which is push c; swap1; div
+def _build_div_const(vm, code, i, length, fallback, site):
+    stack = vm.stack
+    const = _decode(code[i])[1]
+    next_pc = code[i + length]
+
+    def div_const():
+        if not len(stack) or not isinstance(stack.peak(), int):
+            return fallback()
+        stack.push(stack.pop() // const)
+        site.hits += 1
+        vm.pc = next_pc
+        return length
+    return div_const
+
+
+def _match_get_path(ops, i):
+    if ops[i] not in [
+            (OPS["rpush"], NO_IMMEDIATE),
+            (OPS["spush"], NO_IMMEDIATE),
+            (OPS["dup0"], NO_IMMEDIATE)
+    ]:
+        return 0
+    length = 1
+    while (
+            i + length < len(ops) and
+            ops[i + length][0] == OPS["tget"] and
+            isinstance(ops[i + length][1], int)
+    ):
+        length += 1
+    if length == 1:
+        return 0
+    return length
+
+
+# (rpush | spush | dup0); tget(a); tget(b); ...
+def _build_get_path(vm, code, i, length, fallback, site):
+    stack = vm.stack
+    source = _decode(code[i])[0]
+    path = [_decode(code_point)[1] for code_point in code[i + 1:i + length]]
+    next_pc = code[i + length]
+
+    def get_path():
+        if source == OPS["rpush"]:
+            val = vm.register
+        elif source == OPS["spush"]:
+            val = vm.static
+        elif len(stack):
+            val = stack.peak()
+        else:
+            return fallback()
+        for index in path:
+            if not isinstance(val, value.Tuple) or index >= len(val):
+                return fallback()
+            val = val[index]
+        stack.push(val)
+        site.hits += 1
+        vm.pc = next_pc
+        return length
+    return get_path
+
+
+def _valid_jump(code, dest, i, length):
+    # A jump to the last instruction of the sequence or to the start of it
+    # looks like a pc that was never modified to the interpreter
+    return (
+        dest is not None and
+        0 <= dest.pc < len(code) and
+        code[dest.pc] is dest and
+        dest.pc != i and
+        dest.pc != i + length - 1
+    )
+
+
+def _match_branch_if_zero(ops, i):
+    if (
+            i + 1 < len(ops) and
+            ops[i] == (OPS["iszero"], NO_IMMEDIATE) and
+            ops[i + 1][0] == OPS["cjump"]
+    ):
+        return 2
+    return 0
+
+
+# iszero; cjump(dest)
+def _build_branch_if_zero(vm, code, i, length, fallback, site):
+    dest = _resolve_code_point(_decode(code[i + 1])[1])
+    if not _valid_jump(code, dest, i, length):
+        return None
+    stack = vm.stack
+    next_pc = code[i + length]
+
+    def branch_if_zero():
+        if not len(stack):
+            return fallback()
+        if stack.pop() == 0:
+            vm.pc = dest
+        else:
+            vm.pc = next_pc
+        site.hits += 1
+        return length
+    return branch_if_zero
+
+
+def _match_pair(first_op, second_op):
+    def impl(ops, i):
+        if (
+                i + 1 < len(ops) and
+                ops[i] == (OPS[first_op], NO_IMMEDIATE) and
+                ops[i + 1] == (OPS[second_op], NO_IMMEDIATE)
+        ):
+            return 2
+        return 0
+    return impl
+
+
+# auxpop; jump
+def _build_return(vm, code, i, length, fallback, site):
+    aux_stack = vm.aux_stack
+
+    def ret():
+        if not len(aux_stack):
+            return fallback()
+        dest = _resolve_code_point(aux_stack.peak())
+        if not _valid_jump(code, dest, i, length):
+            return fallback()
+        aux_stack.pop()
+        vm.pc = dest
+        site.hits += 1
+        return length
+    return ret
+
+
+# pcpush; auxpush
+def _build_save_pc(vm, code, i, length, fallback, site):
+    aux_stack = vm.aux_stack
+    pc = code[i]
+    next_pc = code[i + length]
+
+    def save_pc():
+        aux_stack.push(pc)
+        site.hits += 1
+        vm.pc = next_pc
+        return length
+    return save_pc
+
+
+FUSIONS = [
+    Fusion("get_path", _match_get_path, _build_get_path),
+    Fusion("is_equal", _match_is_equal, _build_is_equal),
+    Fusion("mod_const", _match_const_op("dup1", "mod"), _build_mod_const),
+    Fusion("div_const", _match_const_op("swap1", "div"), _build_div_const),
+    Fusion("branch_if_zero", _match_branch_if_zero, _build_branch_if_zero),
+    Fusion("return", _match_pair("auxpop", "jump"), _build_return),
+    Fusion("save_pc", _match_pair("pcpush", "auxpush"), _build_save_pc),
+]
+
+
+def fuse_handlers(vm, code, handlers, fusions=FUSIONS):
+    """Return a copy of handlers with fused handlers installed
+
+    Also returns the list of FusionSites that were installed.
+    """
+    ops = [_decode(code_point) for code_point in code]
+    fused = list(handlers)
+    sites = []
+    i = 0
+    while i < len(code):
+        for fusion in fusions:
+            length = fusion.match(ops, i)
+            # The fused handler moves to the code point after the sequence
+            # so the sequence can't be at the end of the program
+            if not length or i + length >= len(code):
+                continue
+            site = FusionSite(fusion.name, i, length)
+            handler = fusion.build(vm, code, i, length, handlers[i], site)
+            if handler is None:
+                continue
+            fused[i] = handler
+            sites.append(site)
+            break
+        i += 1
+    return fused, sites
+
+
+def fusion_report(sites):
+    """Summarize fusion sites as (name, sites, hits, dispatches saved) rows"""
+    rows = {}
+    for site in sites:
+        row = rows.setdefault(site.name, [site.name, 0, 0, 0])
+        row[1] += 1
+        row[2] += site.hits
+        row[3] += site.hits * (site.length - 1)
+    return sorted(
+        (tuple(row) for row in rows.values()),
+        key=lambda row: row[3],
+        reverse=True
+    )
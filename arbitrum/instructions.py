@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .value import ValueType, IntType, TupleType, CodePointType, Tuple
+from .value import ValueType, IntType, TupleType, CodePointType, Tuple, EMPTY_TUPLE
 
 OP_CODES = [
     # Arithmetic
@@ -155,7 +155,7 @@ def tlen(stack):
 
 def tnew(stack):
     size = stack.pop(IntType())
-    stack.push(Tuple([Tuple([]) for i in range(size)]))
+    stack.push(Tuple([EMPTY_TUPLE] * size))
 
 
 def tget(stack):
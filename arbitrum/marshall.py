@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import eth_abi
+import mmap
+import os
+
+import eth_utils
+
 from .ast import AVMLabeledCodePoint, BasicOp, ImmediateOp
 from . import value
 from . import instructions
@@ -20,87 +24,645 @@ from . import instructions
 INT_TYPE_CODE = 0
 CODE_POINT_TYPE_CODE = 1
 TUPLE_TYPE_CODE = 3
+# Only used with the DAG extension, followed by a 4 byte index
+REF_TYPE_CODE = TUPLE_TYPE_CODE + 9
+
+# With this extension in the header every int and nonempty tuple written in
+# full is numbered in the order it starts, and values written before are
+# replaced by a back-reference to their number
+DAG_EXTENSION_ID = 1
+# Offsets of the ops for random access, built by index_extension and read by
+# CodeIndex. The data is the code length (8 bytes), the offset of every op
+# from the start of the ops (4 bytes each), the number of large immediates
+# (4 bytes) and the pc and marshalled size of each of them (4 bytes each).
+INDEX_EXTENSION_ID = 2
+
+
+class Extension:
+    def __init__(self, id, data):
+        self.id = id
+        self.data = data
+
+
+def dag_extension():
+    return Extension(DAG_EXTENSION_ID, b"")
+
+
+# Marshalled values are collected in a buffer that is written out once it
+# holds this many bytes
+FLUSH_SIZE = 1 << 16
+
+
+class _Raw:
+    # Bytes queued on the stack of values to write
+    __slots__ = ["data"]
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _dag_hash(val, memo):
+    # value_hash, except that labeled code points hash like their code point
+    if isinstance(val, AVMLabeledCodePoint):
+        val = val.pc
+    if not isinstance(val, value.Tuple) or val.merkle_hash is not None:
+        return value.value_hash(val)
+    key = id(val)
+    if key not in memo:
+        memo[key] = eth_utils.keccak(
+            value.TUPLE_HASH_PREFIXES[len(val.val)] +
+            b"".join([_dag_hash(item, memo) for item in val.val])
+        )
+    return memo[key]
+
+
+def _padded_hash(next_hash):
+    # The empty next_hash of the last code point is padded with '0's
+    return b'0' * (32 - len(next_hash)) + bytes(next_hash)
+
+
+class Marshaller:
+    """Buffered writer for values in the .ao format
+
+    Values are encoded with an explicit stack, so deeply nested tuples
+    don't hit the recursion limit. If dag is set, repeated ints and tuples
+    are written as back-references as described for DAG_EXTENSION_ID. Call
+    flush when done.
+    """
+    def __init__(self, file, flush_size=FLUSH_SIZE, dag=False):
+        self.file = file
+        self.flush_size = flush_size
+        self.buffer = bytearray()
+        self.dag = dag
+        # Numbers of ints, numbers of tuples by hash and hashes by tuple id
+        self.int_refs = {}
+        self.refs = {}
+        self.ref_count = 0
+        self.hashes = {}
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            del self.buffer[:]
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def op(self, val):
+        stack = []
+        self._op(val, stack)
+        self._values(stack)
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def value(self, val):
+        self._values([val])
+
+    def _op(self, val, stack):
+        # Immediate values are pushed onto stack for _values to write
+        buffer = self.buffer
+        if isinstance(val, BasicOp):
+            buffer.append(0)
+            buffer.append(val.op_code)
+        elif isinstance(val, int):
+            buffer.append(0)
+            buffer.append(val)
+        elif isinstance(val, ImmediateOp):
+            buffer.append(1)
+            buffer.append(val.get_op())
+            stack.append(val.val)
+        else:
+            raise Exception("Tried to marshall bad operation type {}".format(val))
+
+    def _values(self, stack):
+        buffer = self.buffer
+        flush_size = self.flush_size
+        while stack:
+            val = stack.pop()
+            if isinstance(val, value.Tuple):
+                if self.dag and val.val:
+                    digest = _dag_hash(val, self.hashes)
+                    index = self.refs.get(digest)
+                    if index is not None:
+                        buffer.append(REF_TYPE_CODE)
+                        buffer += index.to_bytes(4, byteorder='big', signed=False)
+                        continue
+                    self.refs[digest] = self.ref_count
+                    self.ref_count += 1
+                buffer.append(TUPLE_TYPE_CODE + len(val))
+                stack.extend(reversed(val.val))
+            elif isinstance(val, int):
+                if self.dag:
+                    index = self.int_refs.get(val)
+                    if index is not None:
+                        buffer.append(REF_TYPE_CODE)
+                        buffer += index.to_bytes(4, byteorder='big', signed=False)
+                        continue
+                    self.int_refs[val] = self.ref_count
+                    self.ref_count += 1
+                buffer.append(INT_TYPE_CODE)
+                buffer += val.to_bytes(32, byteorder='big', signed=False)
+            elif isinstance(val, (value.AVMCodePoint, AVMLabeledCodePoint)):
+                if isinstance(val, AVMLabeledCodePoint):
+                    val = val.pc
+                buffer.append(CODE_POINT_TYPE_CODE)
+                buffer += val.pc.to_bytes(8, byteorder='big', signed=True)
+                # The next hash goes after the immediate value
+                stack.append(_Raw(_padded_hash(val.next_hash)))
+                self._op(val.op, stack)
+            elif isinstance(val, _Raw):
+                buffer += val.data
+            else:
+                raise Exception("Can't marshall unexcepted value {}".format(val))
+            if len(buffer) >= flush_size:
+                self.flush()
+
+
+def _marshall(file, write):
+    marshaller = Marshaller(file)
+    write(marshaller)
+    marshaller.flush()
 
 
 def marshall_int(val, file):
-    file.write(eth_abi.encode_single("uint256", val))
+    file.write(val.to_bytes(32, byteorder='big', signed=False))
 
 
 def marshall_op(val, file):
-    if isinstance(val, BasicOp):
-        op_type = 0
-        file.write(op_type.to_bytes(1, byteorder='big', signed=False))
-        file.write(val.op_code.to_bytes(1, byteorder='big', signed=False))
-    elif isinstance(val, int):
-        op_type = 0
-        file.write(op_type.to_bytes(1, byteorder='big', signed=False))
-        file.write(val.to_bytes(1, byteorder='big', signed=False))
-    elif isinstance(val, ImmediateOp):
-        op_type = 1
-        file.write(op_type.to_bytes(1, byteorder='big', signed=False))
-        file.write(val.get_op().to_bytes(1, byteorder='big', signed=False))
-        marshall_value(val.val, file)
-    else:
-        raise Exception("Tried to marshall bad operation type {}".format(val))
+    _marshall(file, lambda marshaller: marshaller.op(val))
 
 
 def marshall_codepoint(val, file):
-    file.write(val.pc.to_bytes(8, byteorder='big', signed=True))
-    marshall_op(val.op, file)
-    val.next_hash = b'0' * (32 - len(val.next_hash)) + val.next_hash
-    file.write(val.next_hash)
+    def write(marshaller):
+        marshaller.write(val.pc.to_bytes(8, byteorder='big', signed=True))
+        marshaller.op(val.op)
+        marshaller.write(_padded_hash(val.next_hash))
+    _marshall(file, write)
 
 
 def marshall_tuple(val, file):
-    for item in val:
-        marshall_value(item, file)
+    def write(marshaller):
+        for item in val:
+            marshaller.value(item)
+    _marshall(file, write)
 
 
 def marshall_value(val, file):
-    if isinstance(val, value.Tuple):
-        file.write((TUPLE_TYPE_CODE + len(val)).to_bytes(
-            1,
-            byteorder='big',
-            signed=False
-        ))
-        marshall_tuple(val, file)
-    elif isinstance(val, int):
-        file.write(INT_TYPE_CODE.to_bytes(
-            1,
-            byteorder='big',
-            signed=False
-        ))
-        marshall_int(val, file)
-    elif isinstance(val, value.AVMCodePoint):
-        file.write(CODE_POINT_TYPE_CODE.to_bytes(
-            1,
-            byteorder='big',
-            signed=False
-        ))
-        marshall_codepoint(val, file)
-    elif isinstance(val, AVMLabeledCodePoint):
-        file.write(CODE_POINT_TYPE_CODE.to_bytes(
-            1,
-            byteorder='big',
-            signed=False
-        ))
-        marshall_codepoint(val.pc, file)
-    else:
-        raise Exception("Can't marshall unexcepted value {}".format(val))
+    _marshall(file, lambda marshaller: marshaller.value(val))
 
 
 AO_VERSION = 1
 
 
+# Immediates with at least this many marshalled bytes are listed in the
+# table of the index extension
+LARGE_IMMEDIATE_SIZE = 1 << 10
+
+
+def index_extension(vm, large_size=LARGE_IMMEDIATE_SIZE):
+    """Build the index extension for the ops of vm, see INDEX_EXTENSION_ID"""
+    marshaller = Marshaller(None, flush_size=float("inf"))
+    offsets = bytearray()
+    large = bytearray()
+    large_count = 0
+    for pc, instr in enumerate(vm.code):
+        start = len(marshaller.buffer)
+        offsets += start.to_bytes(4, byteorder='big', signed=False)
+        marshaller.op(instr.op)
+        size = len(marshaller.buffer) - start - 2
+        if isinstance(instr.op, ImmediateOp) and size >= large_size:
+            large += pc.to_bytes(4, byteorder='big', signed=False)
+            large += size.to_bytes(4, byteorder='big', signed=False)
+            large_count += 1
+    return Extension(
+        INDEX_EXTENSION_ID,
+        len(vm.code).to_bytes(8, byteorder='big', signed=False) +
+        offsets +
+        large_count.to_bytes(4, byteorder='big', signed=False) +
+        large
+    )
+
+
 def marshall_vm(vm, file, extensions=[]):
-    file.write(AO_VERSION.to_bytes(4, byteorder='big', signed=False))
+    ids = [extension.id for extension in extensions]
+    if DAG_EXTENSION_ID in ids and INDEX_EXTENSION_ID in ids:
+        # Back-references make ops depend on everything written before them
+        raise Exception("The index extension can't be used with the DAG extension")
+    marshaller = Marshaller(file, dag=DAG_EXTENSION_ID in ids)
+    marshaller.write(AO_VERSION.to_bytes(4, byteorder='big', signed=False))
     for extension in extensions:
-        file.write(extension.id.to_bytes(4, byteorder='big', signed=False))
-        file.write(len(extension.data).to_bytes(4, byteorder='big', signed=False))
-        file.write(extension.data)
-    file.write((0).to_bytes(4, byteorder='big', signed=False))
+        marshaller.write(extension.id.to_bytes(4, byteorder='big', signed=False))
+        marshaller.write(len(extension.data).to_bytes(4, byteorder='big', signed=False))
+        marshaller.write(extension.data)
+    marshaller.write((0).to_bytes(4, byteorder='big', signed=False))
 
-    file.write(len(vm.code).to_bytes(8, byteorder='big', signed=False))
+    marshaller.write(len(vm.code).to_bytes(8, byteorder='big', signed=False))
     for instr in vm.code:
-        marshall_op(instr.op, file)
-    marshall_value(vm.static, file)
+        marshaller.op(instr.op)
+    marshaller.value(vm.static)
+    marshaller.flush()
+
+
+# Static subtrees with at least this many marshalled bytes are decoded when
+# they are first accessed
+LAZY_SIZE = 1 << 12
+
+
+def _op_code(op):
+    if isinstance(op, int):
+        return op
+    return op.get_op()
+
+
+class _Decoder:
+    """Decodes values from marshalled bytes, a bytes object or an mmap
+
+    Once code is set, code points read from values that match an entry of
+    code are replaced by it. If dag is set, tuples are numbered and
+    back-references resolved as described for DAG_EXTENSION_ID.
+    """
+    def __init__(self, data, dag=False):
+        self.data = data
+        self.code = None
+        self.refs = [] if dag else None
+
+    def read_int(self, offset, size):
+        end = offset + size
+        if end > len(self.data):
+            raise IndexError()
+        return int.from_bytes(self.data[offset:end], byteorder='big'), end
+
+    def op(self, offset):
+        data = self.data
+        op_type = data[offset]
+        op = BasicOp(data[offset + 1])
+        offset += 2
+        if op_type == 0:
+            return op, offset
+        if op_type == 1:
+            val, offset = self.value(offset)
+            return ImmediateOp(op, val), offset
+        raise Exception("Tried to unmarshall bad operation type {}".format(op_type))
+
+    def code_point(self, offset):
+        pc, offset = self.read_int(offset, 8)
+        if pc >= 1 << 63:
+            pc -= 1 << 64
+        op, offset = self.op(offset)
+        next_hash = bytes(self.data[offset:offset + 32])
+        if len(next_hash) != 32:
+            raise IndexError()
+        # marshall_codepoint pads the empty next_hash of the last code point
+        if next_hash == b'0' * 32:
+            next_hash = b''
+        code = self.code
+        if (
+                code is not None and
+                0 <= pc < len(code) and
+                code[pc].next_hash == next_hash and
+                _op_code(code[pc].op) == _op_code(op)
+        ):
+            return code[pc], offset + 32
+        return value.AVMCodePoint(pc, op, next_hash), offset + 32
+
+    def skip(self, offset):
+        """Return the offset after the value at offset"""
+        data = self.data
+        pending = 1
+        while pending:
+            type_code = data[offset]
+            pending -= 1
+            if type_code == INT_TYPE_CODE:
+                offset += 33
+            elif type_code == CODE_POINT_TYPE_CODE:
+                op_type = data[offset + 9]
+                offset += 11
+                if op_type == 1:
+                    offset = self.skip(offset)
+                offset += 32
+            elif TUPLE_TYPE_CODE <= type_code <= TUPLE_TYPE_CODE + 8:
+                pending += type_code - TUPLE_TYPE_CODE
+                offset += 1
+            elif type_code == REF_TYPE_CODE:
+                offset += 5
+            else:
+                raise Exception("Can't unmarshall unexpected type code {}".format(type_code))
+        if offset > len(data):
+            raise IndexError()
+        return offset
+
+    def value(self, offset, lazy=False):
+        """Decode the value at offset and return it with the offset after it
+
+        If lazy is set, large tuples are decoded when first accessed. Tuples
+        have to be numbered in order with back-references, so nothing is
+        lazy then.
+        """
+        data = self.data
+        refs = self.refs
+        if refs is not None:
+            lazy = False
+        # Tuples being decoded as (items, size, number)
+        stack = []
+        while True:
+            type_code = data[offset]
+            if type_code == INT_TYPE_CODE:
+                val, offset = self.read_int(offset + 1, 32)
+                if refs is not None:
+                    refs.append(val)
+            elif type_code == CODE_POINT_TYPE_CODE:
+                val, offset = self.code_point(offset + 1)
+            elif type_code == TUPLE_TYPE_CODE:
+                val = value.EMPTY_TUPLE
+                offset += 1
+            elif TUPLE_TYPE_CODE < type_code <= TUPLE_TYPE_CODE + 8:
+                end = self.skip(offset) if lazy else None
+                if lazy and end - offset >= LAZY_SIZE:
+                    val = _LazyTuple(self, offset)
+                    offset = end
+                else:
+                    number = None
+                    if refs is not None:
+                        number = len(refs)
+                        refs.append(None)
+                    # Everything inside a small tuple is small too
+                    stack.append(([], type_code - TUPLE_TYPE_CODE, number))
+                    lazy = False
+                    offset += 1
+                    continue
+            elif type_code == REF_TYPE_CODE and refs is not None:
+                index, offset = self.read_int(offset + 1, 4)
+                if index >= len(refs) or refs[index] is None:
+                    raise Exception("Bad back-reference {}".format(index))
+                val = refs[index]
+            else:
+                raise Exception("Can't unmarshall unexpected type code {}".format(type_code))
+
+            while stack:
+                items, size, number = stack[-1]
+                items.append(val)
+                if len(items) < size:
+                    break
+                stack.pop()
+                val = value.Tuple.from_items(tuple(items))
+                if number is not None:
+                    refs[number] = val
+            else:
+                return val, offset
+
+    def items(self, offset):
+        count = self.data[offset] - TUPLE_TYPE_CODE
+        offset += 1
+        items = []
+        for _ in range(count):
+            val, offset = self.value(offset, True)
+            items.append(val)
+        return tuple(items)
+
+
+_tuple_items = value.Tuple.val
+
+
+class _LazyTuple(value.Tuple):
+    # A marshalled tuple whose items are decoded on first access
+    __slots__ = ["decoder", "offset"]
+
+    def __init__(self, decoder, offset):
+        _tuple_items.__set__(self, None)
+        self.merkle_hash = None
+        self.hash_cache = None
+        self.node_count = None
+        self.byte_size = None
+        self.decoder = decoder
+        self.offset = offset
+
+    def __new__(cls, decoder, offset):
+        return object.__new__(cls)
+
+    @property
+    def val(self):
+        items = _tuple_items.__get__(self)
+        if items is None:
+            items = self.decoder.items(self.offset)
+            _tuple_items.__set__(self, items)
+            self.decoder = None
+        return items
+
+
+def unmarshall_value(data):
+    """Decode a value written by marshall_value"""
+    try:
+        return _Decoder(data).value(0)[0]
+    except IndexError:
+        raise Exception("Unexpected end of marshalled data")
+
+
+def _link_code_points(val, code, memo):
+    # Swap code points read from values for the matching entries of code
+    if isinstance(val, value.AVMCodePoint):
+        if (
+                0 <= val.pc < len(code) and
+                code[val.pc].next_hash == val.next_hash and
+                _op_code(code[val.pc].op) == _op_code(val.op)
+        ):
+            return code[val.pc]
+        return val
+    if not isinstance(val, value.Tuple):
+        return val
+    if id(val) not in memo:
+        items = [_link_code_points(item, code, memo) for item in val]
+        if any(new is not old for new, old in zip(items, val)):
+            memo[id(val)] = value.Tuple(items)
+        else:
+            memo[id(val)] = val
+    return memo[id(val)]
+
+
+def _decode_vm(data, extensions):
+    from .vm import VM
+
+    decoder = _Decoder(data)
+    version, offset = decoder.read_int(0, 4)
+    if version != AO_VERSION:
+        raise Exception("Can't unmarshall ao version {}".format(version))
+    while True:
+        extension_id, offset = decoder.read_int(offset, 4)
+        if not extension_id:
+            break
+        length, offset = decoder.read_int(offset, 4)
+        if offset + length > len(data):
+            raise IndexError()
+        if extension_id == DAG_EXTENSION_ID:
+            decoder.refs = []
+        if extensions is not None:
+            extensions.append(Extension(extension_id, bytes(data[offset:offset + length])))
+        offset += length
+
+    code_len, offset = decoder.read_int(offset, 8)
+    ops = []
+    for _ in range(code_len):
+        op, offset = decoder.op(offset)
+        ops.append(op)
+
+    code = [None] * code_len
+    immediate_hashes = value.value_hash_many(
+        [op.val for op in ops if isinstance(op, ImmediateOp)]
+    )
+    prev_hash = b''
+    for i in range(code_len - 1, -1, -1):
+        op = ops[i]
+        code[i] = value.AVMCodePoint(i, op, prev_hash)
+        if isinstance(op, ImmediateOp):
+            prev_hash = value.code_point_hash(
+                op.op.op_code,
+                prev_hash,
+                immediate_hashes.pop()
+            )
+        else:
+            prev_hash = value.code_point_hash(op.op_code, prev_hash)
+
+    memo = {}
+    for code_point in code:
+        if isinstance(code_point.op, ImmediateOp):
+            code_point.op.val = _link_code_points(
+                code_point.op.val,
+                code,
+                memo
+            )
+
+    if decoder.refs:
+        # Back-references from static to tuples of immediates
+        decoder.refs = [
+            memo.get(id(val), val) if isinstance(val, value.Tuple) else val
+            for val in decoder.refs
+        ]
+    decoder.code = code
+    vm = VM(code)
+    vm.static = decoder.value(offset, True)[0]
+    return vm
+
+
+def unmarshall_vm(source, extensions=None):
+    """Read a VM written by marshall_vm
+
+    source is a path, which is memory mapped, or a file object. The code
+    points are rebuilt with the same next_hash chain as
+    compiler.generate_code_pointers. Paths aren't marshalled, so they are
+    left empty. Large static subtrees are decoded on first access, so a
+    mapped file must not change while the VM is used. Extensions found in
+    the header are appended to extensions if it is given.
+    """
+    try:
+        if isinstance(source, (str, bytes, os.PathLike)):
+            with open(source, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = source.read()
+        return _decode_vm(data, extensions)
+    except IndexError:
+        raise Exception("Unexpected end of marshalled data")
+
+
+class CodeIndex:
+    """Random access to the ops of a file written by marshall_vm
+
+    source is a path, which is memory mapped, or a file object. With the
+    index extension in the header, op and immediate only decode the bytes of
+    the requested op. Files without it are scanned once when opened.
+    large_immediates lists (pc, marshalled size) of immediates with at least
+    LARGE_IMMEDIATE_SIZE bytes.
+    """
+    def __init__(self, source):
+        if isinstance(source, (str, bytes, os.PathLike)):
+            with open(source, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = source.read()
+        self.decoder = _Decoder(self.data)
+        try:
+            self._read_header()
+        except IndexError:
+            raise Exception("Unexpected end of marshalled data")
+
+    def _read_header(self):
+        decoder = self.decoder
+        version, offset = decoder.read_int(0, 4)
+        if version != AO_VERSION:
+            raise Exception("Can't unmarshall ao version {}".format(version))
+        index = None
+        while True:
+            extension_id, offset = decoder.read_int(offset, 4)
+            if not extension_id:
+                break
+            length, offset = decoder.read_int(offset, 4)
+            if offset + length > len(self.data):
+                raise IndexError()
+            if extension_id == DAG_EXTENSION_ID:
+                raise Exception("Can't index ops written with the DAG extension")
+            if extension_id == INDEX_EXTENSION_ID:
+                index = offset
+            offset += length
+        self.code_len, self.ops_offset = decoder.read_int(offset, 8)
+
+        self._offsets = None
+        self._index_offset = None
+        if index is None:
+            self._scan()
+            return
+        index_len, index = decoder.read_int(index, 8)
+        if index_len != self.code_len:
+            raise Exception("Index of {} ops for {} ops".format(index_len, self.code_len))
+        self._index_offset = index
+        count, offset = decoder.read_int(index + 4 * self.code_len, 4)
+        self.large_immediates = []
+        for _ in range(count):
+            pc, offset = decoder.read_int(offset, 4)
+            size, offset = decoder.read_int(offset, 4)
+            self.large_immediates.append((pc, size))
+
+    def _scan(self):
+        data = self.data
+        offset = self.ops_offset
+        self._offsets = []
+        self.large_immediates = []
+        for pc in range(self.code_len):
+            self._offsets.append(offset)
+            op_type = data[offset]
+            offset += 2
+            if op_type == 1:
+                end = self.decoder.skip(offset)
+                if end - offset >= LARGE_IMMEDIATE_SIZE:
+                    self.large_immediates.append((pc, end - offset))
+                offset = end
+            elif op_type != 0:
+                raise Exception("Tried to unmarshall bad operation type {}".format(op_type))
+
+    def __len__(self):
+        return self.code_len
+
+    def offset(self, pc):
+        """Byte offset of the op at pc in the file"""
+        if not 0 <= pc < self.code_len:
+            raise Exception("No op at pc {}".format(pc))
+        if self._offsets is not None:
+            return self._offsets[pc]
+        start = self._index_offset + 4 * pc
+        return self.ops_offset + self.decoder.read_int(start, 4)[0]
+
+    def op(self, pc):
+        """Decode the op at pc
+
+        Code points in its immediate value are not linked to the code, and
+        the op's own next_hash needs the rest of the program, so only the op
+        is returned.
+        """
+        return self.decoder.op(self.offset(pc))[0]
+
+    def immediate(self, pc):
+        """Decode the immediate value of the op at pc"""
+        offset = self.offset(pc)
+        if self.data[offset] != 1:
+            raise Exception("Op at pc {} has no immediate value".format(pc))
+        return self.decoder.value(offset + 2)[0]
@@ -0,0 +1,183 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .ast import ImmediateOp
+from .basic_vm import VMBudgetExceeded
+from .instructions import OPS, OP_CODES
+from . import value
+
+OP_COSTS = {
+    'add': 3,
+    'mul': 3,
+    'sub': 3,
+    'div': 4,
+    'sdiv': 7,
+    'mod': 4,
+    'smod': 7,
+    'addmod': 4,
+    'mulmod': 4,
+    'exp': 25,
+    'lt': 2,
+    'gt': 2,
+    'slt': 2,
+    'sgt': 2,
+    'eq': 2,
+    'iszero': 1,
+    'bitwise_and': 2,
+    'bitwise_or': 2,
+    'bitwise_xor': 2,
+    'bitwise_not': 1,
+    'byte': 4,
+    'signextend': 7,
+    'hash': 7,
+    'type': 3,
+    'pop': 1,
+    'spush': 1,
+    'rpush': 1,
+    'rset': 2,
+    'jump': 4,
+    'cjump': 4,
+    'stackempty': 2,
+    'pcpush': 1,
+    'auxpush': 1,
+    'auxpop': 1,
+    'auxstackempty': 2,
+    'nop': 1,
+    'errpush': 1,
+    'errset': 1,
+    'dup0': 1,
+    'dup1': 1,
+    'dup2': 1,
+    'swap1': 1,
+    'swap2': 1,
+    'tget': 2,
+    'tset': 40,
+    'tlen': 2,
+    'breakpoint': 100,
+    'log': 100,
+    'send': 100,
+    'nbsend': 100,
+    'gettime': 40,
+    'inbox': 40,
+    'error': 5,
+    'halt': 10,
+    'debug': 1
+}
+
+# Extra cost per unit of size. hash is charged per node of the hashed
+# value and tset per item of the tuple it copies.
+OP_SIZE_COSTS = {
+    'hash': 7,
+    'tset': 5
+}
+
+DEFAULT_COSTS = {
+    op_code: OP_COSTS[op_name]
+    for (op_name, op_code, pops, pushes) in OP_CODES
+}
+DEFAULT_SIZE_COSTS = {
+    OPS[op_name]: cost
+    for op_name, cost in OP_SIZE_COSTS.items()
+}
+
+
+class Meter:
+    """Counts the steps and cost of everything a VM runs
+
+    If max_steps or max_cost are set, running an instruction that would go
+    over them for the current message raises VMBudgetExceeded without
+    running it. The message budget is reset every time inbox receives new
+    messages, or by calling start_message.
+    """
+    def __init__(
+            self,
+            max_steps=None,
+            max_cost=None,
+            costs=DEFAULT_COSTS,
+            size_costs=DEFAULT_SIZE_COSTS
+    ):
+        self.max_steps = max_steps
+        self.max_cost = max_cost
+        self.costs = costs
+        self.size_costs = size_costs
+        self.total_steps = 0
+        self.total_cost = 0
+        self.messages = 0
+        self.message_steps = 0
+        self.message_cost = 0
+        self.last_cost = 0
+        self.exhausted = False
+
+    def fresh(self):
+        """Return a meter with the same limits and costs and nothing counted"""
+        return Meter(self.max_steps, self.max_cost, self.costs, self.size_costs)
+
+    def cost(self, vm, instr):
+        if isinstance(instr, ImmediateOp):
+            op_code = instr.op.op_code
+        elif isinstance(instr, int):
+            op_code = instr
+        else:
+            op_code = instr.op_code
+        cost = self.costs.get(op_code, 1)
+        if op_code not in self.size_costs:
+            return cost
+
+        # The immediate is pushed on top of the stack before the op runs
+        operands = [instr.val] if isinstance(instr, ImmediateOp) else []
+        stack = vm.stack
+        for i in range(min(len(stack), 2 - len(operands))):
+            operands.append(stack[i])
+        if op_code == OPS["hash"] and operands:
+            cost += self.size_costs[op_code] * value.node_count(operands[0])
+        elif (
+                op_code == OPS["tset"] and
+                len(operands) == 2 and
+                isinstance(operands[1], value.Tuple)
+        ):
+            cost += self.size_costs[op_code] * len(operands[1])
+        return cost
+
+    def charge(self, vm, instr):
+        cost = self.cost(vm, instr)
+        if (
+                (
+                    self.max_steps is not None and
+                    self.message_steps >= self.max_steps
+                ) or (
+                    self.max_cost is not None and
+                    self.message_cost + cost > self.max_cost
+                )
+        ):
+            self.exhausted = True
+            raise VMBudgetExceeded()
+        self.total_steps += 1
+        self.total_cost += cost
+        self.message_steps += 1
+        self.message_cost += cost
+        self.last_cost = cost
+
+    def refund(self):
+        # Instructions that block don't run, so they aren't charged
+        self.total_steps -= 1
+        self.total_cost -= self.last_cost
+        self.message_steps -= 1
+        self.message_cost -= self.last_cost
+        self.last_cost = 0
+
+    def start_message(self):
+        self.messages += 1
+        self.message_steps = 0
+        self.message_cost = 0
+        self.exhausted = False
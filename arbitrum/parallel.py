@@ -0,0 +1,114 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs message shards against compiled programs in a process pool.
+#
+# Programs are sent to each worker once, in the .ao format written by
+# marshall.marshall_vm, when the worker starts. Tasks only carry a program
+# index and the messages of a shard. Each worker unmarshalls a program the
+# first time it needs it and resets it from a checkpoint of its initial
+# state before every shard.
+
+import io
+import multiprocessing
+
+from . import marshall
+from .vm_runner import run_until, STOP_BLOCKED, STOP_ERROR, STOP_HALTED
+
+_programs = None
+_vms = {}
+
+
+class ShardResult:
+    def __init__(self, program, shard, steps, logs, sent_messages):
+        self.program = program
+        self.shard = shard
+        self.steps = steps
+        self.logs = logs
+        self.sent_messages = sent_messages
+
+    def __repr__(self):
+        return "ShardResult(program {}, shard {}, {} steps)".format(
+            self.program,
+            self.shard,
+            self.steps
+        )
+
+
+def marshall_program(vm):
+    data = io.BytesIO()
+    marshall.marshall_vm(vm, data)
+    return data.getvalue()
+
+
+def run_shard(vm, messages):
+    """Deliver messages to the VM and run it until it blocks
+
+    Returns the number of steps run. Raises if the VM stops for any other
+    reason than blocking or halting, like a breakpoint or running out of
+    its meter's budget, since the shard wasn't fully run.
+    """
+    for message in messages:
+        vm.env.send_message(message)
+    vm.env.deliver_pending()
+    result = run_until(vm)
+    if result.reason == STOP_ERROR:
+        raise result.error
+    if result.reason not in (STOP_BLOCKED, STOP_HALTED):
+        raise Exception("Shard stopped early ({}) at pc {}".format(
+            result.reason,
+            result.pc.pc
+        ))
+    return result.steps
+
+
+def _init_worker(programs):
+    global _programs
+    _programs = programs
+    _vms.clear()
+
+
+def _run_task(task):
+    shard, (program, messages) = task
+    if program not in _vms:
+        vm = marshall.unmarshall_vm(io.BytesIO(_programs[program]))
+        _vms[program] = (vm, vm.checkpoint())
+    vm, initial = _vms[program]
+    vm.restore(initial)
+    steps = run_shard(vm, messages)
+    return ShardResult(
+        program,
+        shard,
+        steps,
+        list(vm.logs),
+        list(vm.sent_messages)
+    )
+
+
+def run_shards(programs, shards, processes=None):
+    """Run shards of messages against programs using a process pool
+
+    programs is a list of freshly compiled VMs, for example from
+    evm.contract.create_evm_vm. shards is a list of (program index,
+    messages) pairs. Every shard starts from the initial state of its
+    program, so shards of the same program are independent. Returns a
+    ShardResult per shard in the order of shards.
+    """
+    data = [marshall_program(vm) for vm in programs]
+    with multiprocessing.Pool(
+            processes,
+            initializer=_init_worker,
+            initargs=(data,)
+    ) as pool:
+        return pool.map(_run_task, list(enumerate(shards)), chunksize=1)
@@ -0,0 +1,175 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Execution profiler for the VM.
+#
+# Profiling uses its own run loop, so run_vm, run_until and run_blocks pay
+# nothing for it. Only per code point counts and times are recorded while
+# running. Totals per opcode, per path prefix and per path frame are built
+# from those afterwards using the paths that compile_program stored on
+# every code point.
+
+from collections import Counter
+import time
+
+from .ast import CallStatement, ImmediateOp
+from .instructions import OP_NAMES
+from .vm_runner import run_vm_once
+from . import value
+
+
+def op_name(code_point):
+    instr = code_point.op
+    if isinstance(instr, ImmediateOp):
+        return OP_NAMES.get(instr.op.op_code, "unknown")
+    if isinstance(instr, int):
+        return OP_NAMES.get(instr, "unknown")
+    return OP_NAMES.get(instr.op_code, "unknown")
+
+
+def _frame(name):
+    # Collapsed stack lines use ';' between frames
+    return str(name).replace(";", ",")
+
+
+class Profiler:
+    """Execution counts and wall time for every code point run
+
+    counts and times are keyed by code point. Times are in seconds.
+    """
+    def __init__(self):
+        self.counts = Counter()
+        self.times = Counter()
+
+    def run(self, vm, max_steps=None):
+        """Run the VM like run_vm_once in a loop while recording a profile
+
+        Returns the number of steps run.
+        """
+        if vm.hash_consing:
+            with value.hash_consing():
+                return self._run(vm, max_steps)
+        return self._run(vm, max_steps)
+
+    def _run(self, vm, max_steps):
+        counts = self.counts
+        times = self.times
+        clock = time.perf_counter
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            pc = vm.pc
+            start = clock()
+            ran = run_vm_once(vm)
+            times[pc] += clock() - start
+            if not ran:
+                break
+            counts[pc] += 1
+            steps += 1
+        return steps
+
+    def _totals(self, key):
+        counts = Counter()
+        times = Counter()
+        for pc, elapsed in self.times.items():
+            for name in key(pc):
+                counts[name] += self.counts[pc]
+                times[name] += elapsed
+        return sorted(
+            ((name, counts[name], times[name]) for name in counts),
+            key=lambda row: row[2],
+            reverse=True
+        )
+
+    def by_opcode(self):
+        """Return (opcode name, count, time) rows, slowest first"""
+        return self._totals(lambda pc: [op_name(pc)])
+
+    def by_pc(self):
+        """Return (pc, count, time) rows, slowest first"""
+        return self._totals(lambda pc: [pc.pc])
+
+    def call_counts(self):
+        """Return the number of calls run to each function, by func_name
+
+        This is the profile taken by compile_program. Calls are counted at
+        the jump of their call site, so inlined calls aren't included.
+        """
+        calls = Counter()
+        for pc, count in self.counts.items():
+            path = pc.path
+            if (
+                    path and
+                    isinstance(path[-1], CallStatement) and
+                    op_name(pc) == "jump"
+            ):
+                calls[path[-1].func_name] += count
+        return calls
+
+    def by_path(self, depth=1):
+        """Return (path prefix, count, time) rows, slowest first
+
+        The prefix is the first depth entries of the compiler path.
+        """
+        return self._totals(
+            lambda pc: [tuple(str(frame) for frame in pc.path[:depth])]
+        )
+
+    def by_frame(self, prefix=""):
+        """Return inclusive (frame, count, time) rows, slowest first
+
+        Every path entry starting with prefix gets the cost of the code
+        points under it, for example prefix "EthOp(" for EVM opcodes or
+        "FuncDefinition(" for std functions.
+        """
+        def frames(pc):
+            names = {str(frame) for frame in pc.path}
+            return {name for name in names if name.startswith(prefix)}
+        return self._totals(frames)
+
+    def collapsed_stacks(self, weight="count"):
+        """Return the profile in the collapsed stack format of flamegraph.pl
+
+        Each line is the path of a code point and its opcode separated by
+        ';' followed by the count, or the time in microseconds if weight is
+        "time".
+        """
+        totals = Counter()
+        for pc, elapsed in self.times.items():
+            stack = ";".join(
+                [_frame(frame) for frame in pc.path] + [op_name(pc)]
+            )
+            if weight == "time":
+                totals[stack] += elapsed * 1000000
+            else:
+                totals[stack] += self.counts[pc]
+        return [
+            "{} {}".format(stack, int(round(total)))
+            for stack, total in sorted(totals.items())
+        ]
+
+    def write_collapsed_stacks(self, path, weight="count"):
+        with open(path, "w") as f:
+            for line in self.collapsed_stacks(weight):
+                f.write(line)
+                f.write("\n")
+
+    def print_summary(self, limit=10):
+        for title, rows in [
+                ("Opcodes", self.by_opcode()),
+                ("EVM opcodes", self.by_frame("EthOp(")),
+                ("Functions", self.by_frame("FuncDefinition("))
+        ]:
+            print(title)
+            for name, count, elapsed in rows[:limit]:
+                print("  {:>10} {:10.6f}s {}".format(count, elapsed, name))
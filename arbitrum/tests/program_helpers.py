@@ -0,0 +1,61 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Programs shared by the tests of the compiler and the engines that run it
+
+import arbitrum as arb
+from arbitrum import value, ast
+from arbitrum.compiler import compile_block
+
+
+def block(vm):
+    vm.push(value.Tuple([]))
+    vm.inbox()
+
+
+def jump_to_main(vm):
+    vm.jump_direct(ast.AVMLabel("main"))
+
+
+def compile_main(main, initialization=jump_to_main, **kwargs):
+    """Compile a program that runs main after initialization
+
+    initialization must end by jumping to the "main" label, which is set
+    right before main. kwargs are passed on to compile_program.
+    """
+    def labeled_main(vm):
+        vm.set_label(ast.AVMLabel("main"))
+        main(vm)
+
+    return arb.compile_program(
+        compile_block(initialization),
+        compile_block(labeled_main),
+        **kwargs
+    )
+
+
+def log_count(vm, count):
+    # Logs 0 to count - 1 and leaves count on the stack
+    vm.push(0)
+    vm.while_loop(
+        lambda vm: [vm.push(count), vm.dup1(), vm.lt()],
+        lambda vm: [vm.dup0(), vm.log(), vm.push(1), vm.add()]
+    )
+
+
+def run_once_until_block(vm):
+    steps = 0
+    while arb.run_vm_once(vm):
+        steps += 1
+    return steps
@@ -0,0 +1,100 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+
+from arbitrum.basic_vm import BasicVM, Stack
+from arbitrum import value
+
+
+class TestStack(TestCase):
+    def test_indexing(self):
+        stack = Stack()
+        for val in range(10):
+            stack.push(val)
+        self.assertEqual(stack[0], 9)
+        self.assertEqual(stack[-1], 0)
+        self.assertEqual(stack[1:3], [8, 7])
+        self.assertEqual(stack.items, list(range(9, -1, -1)))
+        self.assertEqual(stack.pop(), 9)
+        self.assertEqual(stack.peak(), 8)
+        self.assertEqual(len(stack), 9)
+
+    def test_set_items(self):
+        stack = Stack()
+        stack.items = [1, 2, 3]
+        self.assertEqual(stack[0], 1)
+        stack.push(0)
+        self.assertEqual(stack[:], [0, 1, 2, 3])
+
+    def test_replace_top(self):
+        stack = Stack([1, 2, 3])
+        self.assertEqual(stack.top(2), [1, 2])
+        self.assertEqual(stack.top(0), [])
+        with self.assertRaises(IndexError):
+            stack.top(4)
+        stack.replace_top(2, [5, 6, 7])
+        self.assertEqual(stack[:], [5, 6, 7, 3])
+
+
+class TestTypeStack(TestCase):
+    def test_indexing(self):
+        stack = value.TypeStack()
+        stack.push(value.IntType())
+        stack.push(value.TupleType())
+        self.assertIsInstance(stack[0], value.TupleType)
+        self.assertIsInstance(stack[1], value.IntType)
+        clone = stack.clone()
+        self.assertIsInstance(stack.pop(value.TupleType()), value.TupleType)
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(len(clone), 2)
+
+
+class TestCheckpoint(TestCase):
+    def test_restore(self):
+        vm = BasicVM()
+        vm.push(1)
+        vm.push(value.Tuple([2, 3]))
+        vm.auxpush()
+        vm.push(4)
+        vm.log()
+        checkpoint = vm.checkpoint()
+
+        vm.push(5)
+        vm.log()
+        vm.pop()
+        vm.auxpop()
+        vm.register = value.Tuple([6])
+        vm.env.send_message([7])
+        vm.restore(checkpoint)
+
+        self.assertEqual(vm.stack[:], [1])
+        self.assertEqual(vm.aux_stack[:], [value.Tuple([2, 3])])
+        self.assertEqual(vm.logs, [4])
+        self.assertEqual(vm.register, value.Tuple([]))
+        self.assertEqual(vm.env.pending_messages, value.Tuple([]))
+
+        # A checkpoint can be restored more than once
+        vm.pop()
+        vm.restore(checkpoint)
+        self.assertEqual(vm.stack[:], [1])
+
+    def test_drained_logs(self):
+        vm = BasicVM()
+        vm.push(1)
+        vm.log()
+        checkpoint = vm.checkpoint()
+        vm.logs = []
+        vm.restore(checkpoint)
+        self.assertEqual(vm.logs, [1])
@@ -0,0 +1,356 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import io
+import pickle
+from unittest import TestCase, mock
+
+from arbitrum import value, ast, marshall, compiler, instructions
+from arbitrum.annotation import modifies_stack
+from arbitrum.profiler import Profiler
+
+from program_helpers import block, compile_main, jump_to_main
+
+
+def make_vm(init_value, previous=None):
+    def initialization(vm):
+        vm.push(init_value)
+        vm.pop()
+        jump_to_main(vm)
+
+    def main(vm):
+        vm.push(value.Tuple([1, 2, 3]))
+        vm.while_loop(
+            lambda vm: [vm.dup0(), vm.tlen(), vm.push(0), vm.lt()],
+            lambda vm: [vm.push(0), vm.swap1(), vm.tset()]
+        )
+        vm.log()
+        block(vm)
+
+    return compile_main(main, initialization, previous=previous)
+
+
+def marshalled(vm):
+    data = io.BytesIO()
+    marshall.marshall_vm(vm, data)
+    return data.getvalue()
+
+
+class TestIncrementalCodePoints(TestCase):
+    def test_reuse(self):
+        previous = make_vm(1)
+        fresh = make_vm(value.Tuple([4, 5]))
+        with mock.patch.object(
+                value,
+                "code_point_hash",
+                wraps=value.code_point_hash
+        ) as code_point_hash:
+            updated = make_vm(value.Tuple([4, 5]), previous)
+        # Only the changed start of the program is hashed again
+        self.assertLess(code_point_hash.call_count, len(fresh.code) // 2)
+        self.assertEqual(
+            [value.value_hash(code_point) for code_point in updated.code],
+            [value.value_hash(code_point) for code_point in fresh.code]
+        )
+        self.assertEqual(
+            [code_point.pc for code_point in updated.code],
+            list(range(len(fresh.code)))
+        )
+        self.assertEqual(marshalled(updated), marshalled(fresh))
+
+    def test_unchanged(self):
+        previous = make_vm(1)
+        updated = make_vm(1, previous)
+        self.assertEqual(marshalled(updated), marshalled(previous))
+
+
+def op_names(code):
+    return [
+        instructions.OP_NAMES[op.get_op()] if hasattr(op, "get_op") else op
+        for op in code
+    ]
+
+
+class TestRewriteCode(TestCase):
+    def test_backtrack(self):
+        code = [ast.BasicOp(instructions.OPS[name]) for name in [
+            "add", "swap1", "swap2", "swap2", "swap1", "pop"
+        ]]
+        new_code = compiler.rewrite_code(code, [compiler.PeepholeRule(
+            compiler.remove_nop_swaps,
+            2
+        )])
+        self.assertEqual(op_names(new_code), ["add", "pop"])
+        self.assertEqual(len(code), 6)
+
+    def test_positions(self):
+        positions = []
+
+        def drop_labels(ops, i):
+            if isinstance(ops[0], str):
+                positions.append((ops[0], i))
+                return []
+            return None
+
+        code = [
+            "start",
+            ast.BasicOp(instructions.OPS["add"]),
+            ast.BasicOp(instructions.OPS["swap1"]),
+            "middle",
+            ast.BasicOp(instructions.OPS["swap1"]),
+            "end"
+        ]
+        code = compiler.rewrite_code(code, [compiler.PeepholeRule(
+            compiler.remove_nop_swaps,
+            2
+        )])
+        code = compiler.rewrite_code(code, [compiler.PeepholeRule(drop_labels)])
+        self.assertEqual(op_names(code), ["add", "swap1", "swap1"])
+        self.assertEqual(positions, [("start", 0), ("middle", 2), ("end", 3)])
+
+    def test_registered(self):
+        self.assertEqual(
+            [rule.rewrite for rule in compiler.PEEPHOLE_RULES],
+            [compiler.remove_nop_swaps, compiler.compress_pushes]
+        )
+        code = [
+            ast.ImmediateOp(ast.BasicOp(instructions.OPS["nop"]), 5),
+            ast.BasicOp(instructions.OPS["add"]),
+        ]
+        new_code = compiler.rewrite_code(code, compiler.PEEPHOLE_RULES)
+        self.assertEqual(len(new_code), 1)
+        self.assertEqual(new_code[0].get_op(), instructions.OPS["add"])
+        self.assertEqual(new_code[0].val, 5)
+
+
+class TestFlattenBlock(TestCase):
+    def test_paths(self):
+        add = ast.BasicOp(instructions.OPS["add"])
+        pop = ast.BasicOp(instructions.OPS["pop"], ["own"])
+        swap = ast.BasicOp(instructions.OPS["swap1"])
+        block = ast.BlockStatement([
+            ast.BlockStatement([add, pop], ["inner"]),
+            swap
+        ], ["outer"])
+        code = compiler.flatten_block(block)
+        self.assertEqual(code, [add, pop, swap])
+        self.assertEqual(list(add.path), ["outer", "inner"])
+        self.assertEqual(list(pop.path), ["outer", "inner", "own"])
+        self.assertEqual(pop.path[-1], "own")
+        self.assertEqual(len(pop.path), 3)
+        self.assertEqual(repr(swap.path), repr(["outer"]))
+        self.assertIs(pop.path.parent, add.path)
+        self.assertIs(add.path.parent, swap.path)
+        copy = pickle.loads(pickle.dumps(pop.path))
+        self.assertEqual(list(copy), ["outer", "inner", "own"])
+
+    def test_deep(self):
+        block = ast.BasicOp(instructions.OPS["add"])
+        for i in range(5000):
+            block = ast.BlockStatement([block], [i])
+        code = compiler.flatten_block(block)
+        self.assertEqual(len(code), 1)
+        self.assertEqual(list(code[0].path), list(range(4999, -1, -1)))
+
+
+def make_call_graph(calls):
+    graph = compiler.CallGraph({})
+    for caller, callee in calls:
+        graph.add_call(caller, callee)
+    return graph
+
+
+class TestCallGraph(TestCase):
+    def test_recursive(self):
+        graph = make_call_graph([
+            ("main", "a"), ("a", "b"), ("b", "a"), ("b", "c"),
+            ("c", "c"), ("main", "d"), ("d", "e")
+        ])
+        self.assertEqual(graph.recursive(), {"a", "b", "c"})
+        self.assertEqual(
+            sorted(graph.strongly_connected_components()),
+            [["a", "b"], ["c"], ["d"], ["e"], ["main"]]
+        )
+        self.assertEqual(graph.topological_order(), ["a", "b", "c", "main", "d", "e"])
+
+    def test_many_cycles(self):
+        # Every pair of the helpers calls each other, which has too many
+        # elementary cycles to list
+        names = ["helper{}".format(i) for i in range(30)]
+        graph = make_call_graph([
+            (caller, callee) for caller in names for callee in names
+            if caller != callee
+        ] + [("main", "helper0"), ("main", "leaf")])
+        self.assertEqual(graph.recursive(), set(names))
+        self.assertEqual(graph.topological_order(), sorted(names) + ["main", "leaf"])
+
+    def test_inline(self):
+        graph = make_call_graph([
+            ("main", "a"), ("main", "a"), ("a", "b"), ("a", "c"),
+            ("b", "c"), ("x", "y")
+        ])
+        self.assertEqual(graph.call_count("a"), 2)
+        self.assertEqual(graph.call_count("c"), 2)
+        graph.inline("a")
+        self.assertEqual(graph.call_count("c"), 3)
+        self.assertEqual(graph.calls["main"], {"b": 2, "c": 2})
+        self.assertEqual(graph.callers["b"], {"main"})
+        graph.inline("y")
+        self.assertEqual(graph.nodes(), ["b", "c", "main"])
+        self.assertEqual(graph.topological_order(), ["main", "b", "c"])
+
+
+@modifies_stack([value.IntType()], [value.IntType()])
+def add_many(vm):
+    # Too long for the fixed inlining heuristics
+    for _ in range(100):
+        vm.push(1)
+        vm.add()
+
+
+@modifies_stack([value.IntType()], [value.IntType()])
+def sub_many(vm):
+    for _ in range(100):
+        vm.push(1)
+        vm.swap1()
+        vm.sub()
+
+
+@modifies_stack([value.IntType()], [value.IntType()])
+def mul_many(vm):
+    for _ in range(100):
+        vm.push(1)
+        vm.mul()
+
+
+def make_loop_vm(profile=None, inline_budget=compiler.INLINE_BUDGET):
+    def main(vm):
+        # Not known at compile time, so the calls don't fold away once
+        # inlined
+        vm.stackempty()
+        add_many(vm)
+        sub_many(vm)
+        sub_many(vm)
+        mul_many(vm)
+        mul_many(vm)
+        vm.log()
+        vm.push(0)
+        vm.while_loop(
+            lambda vm: [vm.dup0(), vm.push(10), vm.gt()],
+            lambda vm: [
+                vm.dup0(), add_many(vm), vm.pop(),
+                vm.push(1), vm.add()
+            ]
+        )
+        vm.log()
+        block(vm)
+
+    return compile_main(main, profile=profile, inline_budget=inline_budget)
+
+
+def run_profiled(vm):
+    profiler = Profiler()
+    profiler.run(vm)
+    return profiler
+
+
+class TestProfileGuidedInlining(TestCase):
+    name = "{}.add_many".format(__name__)
+
+    def test_inline(self):
+        vm = make_loop_vm()
+        self.assertEqual(vm.inline_report, [])
+        profiler = run_profiled(vm)
+        profile = profiler.call_counts()
+        others = {
+            "{}.sub_many".format(__name__): 2,
+            "{}.mul_many".format(__name__): 2
+        }
+        self.assertEqual(profile, dict(others, **{self.name: 11}))
+        steps = sum(profiler.counts.values())
+
+        vm2 = make_loop_vm({self.name: 11})
+        self.assertEqual(len(vm2.inline_report), 1)
+        name, sites, calls, added, saved = vm2.inline_report[0]
+        self.assertEqual((name, sites, calls), (self.name, 2, 11))
+        self.assertEqual(saved, 11 * compiler.CALL_DISPATCH_STEPS)
+        profiler2 = run_profiled(vm2)
+        self.assertEqual(profiler2.call_counts(), others)
+        self.assertEqual(vm2.logs, vm.logs)
+        self.assertEqual(sum(profiler2.counts.values()), steps - saved)
+
+    def test_budget(self):
+        profile = {self.name: 11}
+        vm = make_loop_vm(profile, inline_budget=10)
+        self.assertEqual(vm.inline_report, [])
+        self.assertEqual(len(vm.code), len(make_loop_vm().code))
+
+
+def push_op(val):
+    return ast.ImmediateOp(ast.BasicOp(instructions.OPS["nop"]), val)
+
+
+def basic_ops(*op_names):
+    return [ast.BasicOp(instructions.OPS[op_name]) for op_name in op_names]
+
+
+class TestConstantFolding(TestCase):
+    def test_chain(self):
+        # (2 + 3) - 4 with the operands swapped, then a tuple get
+        code = [push_op(2), push_op(3)] + basic_ops("add") + \
+            [push_op(4)] + basic_ops("swap1", "sub") + [
+                push_op(value.Tuple([7, 8])),
+                ast.ImmediateOp(ast.BasicOp(instructions.OPS["tget"]), 1),
+                push_op(9)
+            ] + basic_ops("pop", "dup0", "add")
+        new_code = compiler.fold_constants(code)
+        self.assertEqual(op_names(new_code), ["nop", "nop"])
+        self.assertEqual([op.val for op in new_code], [1, 16])
+
+    def test_errors(self):
+        code = [push_op(0), push_op(1)] + basic_ops("div") + \
+            [push_op(value.Tuple([]))] + basic_ops("tlen", "add")
+        new_code = compiler.fold_constants(code)
+        self.assertEqual(op_names(new_code), ["nop", "nop", "div", "nop", "add"])
+        label = ast.AVMLabel("target")
+        code = [ast.ImmediateOp(ast.BasicOp(instructions.OPS["nop"]), label)] + \
+            basic_ops("pop")
+        self.assertEqual(compiler.fold_constants(code), code)
+
+    def test_tuple_operands(self):
+        code = [push_op(2), push_op(value.Tuple([1]))] + basic_ops("div")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            new_code = compiler.fold_constants(code)
+        self.assertEqual(new_code, code)
+        self.assertEqual(output.getvalue(), "")
+
+    def test_unreachable(self):
+        label = ast.AVMLabel("target")
+        code = basic_ops("add", "jump", "pop", "swap1") + [label] + \
+            basic_ops("pop", "halt", "add")
+        new_code = compiler.remove_unreachable(code)
+        self.assertEqual(op_names(new_code), ["add", "jump", label, "pop", "halt"])
+
+    def test_report(self):
+        add, pop, swap = basic_ops("add", "pop", "swap1")
+        add.path = ["a"]
+        pop.path = ["b", "inner"]
+        swap.path = ["b"]
+        report = compiler.reduction_report(
+            [add, pop, swap, ast.AVMLabel("end")],
+            [add, ast.AVMLabel("end")]
+        )
+        self.assertEqual(report, [("b", 2, 0), ("a", 1, 1)])
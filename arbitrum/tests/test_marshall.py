@@ -0,0 +1,250 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+import arbitrum as arb
+from arbitrum import value, ast, marshall
+from arbitrum.annotation import noreturn
+
+from program_helpers import block, compile_main, log_count
+
+
+@noreturn
+def first_handler(vm):
+    vm.push(1)
+    vm.log()
+    block(vm)
+
+
+@noreturn
+def second_handler(vm):
+    vm.push(2)
+    vm.log()
+    block(vm)
+
+
+def make_vm():
+    def main(vm):
+        vm.set_exception_handler(first_handler)
+        log_count(vm, 3)
+        vm.set_exception_handler(second_handler)
+        vm.error()
+
+    return compile_main(main)
+
+
+def marshall_vm(vm):
+    data = io.BytesIO()
+    marshall.marshall_vm(vm, data)
+    return data.getvalue()
+
+
+def marshall_op(op):
+    data = io.BytesIO()
+    marshall.marshall_op(op, data)
+    return data.getvalue()
+
+
+def marshall_value(val):
+    data = io.BytesIO()
+    marshall.marshall_value(val, data)
+    return data.getvalue()
+
+
+class TestUnmarshall(TestCase):
+    def test_round_trip(self):
+        vm = make_vm()
+        data = marshall_vm(vm)
+        vm2 = marshall.unmarshall_vm(io.BytesIO(data))
+        self.assertEqual(len(vm2.code), len(vm.code))
+        self.assertEqual(
+            value.value_hash(vm2.code[0]),
+            value.value_hash(vm.code[0])
+        )
+        self.assertEqual(marshall_vm(vm2), data)
+
+    def test_code_points_linked(self):
+        vm = marshall.unmarshall_vm(io.BytesIO(marshall_vm(make_vm())))
+        handler = vm.static[0]
+        self.assertIs(handler, vm.code[handler.pc])
+
+    def test_run(self):
+        vm = make_vm()
+        while arb.run_vm_once(vm):
+            pass
+        vm2 = marshall.unmarshall_vm(io.BytesIO(marshall_vm(make_vm())))
+        while arb.run_vm_once(vm2):
+            pass
+        self.assertEqual(vm2.logs, [0, 1, 2, 2])
+        self.assertEqual(vm2.logs, vm.logs)
+
+    def test_truncated(self):
+        data = marshall_vm(make_vm())
+        with self.assertRaises(Exception):
+            marshall.unmarshall_vm(io.BytesIO(data[:-1]))
+
+    def test_path(self):
+        vm = make_vm()
+        big = value.Tuple([
+            value.Tuple([i * 8 + j for j in range(8)])
+            for i in range(8)
+        ])
+        vm.static = value.Tuple([vm.static, value.Tuple([big, big]), 5])
+        data = marshall_vm(vm)
+        extensions = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "program.ao")
+            with open(path, "wb") as f:
+                marshall.marshall_vm(vm, f, [marshall.Extension(7, b"abc")])
+            vm2 = marshall.unmarshall_vm(path, extensions)
+        self.assertEqual([(ext.id, ext.data) for ext in extensions], [(7, b"abc")])
+        self.assertIs(vm2.static[0][0], vm2.code[vm2.static[0][0].pc])
+        self.assertEqual(vm2.static[1], vm.static[1])
+        self.assertEqual(value.value_hash(vm2.static[1]), value.value_hash(vm.static[1]))
+        self.assertEqual(marshall_vm(vm2), data)
+
+    def test_lazy_static(self):
+        vm = make_vm()
+        big = value.Tuple([
+            value.Tuple([i * 8 + j for j in range(8)])
+            for i in range(8)
+        ])
+        vm.static = value.Tuple([vm.static, big, big])
+        old_size = marshall.LAZY_SIZE
+        marshall.LAZY_SIZE = 1000
+        try:
+            vm2 = marshall.unmarshall_vm(io.BytesIO(marshall_vm(vm)))
+        finally:
+            marshall.LAZY_SIZE = old_size
+        self.assertIsNone(value.Tuple.val.__get__(vm2.static))
+        self.assertEqual(vm2.static[2], big)
+        self.assertIs(vm2.static[0][0], vm2.code[vm2.static[0][0].pc])
+        self.assertEqual(marshall_vm(vm2), marshall_vm(vm))
+
+
+class TestMarshall(TestCase):
+    def test_next_hash_unchanged(self):
+        vm = make_vm()
+        last = vm.code[-1]
+        self.assertEqual(last.next_hash, b'')
+        data = marshall_vm(vm)
+        self.assertEqual(last.next_hash, b'')
+        self.assertEqual(marshall_vm(vm), data)
+
+    def test_deep_nesting(self):
+        val = 5
+        for _ in range(5000):
+            val = value.Tuple([val])
+        data = io.BytesIO()
+        marshall.marshall_value(val, data)
+        expected = bytes([marshall.TUPLE_TYPE_CODE + 1]) * 5000
+        expected += bytes([marshall.INT_TYPE_CODE]) + (5).to_bytes(32, byteorder='big')
+        self.assertEqual(data.getvalue(), expected)
+        data = io.BytesIO()
+        marshall.marshall_value(marshall.unmarshall_value(expected), data)
+        self.assertEqual(data.getvalue(), expected)
+
+    def test_small_buffer(self):
+        vm = make_vm()
+        data = io.BytesIO()
+        marshaller = marshall.Marshaller(data, flush_size=16)
+        marshaller.value(vm.static)
+        marshaller.flush()
+        expected = io.BytesIO()
+        marshall.marshall_value(vm.static, expected)
+        self.assertEqual(data.getvalue(), expected.getvalue())
+
+    def test_dag(self):
+        vm = make_vm()
+        big = value.Tuple([
+            value.Tuple([i * 8 + j for j in range(8)])
+            for i in range(8)
+        ])
+        vm.static = value.Tuple([vm.static, big, value.Tuple([big, 5]), 5])
+        plain = marshall_vm(vm)
+        data = io.BytesIO()
+        marshall.marshall_vm(vm, data, [marshall.dag_extension()])
+        self.assertLess(len(data.getvalue()), len(plain) - 64 * 33)
+        vm2 = marshall.unmarshall_vm(io.BytesIO(data.getvalue()))
+        self.assertIs(vm2.static[2][0], vm2.static[1])
+        self.assertIs(vm2.static[0][0], vm2.code[vm2.static[0][0].pc])
+        self.assertEqual(marshall_vm(vm2), plain)
+
+
+class TestCodeIndex(TestCase):
+    def make_vm(self):
+        vm = make_vm()
+        big = value.Tuple([
+            value.Tuple([i * 8 + j for j in range(8)])
+            for i in range(8)
+        ])
+        vm.code[0].op = ast.ImmediateOp(vm.code[0].op.op, big)
+        return vm, big
+
+    def check_index(self, vm, index):
+        self.assertEqual(len(index), len(vm.code))
+        for code_point in vm.code:
+            op = index.op(code_point.pc)
+            self.assertEqual(marshall_op(op), marshall_op(code_point.op))
+        for pc, size in index.large_immediates:
+            self.assertEqual(
+                marshall_value(index.immediate(pc)),
+                marshall_value(vm.code[pc].op.val)
+            )
+
+    def test_index(self):
+        vm, big = self.make_vm()
+        data = io.BytesIO()
+        marshall.marshall_vm(vm, data, [marshall.index_extension(vm)])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "program.ao")
+            with open(path, "wb") as f:
+                f.write(data.getvalue())
+            index = marshall.CodeIndex(path)
+            self.assertIsNone(index._offsets)
+            self.check_index(vm, index)
+            self.assertEqual(index.immediate(0), big)
+            self.assertEqual(
+                index.large_immediates,
+                [(0, len(marshall_value(big)))]
+            )
+            index.data.close()
+
+    def test_without_extension(self):
+        vm, big = self.make_vm()
+        index = marshall.CodeIndex(io.BytesIO(marshall_vm(vm)))
+        self.check_index(vm, index)
+        self.assertEqual(index.large_immediates, [(0, len(marshall_value(big)))])
+        with self.assertRaises(Exception):
+            index.op(len(vm.code))
+
+    def test_readable_without_index(self):
+        vm, _ = self.make_vm()
+        data = io.BytesIO()
+        marshall.marshall_vm(vm, data, [marshall.index_extension(vm)])
+        vm2 = marshall.unmarshall_vm(io.BytesIO(data.getvalue()))
+        self.assertEqual(marshall_vm(vm2), marshall_vm(vm))
+
+    def test_no_dag(self):
+        vm, _ = self.make_vm()
+        with self.assertRaises(Exception):
+            marshall.marshall_vm(
+                vm,
+                io.BytesIO(),
+                [marshall.dag_extension(), marshall.index_extension(vm)]
+            )
@@ -0,0 +1,66 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+
+from arbitrum import value
+from arbitrum.metering import Meter
+from arbitrum.parallel import run_shard, run_shards
+
+from program_helpers import compile_main
+
+
+def make_vm(tag):
+    # Logs tag and the messages it received every time it is woken up
+    def main(vm):
+        vm.push(value.Tuple([]))
+        vm.while_loop(
+            lambda vm: vm.push(1),
+            lambda vm: [
+                vm.inbox(),
+                vm.dup0(),
+                vm.push(tag),
+                vm.log(),
+                vm.log()
+            ]
+        )
+
+    return compile_main(main)
+
+
+class TestRunShards(TestCase):
+    def test_matches_sequential(self):
+        programs = [make_vm(10), make_vm(20)]
+        shards = [
+            (program, [[value.Tuple([shard, i]), 1234, 0, 0] for i in range(3)])
+            for shard, program in enumerate([0, 1, 1, 0, 1])
+        ]
+        results = run_shards(programs, shards, processes=2)
+
+        self.assertEqual([result.shard for result in results], list(range(5)))
+        for result, (program, messages) in zip(results, shards):
+            vm = [make_vm(10), make_vm(20)][program]
+            steps = run_shard(vm, messages)
+            self.assertEqual(result.program, program)
+            self.assertEqual(result.steps, steps)
+            self.assertEqual(result.logs, vm.logs)
+            self.assertEqual(result.logs[0], [10, 20][program])
+            self.assertEqual(result.sent_messages, vm.sent_messages)
+
+    def test_stopped_early(self):
+        vm = make_vm(10)
+        vm.meter = Meter(max_steps=5)
+        with self.assertRaises(Exception) as context:
+            run_shard(vm, [[value.Tuple([0, 0]), 1234, 0, 0]])
+        self.assertIn("budget", str(context.exception))
@@ -0,0 +1,65 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+
+from arbitrum.profiler import Profiler
+
+from program_helpers import block, compile_main, log_count, run_once_until_block
+
+
+def make_vm():
+    def main(vm):
+        log_count(vm, 5)
+        block(vm)
+
+    return compile_main(main)
+
+
+class TestProfiler(TestCase):
+    def test_counts(self):
+        vm = make_vm()
+        steps = run_once_until_block(vm)
+
+        vm2 = make_vm()
+        profiler = Profiler()
+        self.assertEqual(profiler.run(vm2), steps)
+        self.assertEqual(vm2.logs, vm.logs)
+        self.assertEqual(sum(profiler.counts.values()), steps)
+
+        ops = {name: count for name, count, _ in profiler.by_opcode()}
+        self.assertEqual(ops["log"], 5)
+        self.assertEqual(sum(ops.values()), steps)
+        pcs = {pc: count for pc, count, _ in profiler.by_pc()}
+        self.assertEqual(sum(pcs.values()), steps)
+
+        body = {
+            frame: count
+            for frame, count, _ in profiler.by_frame("WhileStatementBody")
+        }
+        self.assertEqual(body["WhileStatementBody"], 5 * 3)
+
+    def test_collapsed_stacks(self):
+        vm = make_vm()
+        profiler = Profiler()
+        steps = profiler.run(vm)
+        lines = profiler.collapsed_stacks()
+        self.assertEqual(
+            sum(int(line.rsplit(" ", 1)[1]) for line in lines),
+            steps
+        )
+        self.assertIn(
+            "WhileStatement;WhileStatementBody;log 5",
+            lines
+        )
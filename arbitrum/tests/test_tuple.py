@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from unittest import TestCase
+import pickle
+from unittest import TestCase, mock
+
+import eth_utils
+from eth_abi.packed import encode_single_packed
 
 from arbitrum.std import tup
-from arbitrum import VM
+from arbitrum import VM, value, ast
 
 
 class TestTuple(TestCase):
@@ -37,3 +41,136 @@ class TestTuple(TestCase):
                 tup.pack(i)(vm)
                 tup.unpack(i)(vm)
                 self.assertEqual(vm.stack[:], data[:])
+
+
+class TestTupleValue(TestCase):
+    def test_empty_singleton(self):
+        self.assertIs(value.Tuple([]), value.Tuple())
+        self.assertIs(value.Tuple.from_items(()), value.EMPTY_TUPLE)
+        self.assertIs(pickle.loads(pickle.dumps(value.Tuple([]))), value.EMPTY_TUPLE)
+
+    def test_checks(self):
+        with self.assertRaises(Exception):
+            value.Tuple((1, 2))
+        with self.assertRaises(Exception):
+            value.Tuple(list(range(9)))
+
+    def test_pickle(self):
+        tup = value.Tuple([1, value.Tuple([2, value.Tuple([])])])
+        copy = pickle.loads(pickle.dumps(tup))
+        self.assertEqual(copy, tup)
+        self.assertIs(copy[1][1], value.EMPTY_TUPLE)
+        self.assertFalse(hasattr(copy, "__dict__"))
+
+
+class TestHashConsing(TestCase):
+    def test_shared(self):
+        with value.hash_consing():
+            a = value.Tuple([1, value.Tuple([2, 3])])
+            b = value.Tuple([1, value.Tuple([2, 3])])
+            self.assertIs(a, b)
+            self.assertIs(a.set_tup_val(0, 4).set_tup_val(0, 1), a)
+            self.assertIsNot(value.Tuple([1, value.Tuple([2, 4])]), a)
+        self.assertIsNot(value.Tuple([1]), value.Tuple([1]))
+
+    def test_existing_values(self):
+        old = value.Tuple([value.Tuple([5]), 6])
+        with value.hash_consing():
+            new = value.Tuple([value.Tuple([5]), 6])
+            self.assertIs(value.intern_value(old), new)
+            self.assertIs(value.Tuple([old[0]])[0], new[0])
+        self.assertIs(value.intern_value(old), old)
+
+    def test_kept_between_runs(self):
+        with value.hash_consing():
+            state = value.Tuple([])
+            for i in range(100):
+                state = value.Tuple([state, i])
+        with value.hash_consing():
+            self.assertIs(value.Tuple([state[0], 99]), state)
+            with mock.patch.object(
+                    value,
+                    "_intern_items",
+                    wraps=value._intern_items
+            ) as intern_items:
+                updated = state.set_tup_val(1, 100)
+            # The rest of the state is still canonical and isn't
+            # interned again
+            self.assertEqual(intern_items.call_count, 1)
+            self.assertIs(updated[0], state[0])
+
+
+class TestValueHash(TestCase):
+    def test_cached_hash(self):
+        def build(depth, leaf):
+            if depth == 0:
+                return leaf
+            return value.Tuple([build(depth - 1, leaf), depth])
+
+        tree = build(5, 1)
+        old_hash = value.value_hash(tree)
+        self.assertEqual(tree.merkle_hash, old_hash)
+        updated = tree.set_tup_val(1, 7)
+        self.assertIsNone(updated.merkle_hash)
+        self.assertEqual(
+            value.value_hash(updated),
+            value.value_hash(value.Tuple([build(4, 1), 7]))
+        )
+        self.assertEqual(value.value_hash(tree), old_hash)
+
+    def test_packed_encoding(self):
+        tup = value.Tuple([3, value.Tuple([]), 2**256 - 1])
+        self.assertEqual(
+            value.value_hash(tup),
+            eth_utils.keccak(encode_single_packed(
+                '(uint8,bytes32,bytes32,bytes32)',
+                [
+                    value.TUPLE_TYPE_CODE + 3,
+                    eth_utils.keccak(encode_single_packed('(uint256)', [3])),
+                    eth_utils.keccak(encode_single_packed('(uint8)', [value.TUPLE_TYPE_CODE])),
+                    eth_utils.keccak(encode_single_packed('(uint256)', [2**256 - 1]))
+                ]
+            ))
+        )
+        code_point = value.AVMCodePoint(
+            0,
+            ast.ImmediateOp(ast.BasicOp(8), tup),
+            b'\x01\x02'
+        )
+        self.assertEqual(
+            value.value_hash(code_point),
+            eth_utils.keccak(encode_single_packed(
+                '(uint8,uint8,bytes32,bytes32)',
+                [value.CODE_POINT_CODE, 8, value.value_hash(tup), b'\x01\x02']
+            ))
+        )
+
+    def test_hash_many(self):
+        vals = [1, value.Tuple([1, 2]), 1, value.Tuple([])]
+        self.assertEqual(
+            value.value_hash_many(vals),
+            [value.value_hash(val) for val in vals]
+        )
+
+
+class TestValueSize(TestCase):
+    def test_marshalled_size(self):
+        tup = value.Tuple([3, value.Tuple([]), value.Tuple([1, 2])])
+        self.assertEqual(value.value_sizes(tup), (6, 1 + 33 + 1 + 1 + 33 * 2))
+        self.assertEqual(value.value_size(5), 33)
+
+    def test_cached(self):
+        shared = value.Tuple([value.Tuple([i, i]) for i in range(8)])
+        tree = value.Tuple([shared, shared])
+        self.assertEqual(value.node_count(tree), 1 + 2 * (1 + 8 * 3))
+        self.assertEqual(shared.node_count, 25)
+        updated = tree.set_tup_val(1, 7)
+        self.assertIsNone(updated.node_count)
+        self.assertEqual(value.node_count(updated), 1 + 25 + 1)
+        self.assertEqual(value.value_size(updated), 1 + shared.byte_size + 33)
+
+    def test_deep(self):
+        val = 5
+        for _ in range(5000):
+            val = value.Tuple([val])
+        self.assertEqual(value.value_sizes(val), (5001, 5000 + 33))
@@ -0,0 +1,487 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+from collections import deque
+import io
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import arbitrum as arb
+from arbitrum import value, ast
+from arbitrum.annotation import noreturn
+from arbitrum.basic_vm import Stack
+from arbitrum.block_compiler import compile_blocks
+from arbitrum.instructions import OPS
+from arbitrum.metering import Meter
+from arbitrum.compiler import compile_block
+from arbitrum.profiler import Profiler
+from arbitrum.vm_runner import (
+    STOP_BLOCKED, STOP_BUDGET, STOP_ERROR, STOP_STEP_BUDGET, run_until
+)
+
+from program_helpers import block, compile_main, log_count, run_once_until_block
+
+
+@noreturn
+def unused_handler(vm):
+    vm.push(66)
+    vm.log()
+    block(vm)
+
+
+@noreturn
+def div_handler(vm):
+    vm.push(77)
+    vm.log()
+    block(vm)
+
+
+def make_vm(loop_count=20):
+    def main(vm):
+        vm.set_exception_handler(unused_handler)
+        log_count(vm, loop_count)
+        vm.set_exception_handler(div_handler)
+        vm.push(0)
+        vm.push(1)
+        vm.div()
+
+    return compile_main(main)
+
+
+class TestRunVM(TestCase):
+    def test_matches_run_vm_once(self):
+        vm = make_vm()
+        steps = run_once_until_block(vm)
+        vm2 = make_vm()
+        self.assertEqual(arb.run_vm(vm2), steps)
+        self.assertEqual(vm2.pc.pc, vm.pc.pc)
+        self.assertEqual(vm2.stack[:], vm.stack[:])
+        self.assertEqual(vm2.logs, list(range(20)) + [77])
+
+    def test_max_steps(self):
+        vm = make_vm()
+        total = run_once_until_block(vm)
+        vm2 = make_vm()
+        taken = 0
+        while True:
+            ran = arb.run_vm(vm2, 7)
+            taken += ran
+            if ran < 7:
+                break
+        self.assertEqual(taken, total)
+        self.assertEqual(vm2.logs, vm.logs)
+
+    def test_unhandled_error(self):
+        def initialization(vm):
+            vm.push(0)
+            vm.push(1)
+            vm.div()
+            block(vm)
+
+        vm = arb.compile_program(
+            compile_block(initialization),
+            ast.BlockStatement([])
+        )
+        with self.assertRaises(Exception):
+            arb.run_vm(vm)
+
+
+class TestRunUntil(TestCase):
+    def test_blocked(self):
+        vm = make_vm()
+        steps = run_once_until_block(vm)
+        vm2 = make_vm()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = run_until(vm2)
+        self.assertEqual(output.getvalue(), "")
+        self.assertEqual(result.reason, STOP_BLOCKED)
+        self.assertEqual(result.steps, steps)
+        self.assertEqual(result.handled_errors, 1)
+        self.assertIs(result.pc, vm2.pc)
+        self.assertEqual(vm2.pc.pc, vm.pc.pc)
+
+    def test_step_budget(self):
+        vm = make_vm()
+        result = run_until(vm, 10)
+        self.assertEqual(result.reason, STOP_STEP_BUDGET)
+        self.assertEqual(result.steps, 10)
+        result = run_until(vm)
+        self.assertEqual(result.reason, STOP_BLOCKED)
+
+    def test_stop_on_error(self):
+        vm = make_vm()
+        result = run_until(vm, stop_on=(STOP_ERROR,))
+        self.assertEqual(result.reason, STOP_ERROR)
+        self.assertIsNotNone(result.error)
+        self.assertEqual(vm.logs, list(range(20)))
+        result = run_until(vm)
+        self.assertEqual(result.reason, STOP_BLOCKED)
+        self.assertEqual(vm.logs, list(range(20)) + [77])
+
+    def test_unhandled_error(self):
+        def initialization(vm):
+            vm.push(0)
+            vm.push(1)
+            vm.div()
+            block(vm)
+
+        vm = arb.compile_program(
+            compile_block(initialization),
+            ast.BlockStatement([])
+        )
+        result = run_until(vm)
+        self.assertEqual(result.reason, STOP_ERROR)
+        self.assertEqual(result.steps, 1)
+        self.assertEqual(str(result.error), "Can't divide by zero")
+
+
+class TestFusion(TestCase):
+    def test_report(self):
+        vm = make_vm()
+        steps = run_once_until_block(vm)
+        vm2 = make_vm()
+        result = run_until(vm2)
+        self.assertEqual(result.steps, steps)
+        report = {
+            row[0]: row[1:]
+            for row in vm2.decoded_program.fusion_report()
+        }
+        sites, hits, saved = report["branch_if_zero"]
+        self.assertGreater(sites, 0)
+        self.assertEqual(hits, 21)
+        self.assertEqual(saved, 21)
+
+    def test_exact_budget(self):
+        vm = make_vm()
+        total = run_once_until_block(vm)
+        for budget in range(1, 40):
+            with self.subTest(budget=budget):
+                vm2 = make_vm()
+                taken = 0
+                while True:
+                    result = run_until(vm2, budget)
+                    taken += result.steps
+                    if result.reason != STOP_STEP_BUDGET:
+                        break
+                    self.assertEqual(result.steps, budget)
+                self.assertEqual(taken, total)
+                self.assertEqual(vm2.logs, vm.logs)
+
+    def test_replaced_aux_stack(self):
+        vm = make_vm()
+        arb.run_vm_once(vm)
+        vm.aux_stack = Stack()
+        steps = run_once_until_block(vm)
+        vm2 = make_vm()
+        run_until(vm2, 1)
+        vm2.aux_stack = Stack()
+        self.assertEqual(run_until(vm2).steps, steps)
+        self.assertEqual(vm2.logs, vm.logs)
+        self.assertEqual(
+            [fault.pc for fault in vm2.faults],
+            [fault.pc for fault in vm.faults]
+        )
+
+
+def run_quietly(run, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return run(*args, **kwargs)
+
+
+class TestRunBlocks(TestCase):
+    def setUp(self):
+        self.cache = tempfile.TemporaryDirectory()
+        self.cache_dir = self.cache.name
+
+    def tearDown(self):
+        self.cache.cleanup()
+
+    def test_matches_run_vm_once(self):
+        vm = make_vm()
+        steps = run_quietly(run_once_until_block, vm)
+        vm2 = make_vm()
+        self.assertEqual(
+            run_quietly(arb.run_blocks, vm2, cache_dir=self.cache_dir),
+            steps
+        )
+        self.assertGreater(vm2.compiled_blocks.compiled_count, 0)
+        self.assertEqual(vm2.pc.pc, vm.pc.pc)
+        self.assertEqual(vm2.stack[:], vm.stack[:])
+        self.assertEqual(vm2.aux_stack[:], vm.aux_stack[:])
+        # The div by zero inside a compiled block reaches the handler
+        self.assertEqual(vm2.logs, list(range(20)) + [77])
+
+    def test_max_steps(self):
+        vm = make_vm()
+        total = run_quietly(run_once_until_block, vm)
+        vm2 = make_vm()
+        taken = 0
+        while True:
+            ran = run_quietly(
+                arb.run_blocks,
+                vm2,
+                7,
+                cache_dir=self.cache_dir
+            )
+            self.assertLessEqual(ran, 7)
+            taken += ran
+            if ran < 7:
+                break
+        self.assertEqual(taken, total)
+        self.assertEqual(vm2.logs, vm.logs)
+
+    def test_disk_cache(self):
+        vm = make_vm()
+        self.assertFalse(compile_blocks(vm, self.cache_dir).from_cache)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        vm2 = make_vm()
+        self.assertTrue(compile_blocks(vm2, self.cache_dir).from_cache)
+        run_quietly(arb.run_blocks, vm2, cache_dir=self.cache_dir)
+        self.assertEqual(vm2.logs, list(range(20)) + [77])
+
+    def test_edited_code(self):
+        vm = make_vm()
+        compile_blocks(vm, self.cache_dir)
+        # Change the loop count without updating the code point hashes
+        vm2 = make_vm()
+        code_point = next(
+            code_point for code_point in vm2.code
+            if isinstance(code_point.op, ast.ImmediateOp) and
+            code_point.op.val == 20
+        )
+        code_point.op = ast.ImmediateOp(code_point.op.op, 5)
+        self.assertFalse(compile_blocks(vm2, self.cache_dir).from_cache)
+        run_quietly(arb.run_blocks, vm2, cache_dir=self.cache_dir)
+        self.assertEqual(vm2.logs, list(range(5)) + [77])
+
+    def test_corrupt_cache(self):
+        vm = make_vm()
+        key = compile_blocks(vm, self.cache_dir).key
+        path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(path, "wb") as f:
+            f.write(b"not marshalled code")
+        vm2 = make_vm()
+        program = compile_blocks(vm2, self.cache_dir)
+        self.assertEqual(program.key, key)
+        self.assertFalse(program.from_cache)
+        run_quietly(arb.run_blocks, vm2, cache_dir=self.cache_dir)
+        self.assertEqual(vm2.logs, list(range(20)) + [77])
+
+
+class TestCheckpoint(TestCase):
+    def test_rollback(self):
+        vm = make_vm()
+        total = run_quietly(run_once_until_block, vm)
+        vm2 = make_vm()
+        arb.run_vm(vm2, 50)
+        checkpoint = vm2.checkpoint()
+        logs = list(vm2.logs)
+        run_quietly(arb.run_vm, vm2)
+        self.assertEqual(vm2.logs, vm.logs)
+
+        vm2.restore(checkpoint)
+        self.assertEqual(vm2.logs, logs)
+        self.assertEqual(50 + run_quietly(arb.run_vm, vm2), total)
+        self.assertEqual(vm2.logs, vm.logs)
+        self.assertEqual(vm2.stack[:], vm.stack[:])
+
+    def test_fork(self):
+        vm = make_vm()
+        arb.run_vm(vm, 50)
+        fork = vm.fork()
+        self.assertIs(fork.code, vm.code)
+        self.assertIs(fork.static, vm.static)
+        run_quietly(arb.run_vm, fork)
+        self.assertEqual(fork.logs, list(range(20)) + [77])
+        self.assertLess(len(vm.logs), 20)
+        run_quietly(arb.run_vm, vm)
+        self.assertEqual(vm.logs, fork.logs)
+
+    def test_fork_settings(self):
+        vm = make_vm()
+        vm.meter = Meter(max_steps=30, max_cost=1000)
+        vm.verbose_errors = True
+        vm.hash_consing = True
+        vm.faults = deque(maxlen=5)
+        vm.record_fault(Exception("before the fork"))
+        arb.run_vm(vm, 10)
+        fork = vm.fork()
+        self.assertIsNot(fork.meter, vm.meter)
+        self.assertEqual(
+            (fork.meter.max_steps, fork.meter.max_cost, fork.meter.total_steps),
+            (30, 1000, 0)
+        )
+        self.assertIs(fork.meter.costs, vm.meter.costs)
+        self.assertTrue(fork.verbose_errors)
+        self.assertTrue(fork.hash_consing)
+        self.assertEqual(len(fork.faults), 0)
+        self.assertEqual(fork.faults.maxlen, 5)
+        self.assertEqual(run_until(fork).reason, STOP_BUDGET)
+        self.assertEqual(fork.meter.total_steps, 30)
+        self.assertEqual(vm.meter.total_steps, 10)
+
+
+class TestMetering(TestCase):
+    def test_counters(self):
+        vm = make_vm()
+        vm.meter = Meter()
+        steps = run_quietly(run_once_until_block, vm)
+        self.assertEqual(vm.meter.total_steps, steps)
+        self.assertGreater(vm.meter.total_cost, steps)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for run in [
+                    arb.run_vm,
+                    lambda vm: arb.run_blocks(vm, cache_dir=cache_dir)
+            ]:
+                vm2 = make_vm()
+                vm2.meter = Meter()
+                self.assertEqual(run_quietly(run, vm2), steps)
+                self.assertEqual(vm2.meter.total_cost, vm.meter.total_cost)
+
+    def test_step_budget(self):
+        vm = make_vm()
+        vm.meter = Meter(max_steps=30)
+        result = run_until(vm)
+        self.assertEqual(result.reason, STOP_BUDGET)
+        self.assertEqual(result.steps, 30)
+        self.assertTrue(vm.meter.exhausted)
+        pc = vm.pc
+        self.assertFalse(arb.run_vm_once(vm))
+        self.assertIs(vm.pc, pc)
+
+        total = 30
+        while vm.meter.exhausted:
+            vm.meter.start_message()
+            total += run_until(vm).steps
+        self.assertEqual(vm.logs, list(range(20)) + [77])
+        self.assertEqual(vm.meter.total_steps, total)
+
+    def test_cost_budget(self):
+        vm = make_vm()
+        vm.meter = Meter(max_cost=50)
+        result = run_until(vm)
+        self.assertEqual(result.reason, STOP_BUDGET)
+        self.assertLessEqual(vm.meter.message_cost, 50)
+        self.assertEqual(vm.meter.total_steps, result.steps)
+
+    def test_sized_costs(self):
+        meter = Meter()
+        vm = make_vm()
+        hash_op = ast.BasicOp(OPS["hash"])
+        vm.push(5)
+        small = meter.cost(vm, hash_op)
+        vm.push(value.Tuple([1, value.Tuple([2, 3])]))
+        self.assertGreater(meter.cost(vm, hash_op), small)
+        self.assertEqual(
+            meter.cost(vm, ast.ImmediateOp(hash_op, 5)),
+            small
+        )
+
+        tset_op = ast.ImmediateOp(ast.BasicOp(OPS["tset"]), 0)
+        vm.push(value.Tuple([1]))
+        short = meter.cost(vm, tset_op)
+        vm.push(value.Tuple([1, 2, 3]))
+        self.assertGreater(meter.cost(vm, tset_op), short)
+
+
+class TestFaults(TestCase):
+    def test_quiet_by_default(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for run in [
+                    run_once_until_block,
+                    arb.run_vm,
+                    lambda vm: arb.run_blocks(vm, cache_dir=cache_dir)
+            ]:
+                vm = make_vm()
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    run(vm)
+                self.assertEqual(output.getvalue(), "")
+                self.assertEqual(len(vm.faults), 1)
+                fault = vm.faults[0]
+                self.assertEqual(fault.op_code, OPS["div"])
+                self.assertEqual(vm.code[fault.pc].op.get_op(), OPS["div"])
+                self.assertIs(fault.error_type, Exception)
+                self.assertEqual(fault.message, "Can't divide by zero")
+
+    def test_verbose(self):
+        vm = make_vm()
+        vm.verbose_errors = True
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            arb.run_vm(vm)
+        self.assertIn("Hit exception Can't divide by zero", output.getvalue())
+
+    def test_bounded(self):
+        vm = make_vm()
+        vm.push(value.Tuple([1, 2]))
+        for i in range(100):
+            vm.record_fault(Exception(str(i)))
+        self.assertEqual(len(vm.faults), 64)
+        self.assertEqual(vm.faults[-1].message, "99")
+        self.assertEqual(vm.faults[-1].stack_top, ("Tuple(2)",))
+
+
+class TestHashConsing(TestCase):
+    def test_per_vm(self):
+        vm = make_vm()
+        steps = arb.run_vm(vm)
+        vm2 = make_vm()
+        vm2.hash_consing = True
+        self.assertEqual(arb.run_vm(vm2), steps)
+        self.assertEqual(vm2.stack[:], vm.stack[:])
+        self.assertEqual(vm2.logs, vm.logs)
+        # Only on while the VM runs
+        self.assertFalse(value.set_hash_consing(False))
+
+    def test_every_engine(self):
+        vm = make_vm()
+        steps = run_once_until_block(vm)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for run in [
+                    run_once_until_block,
+                    arb.run_vm,
+                    lambda vm: arb.run_blocks(vm, cache_dir=cache_dir),
+                    lambda vm: Profiler().run(vm)
+            ]:
+                vm2 = make_vm()
+                vm2.hash_consing = True
+                with mock.patch.object(
+                        value,
+                        "set_hash_consing",
+                        wraps=value.set_hash_consing
+                ) as set_hash_consing:
+                    self.assertEqual(run(vm2), steps)
+                self.assertIn(mock.call(True), set_hash_consing.call_args_list)
+                self.assertEqual(vm2.logs, vm.logs)
+                self.assertFalse(value.set_hash_consing(False))
+
+
+class TestMemoryFootprint(TestCase):
+    def test_footprint(self):
+        vm = make_vm()
+        arb.run_vm(vm, 50)
+        vm.aux_stack.push(value.Tuple([1, 2]))
+        vm.register = value.Tuple([3])
+        self.assertEqual(
+            vm.memory_footprint(),
+            sum(value.value_size(val) for val in vm.stack[:]) +
+            1 + 2 * 33 +
+            1 + 33 +
+            value.value_size(vm.static)
+        )
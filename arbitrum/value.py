@@ -12,16 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import weakref
+
 import eth_utils
 import eth_abi
 
-from eth_abi.packed import encode_single_packed
-
 INT_TYPE_CODE = 0
 CODE_POINT_CODE = 1
 HASH_ONLY_CODE = 2
 TUPLE_TYPE_CODE = 3
 
+# Canonical tuples by their items. Kept for the whole process, so values
+# interned by an earlier run are still canonical when hash consing is
+# turned on again.
+_interned_table = weakref.WeakValueDictionary()
+# _interned_table while hash consing is on, otherwise None
+_interned = None
+
 
 class IntType:
     def __repr__(self):
@@ -212,6 +220,8 @@ class ValueType:
 
 
 class TypeStack:
+    # The top of each stack is stored at the end of its list so that push
+    # and pop are O(1). Indexing is top-first like Stack in basic_vm.
 
     def __init__(self, stack=None, auxstack=None):
         if stack is None:
@@ -225,10 +235,12 @@ class TypeStack:
         return len(self.stack)
 
     def __repr__(self):
-        return "TypeStack({}, {})".format(self.stack, self.auxstack)
+        return "TypeStack({}, {})".format(self.stack[::-1], self.auxstack[::-1])
 
     def __getitem__(self, index):
-        return self.stack[index]
+        if isinstance(index, slice):
+            return self.stack[::-1][index]
+        return self.stack[-1 - index]
 
     def clone(self):
         return TypeStack(list(self.stack), list(self.auxstack))
@@ -246,43 +258,68 @@ class TypeStack:
     def pop(self, pop_type=None):
         if pop_type is None:
             pop_type = ValueType()
-        typ = self.stack[0]
+        typ = self.stack[-1]
         try:
             if not pop_type.accepts(typ):
-                raise Exception("TypeStack wanted {} but got {}".format(pop_type, self.stack[0]))
+                raise Exception("TypeStack wanted {} but got {}".format(pop_type, typ))
         except Exception as err:
             raise Exception("TypeStack: included non-type {}. Got err {}".format(typ, err))
-        self.stack = self.stack[1:]
+        self.stack.pop()
         return typ
 
     def pop_aux(self, pop_type=None):
         if pop_type is None:
             pop_type = ValueType()
-        typ = self.auxstack[0]
+        typ = self.auxstack[-1]
         try:
             if not pop_type.accepts(typ):
-                raise Exception("TypeStack wanted {} but got {}".format(pop_type, self.stack[0]))
+                raise Exception("TypeStack wanted {} but got {}".format(pop_type, typ))
         except Exception as err:
             raise Exception("TypeStack: included non-type {}. Got err {}".format(typ, err))
-        self.auxstack = self.auxstack[1:]
+        self.auxstack.pop()
         return typ
 
     def push(self, push_type):
-        self.stack.insert(0, push_type)
+        self.stack.append(push_type)
 
     def push_aux(self, push_type):
-        self.auxstack.insert(0, push_type)
+        self.auxstack.append(push_type)
 
 
 class Tuple:
-    def __init__(self, val=None):
+    __slots__ = [
+        "val",
+        "merkle_hash",
+        "hash_cache",
+        "node_count",
+        "byte_size",
+        "__weakref__"
+    ]
+
+    def __new__(cls, val=None):
         if val is None:
-            val = []
+            return EMPTY_TUPLE
         if not isinstance(val, list):
             raise Exception("Tuple must be created from list not {}".format(type(val)))
         elif len(val) > 8:
             raise Exception("Tuple must be created from list of size <= 8")
-        self.val = tuple(val)
+        return Tuple.from_items(tuple(val))
+
+    @staticmethod
+    def from_items(items):
+        """Create a tuple from a python tuple without checking it
+
+        Only for internal callers that already know items holds at most 8
+        values.
+        """
+        if not items:
+            return EMPTY_TUPLE
+        if _interned is not None:
+            return _intern_items(items)
+        return _new_tuple(items)
+
+    def __reduce__(self):
+        return (Tuple, (list(self.val),))
 
     def __repr__(self):
         return "Tuple([{}])".format(', '.join([repr(v) for v in self.val]))
@@ -297,15 +334,19 @@ class Tuple:
         return self.val[index]
 
     def __eq__(self, other):
-        return isinstance(other, Tuple) and self.val == other.val
+        return self is other or (
+            isinstance(other, Tuple) and self.val == other.val
+        )
 
     def __hash__(self):
-        return self.val.__hash__()
+        if self.hash_cache is None:
+            self.hash_cache = self.val.__hash__()
+        return self.hash_cache
 
     def __ne__(self, other):
         if not isinstance(other, Tuple):
             return False
-        return self.val != other.val
+        return self is not other and self.val != other.val
 
     def __iter__(self):
         return self.val.__iter__()
@@ -321,7 +362,78 @@ class Tuple:
             raise Exception("Can't set value {} to index {} of tuple {}".format(value, index, self))
         new_tup = list(self.val)
         new_tup[index] = value
-        return Tuple(new_tup)
+        return Tuple.from_items(tuple(new_tup))
+
+
+def _intern_items(items):
+    # Items compare by identity first, so once the child tuples are
+    # canonical looking up a parent doesn't recurse into them
+    if any(isinstance(item, Tuple) for item in items):
+        items = tuple(intern_value(item) for item in items)
+    try:
+        tup = _interned.get(items)
+    except TypeError:
+        # Compiler values like AVMLabeledCodePoint can't be hashed
+        tup = _new_tuple(items)
+    else:
+        if tup is None:
+            tup = _new_tuple(items)
+            _interned[items] = tup
+    return tup
+
+
+def _new_tuple(items):
+    # merkle_hash, hash_cache, node_count and byte_size are filled in by
+    # value_hash, __hash__ and value_sizes, tuples are never modified in place
+    tup = object.__new__(Tuple)
+    tup.val = items
+    tup.merkle_hash = None
+    tup.hash_cache = None
+    tup.node_count = None
+    tup.byte_size = None
+    return tup
+
+
+EMPTY_TUPLE = _new_tuple(())
+
+
+def intern_value(val):
+    """Return the canonical copy of val while hash consing is on"""
+    if _interned is None or not isinstance(val, Tuple) or not val.val:
+        return val
+    try:
+        if _interned.get(val.val) is val:
+            return val
+    except TypeError:
+        return val
+    return _intern_items(val.val)
+
+
+def set_hash_consing(enabled):
+    """Turn hash consing of tuples on or off for the whole process
+
+    While it is on every tuple created is looked up in a weak table, so
+    structurally equal tuples are the same object. Turning it off keeps the
+    table, tuples are only dropped from it once nothing else refers to
+    them. Returns whether it was on before.
+
+    It only saves memory for values with many equal subtrees. For values
+    with few, like a keyvalue with distinct keys, the table makes them
+    bigger and slower to build.
+    """
+    global _interned
+    previous = _interned is not None
+    _interned = _interned_table if enabled else None
+    return previous
+
+
+@contextlib.contextmanager
+def hash_consing(enabled=True):
+    previous = set_hash_consing(enabled)
+    try:
+        yield
+    finally:
+        set_hash_consing(previous)
 
 
 class AVMCodePoint:
@@ -337,42 +449,137 @@ class AVMCodePoint:
         return "AVMCodePoint({}, {})".format(self.pc, self.op)
 
 
-def value_hash(val):
+# Hash preimages are the packed ABI encodings of (uint8, bytes32...) for
+# tuples and (uint8, uint8, [bytes32,] bytes32) for code points, built
+# directly from bytes
+TUPLE_HASH_PREFIXES = [bytes([TUPLE_TYPE_CODE + i]) for i in range(9)]
+
+
+def _int_hash(val):
+    return eth_utils.keccak(val.to_bytes(32, byteorder="big"))
+
+
+def code_point_hash(op_code, next_hash, immediate_hash=b""):
+    """Hash of a code point from its opcode, next_hash and the hash of its
+    immediate value if it has one
+    """
+    # Packed bytes32 values are right padded
+    return eth_utils.keccak(
+        bytes([CODE_POINT_CODE, op_code]) +
+        immediate_hash +
+        bytes(next_hash).ljust(32, b"\0")
+    )
+
+
+def _hash(val, int_hash):
     if isinstance(val, int):
-        return eth_utils.keccak(encode_single_packed(
-            '(uint256)',
-            [val]
-        ))
-        # return eth_utils.keccak(encode_single_packed(
-        #     '(uint8,uint256)',
-        #     [INT_TYPE_CODE, val]
-        # ))
+        return int_hash(val)
     if isinstance(val, Tuple):
-        return eth_utils.keccak(encode_single_packed(
-            '(uint8' + ',bytes32'*len(val) + ')',
-            [TUPLE_TYPE_CODE + len(val)] + [value_hash(v) for v in val.val]
-        ))
+        if val.merkle_hash is None:
+            val.merkle_hash = eth_utils.keccak(
+                TUPLE_HASH_PREFIXES[len(val.val)] +
+                b"".join([_hash(item, int_hash) for item in val.val])
+            )
+        return val.merkle_hash
     if isinstance(val, AVMCodePoint):
-        if hasattr(val.op, "op_code"):
-            return eth_utils.keccak(encode_single_packed(
-                '(uint8,uint8,bytes32)',
-                [CODE_POINT_CODE, val.op.op_code, val.next_hash]
-            ))
-        if isinstance(val.op, int):
-            return eth_utils.keccak(encode_single_packed(
-                '(uint8,uint8,bytes32)',
-                [CODE_POINT_CODE, val.op, val.next_hash]
-            ))
-        if hasattr(val.op, "val"):
-            return eth_utils.keccak(encode_single_packed(
-                '(uint8,uint8,bytes32,bytes32)',
-                [CODE_POINT_CODE, val.op.op.op_code, value_hash(val.op.val), val.next_hash]
-            ))
-        raise Exception("Bad op type {}".format(val.op))
+        op = val.op
+        if hasattr(op, "op_code"):
+            return code_point_hash(op.op_code, val.next_hash)
+        if isinstance(op, int):
+            return code_point_hash(op, val.next_hash)
+        if hasattr(op, "val"):
+            return code_point_hash(
+                op.op.op_code,
+                val.next_hash,
+                _hash(op.val, int_hash)
+            )
+        raise Exception("Bad op type {}".format(op))
 
     raise Exception("Can't hash {}".format(val))
 
 
+def value_hash(val):
+    return _hash(val, _int_hash)
+
+
+def value_hash_many(values):
+    """Return the hashes of a list of values
+
+    Integers that appear more than once across the values are only hashed
+    once.
+    """
+    int_hashes = {}
+
+    def int_hash(val):
+        digest = int_hashes.get(val)
+        if digest is None:
+            digest = _int_hash(val)
+            int_hashes[val] = digest
+        return digest
+
+    return [_hash(val, int_hash) for val in values]
+
+
+# Bytes counted for each value by value_size, the size of its marshalled
+# form. Code points belong to the program, so their immediate values aren't
+# counted.
+INT_SIZE = 33
+CODE_POINT_SIZE = 43
+
+
+def _fill_sizes(tup):
+    # Tuples are sized after their items, without recursion so deep values
+    # are fine. Only tuples not sized before are visited.
+    stack = [tup]
+    while stack:
+        top = stack[-1]
+        if top.node_count is not None:
+            stack.pop()
+            continue
+        unsized = [
+            item for item in top.val
+            if isinstance(item, Tuple) and item.node_count is None
+        ]
+        if unsized:
+            stack.extend(unsized)
+            continue
+        stack.pop()
+        count = 1
+        size = 1
+        for item in top.val:
+            if isinstance(item, Tuple):
+                count += item.node_count
+                size += item.byte_size
+            else:
+                count += 1
+                size += INT_SIZE if isinstance(item, int) else CODE_POINT_SIZE
+        top.node_count = count
+        top.byte_size = size
+
+
+def value_sizes(val):
+    """Return the node count and byte size of val
+
+    Both are cached on tuples, so sizing a tuple built from sized tuples
+    only looks at its own items.
+    """
+    if isinstance(val, Tuple):
+        if val.node_count is None:
+            _fill_sizes(val)
+        return val.node_count, val.byte_size
+    if isinstance(val, int):
+        return 1, INT_SIZE
+    return 1, CODE_POINT_SIZE
+
+
+def node_count(val):
+    return value_sizes(val)[0]
+
+
+def value_size(val):
+    return value_sizes(val)[1]
+
+
 def arbtype(val):
     if isinstance(val, int):
         return IntType()
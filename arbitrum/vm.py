@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
+
 from .value import AVMCodePoint
 from . import value
 from .basic_vm import BasicVM
@@ -35,11 +37,33 @@ class VM(BasicVM):
         self.ops = {}
         for (op_name, op_code, pop_count, push_count) in OP_CODES:
             self.ops[op_code] = getattr(self, op_name)
+        self.decoded_program = None
+        self.compiled_blocks = None
+        # Functions inlined by compile_program because of a profile, and
+        # instructions removed by constant folding and dead code removal
+        self.inline_report = []
+        self.optimization_report = []
         if code:
             self.pc = code[0]
         else:
             self.pc = AVMCodePoint(0, 0, b'')
 
+    def fork(self):
+        """Return an independent copy of this VM sharing code and static"""
+        vm = VM(self.code, self.output_handler)
+        # Compiled blocks only depend on the code
+        vm.compiled_blocks = self.compiled_blocks
+        vm.inline_report = self.inline_report
+        vm.optimization_report = self.optimization_report
+        # Run like this VM, but count steps and record faults on its own
+        if self.meter is not None:
+            vm.meter = self.meter.fresh()
+        vm.verbose_errors = self.verbose_errors
+        vm.hash_consing = self.hash_consing
+        vm.faults = deque(maxlen=self.faults.maxlen)
+        self.checkpoint().restore(vm)
+        return vm
+
     def debug_print(self):
         print(
             "debug_print:",
@@ -15,7 +15,8 @@
 from .annotation import modifies_stack
 from .ast import ImmediateOp, AVMLabeledCodePoint
 from . import value
-from .basic_vm import VMBlocked, VMBlockedAdvance
+from . import fusion
+from .basic_vm import VMBlocked, VMBlockedAdvance, VMBudgetExceeded
 import traceback
 
 
@@ -30,7 +31,42 @@ class InstructionOutOfBounds(Exception):
     pass
 
 
+def _error_handler_pc(vm):
+    if isinstance(vm.err_handler, value.CodePointType):
+        return vm.err_handler
+    elif isinstance(vm.err_handler, AVMLabeledCodePoint):
+        return vm.err_handler.pc
+    elif isinstance(vm.err_handler, value.AVMCodePoint):
+        return vm.err_handler
+    return None
+
+
+def _print_error(vm, err):
+    print("Hit exception {} while running {}".format(err, vm.pc))
+    traceback.print_tb(err.__traceback__)
+
+
+def _jump_to_error_handler(vm, err):
+    # Must be called while handling err so that it can be reraised
+    vm.record_fault(err)
+    if vm.verbose_errors:
+        _print_error(vm, err)
+    handler = _error_handler_pc(vm)
+    if handler is None:
+        if vm.verbose_errors:
+            print("Error handler", vm.err_handler)
+        raise
+    vm.pc = handler
+
+
 def run_vm_once(vm):
+    if vm.hash_consing:
+        with value.hash_consing():
+            return _run_vm_once(vm)
+    return _run_vm_once(vm)
+
+
+def _run_vm_once(vm):
     if vm.halted:
         raise Exception("Can't run VM since it is halted")
     if vm.pc.pc == -2:
@@ -39,6 +75,8 @@ def run_vm_once(vm):
     old_pc = vm.pc
 
     try:
+        if vm.meter is not None:
+            vm.meter.charge(vm, instr)
         if isinstance(instr, ImmediateOp):
             vm.push(instr.val)
             vm.ops[instr.op.op_code]()
@@ -57,25 +95,259 @@ def run_vm_once(vm):
         if next_pc >= len(vm.code):
             raise InstructionOutOfBounds()
 
+    except VMBudgetExceeded:
+        return False
     except VMBlocked:
+        if vm.meter is not None:
+            vm.meter.refund()
         return False
     except VMBlockedAdvance:
         vm.pc = vm.code[vm.pc.pc + 1]
         return False
     except Exception as err:
-        print("Hit exception {} while running {}".format(err, vm.pc))
-        traceback.print_tb(err.__traceback__)
-        if isinstance(vm.err_handler, value.CodePointType):
-            vm.pc = vm.err_handler
-        elif isinstance(vm.err_handler, AVMLabeledCodePoint):
-            vm.pc = vm.err_handler.pc
-        elif isinstance(vm.err_handler, value.AVMCodePoint):
-            vm.pc = vm.err_handler
-        else:
-            print("Error handler", vm.err_handler)
-            raise
+        _jump_to_error_handler(vm, err)
 
     if vm.pc.pc == old_pc.pc:
         vm.pc = vm.code[vm.pc.pc + 1]
 
     return True
+
+
+def _bind_immediate(push, op, val):
+    def impl():
+        push(val)
+        op()
+    return impl
+
+
+def _run_op(vm, instr):
+    if isinstance(instr, ImmediateOp):
+        vm.push(instr.val)
+        vm.ops[instr.op.op_code]()
+    elif isinstance(instr, int):
+        vm.ops[instr]()
+    else:
+        vm.ops[instr.op_code]()
+
+
+class DecodedProgram:
+    """vm.code translated into handlers that can be called directly
+
+    handlers[i] runs the op at code point i with any immediate already
+    bound in and successors[i] is the code point that follows it, or None
+    at the end of the program. fused_handlers is handlers with the
+    superinstructions from fusion installed.
+    """
+    def __init__(self, vm):
+        self.code = vm.code
+        self.stack = vm.stack
+        # Fused handlers hold on to the aux stack too
+        self.aux_stack = vm.aux_stack
+        self.handlers = []
+        self.successors = []
+        for code_point in self.code:
+            instr = code_point.op
+            if isinstance(instr, ImmediateOp):
+                val = instr.val
+                if isinstance(val, list):
+                    val = value.Tuple(val)
+                handler = _bind_immediate(
+                    vm.stack.push,
+                    vm.ops[instr.op.op_code],
+                    val
+                )
+            elif isinstance(instr, int):
+                handler = vm.ops[instr]
+            else:
+                handler = vm.ops[instr.op_code]
+            self.handlers.append(handler)
+        self.successors = self.code[1:] + [None]
+        self.fused_handlers, self.fusion_sites = fusion.fuse_handlers(
+            vm,
+            self.code,
+            self.handlers
+        )
+        self.longest_fusion = max(
+            [site.length for site in self.fusion_sites],
+            default=1
+        )
+
+    def fusion_report(self):
+        return fusion.fusion_report(self.fusion_sites)
+
+    def matches(self, vm):
+        return (
+            self.code is vm.code and
+            self.stack is vm.stack and
+            self.aux_stack is vm.aux_stack
+        )
+
+
+def decode_program(vm):
+    program = vm.decoded_program
+    if program is None or not program.matches(vm):
+        program = DecodedProgram(vm)
+        vm.decoded_program = program
+    return program
+
+
+STOP_BLOCKED = "blocked"
+STOP_BUDGET = "budget"
+STOP_BREAKPOINT = "breakpoint"
+STOP_HALTED = "halted"
+STOP_ERROR = "error"
+STOP_STEP_BUDGET = "step_budget"
+
+
+class RunResult:
+    def __init__(self, steps, reason, pc, error=None, handled_errors=0):
+        self.steps = steps
+        self.reason = reason
+        self.pc = pc
+        self.error = error
+        self.handled_errors = handled_errors
+
+    def __repr__(self):
+        return "RunResult({} steps, {}, pc {})".format(
+            self.steps,
+            self.reason,
+            self.pc.pc
+        )
+
+
+def run_until(vm, max_steps=None, stop_on=(STOP_BREAKPOINT,), verbose=False):
+    """Run the VM until it stops and report why it stopped
+
+    The VM always stops when it blocks on inbox, runs out of the budget of
+    its meter, halts, hits an error with no error handler or has run
+    max_steps steps. It also stops at a
+    breakpoint or at an error that jumped to the error handler if
+    STOP_BREAKPOINT or STOP_ERROR is in stop_on. Errors are recorded in
+    vm.faults and only printed if verbose is set.
+    """
+    if vm.hash_consing:
+        with value.hash_consing():
+            return _run_until(vm, max_steps, stop_on, verbose)
+    return _run_until(vm, max_steps, stop_on, verbose)
+
+
+def _run_until(vm, max_steps, stop_on, verbose):
+    if vm.halted:
+        return RunResult(0, STOP_HALTED, vm.pc)
+    program = decode_program(vm)
+    code = program.code
+    successors = program.successors
+    code_len = len(code)
+    stop_on_breakpoint = STOP_BREAKPOINT in stop_on
+    stop_on_error = STOP_ERROR in stop_on
+    meter = vm.meter
+    if meter is not None:
+        # Metering charges every instruction separately
+        phases = [(program.handlers, max_steps)]
+    elif max_steps is None:
+        phases = [(program.fused_handlers, None)]
+    else:
+        # Fused handlers run several steps at once, so the end of the
+        # budget runs unfused to stop at exactly max_steps
+        phases = [
+            (program.fused_handlers, max_steps - program.longest_fusion + 1),
+            (program.handlers, max_steps)
+        ]
+
+    steps = 0
+    handled_errors = 0
+    error = None
+    reason = None
+    for handlers, limit in phases:
+        while limit is None or steps < limit:
+            if vm.halted:
+                reason = STOP_HALTED
+                break
+            pc = vm.pc
+            index = pc.pc
+            if index == -2:
+                reason = STOP_ERROR
+                error = Exception("VM hit unhandled error")
+                break
+
+            try:
+                if meter is not None:
+                    meter.charge(vm, pc.op)
+                if 0 <= index < code_len and code[index] is pc:
+                    # Fused handlers return how many steps they ran
+                    ran = handlers[index]()
+                    successor = successors[index]
+                else:
+                    # Code points outside of vm.code (like a cleared error
+                    # handler) aren't decoded
+                    ran = _run_op(vm, pc.op)
+                    if index + 1 < code_len:
+                        successor = code[index + 1]
+                    else:
+                        successor = None
+
+                # We only incremement the PC if the operation has not
+                # otherwise modified the PC (JUMP, CJUMP)
+                next_pc = vm.pc
+                if next_pc.pc == index:
+                    if successor is None:
+                        raise InstructionOutOfBounds()
+                    vm.pc = successor
+                elif next_pc.pc >= code_len:
+                    raise InstructionOutOfBounds()
+            except VMBudgetExceeded:
+                reason = STOP_BUDGET
+                break
+            except VMBlocked:
+                if meter is not None:
+                    meter.refund()
+                reason = STOP_BLOCKED
+                break
+            except VMBlockedAdvance:
+                vm.pc = code[vm.pc.pc + 1]
+                if stop_on_breakpoint:
+                    reason = STOP_BREAKPOINT
+                    break
+                steps += 1
+            except Exception as err:
+                vm.record_fault(err)
+                if verbose:
+                    _print_error(vm, err)
+                handler = _error_handler_pc(vm)
+                if handler is None:
+                    reason = STOP_ERROR
+                    error = err
+                    break
+                vm.pc = handler
+                if handler.pc == index:
+                    vm.pc = code[index + 1]
+                handled_errors += 1
+                steps += 1
+                if stop_on_error:
+                    reason = STOP_ERROR
+                    error = err
+                    break
+            else:
+                steps += ran or 1
+        if reason is not None:
+            break
+    else:
+        reason = STOP_STEP_BUDGET
+
+    return RunResult(steps, reason, vm.pc, error, handled_errors)
+
+
+def run_vm(vm, max_steps=None):
+    """Run up to max_steps instructions, stopping early if the VM blocks
+
+    Behaves like calling run_vm_once repeatedly until it returns False and
+    returns the number of calls that would have returned True.
+    """
+    if vm.halted:
+        raise Exception("Can't run VM since it is halted")
+    result = run_until(vm, max_steps, verbose=vm.verbose_errors)
+    if result.reason == STOP_ERROR:
+        if vm.verbose_errors and result.pc.pc != -2:
+            print("Error handler", vm.err_handler)
+        raise result.error
+    return result.steps
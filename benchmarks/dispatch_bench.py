@@ -0,0 +1,125 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import arbitrum as arb
+from arbitrum import value, ast
+from arbitrum.annotation import noreturn
+from arbitrum.block_compiler import compile_blocks
+from arbitrum.compiler import compile_block
+
+LOOP_COUNT = 5000
+
+
+def block(vm):
+    vm.push(value.Tuple([]))
+    vm.inbox()
+
+
+@noreturn
+def loop_error(vm):
+    block(vm)
+
+
+@noreturn
+def block_error(vm):
+    block(vm)
+
+
+def make_vm():
+    def initialization(vm):
+        vm.jump_direct(ast.AVMLabel("main"))
+
+    def main(vm):
+        vm.set_label(ast.AVMLabel("main"))
+        vm.set_exception_handler(loop_error)
+        vm.push(value.Tuple([0, 0, 0, 0]))
+        vm.push(0)
+        vm.while_loop(
+            lambda vm: [vm.push(LOOP_COUNT), vm.dup1(), vm.lt()],
+            lambda vm: [
+                # [i, tup]
+                vm.dup1(),
+                vm.dup1(),
+                vm.push(4),
+                vm.swap1(),
+                vm.mod(),
+                vm.tget(),
+                vm.dup1(),
+                vm.add(),
+                # [val, i, tup]
+                vm.swap1(),
+                vm.dup0(),
+                vm.auxpush(),
+                vm.swap2(),
+                vm.swap1(),
+                vm.auxpop(),
+                # [i, val, tup, i]
+                vm.push(4),
+                vm.swap1(),
+                vm.mod(),
+                vm.swap1(),
+                vm.swap2(),
+                vm.swap1(),
+                vm.tset(),
+                vm.swap1(),
+                vm.push(1),
+                vm.add()
+            ]
+        )
+        vm.pop()
+        vm.pop()
+        vm.set_exception_handler(block_error)
+        block(vm)
+
+    return arb.compile_program(
+        compile_block(initialization),
+        compile_block(main)
+    )
+
+
+def bench(name, run, prepare=arb.vm_runner.decode_program):
+    vm = make_vm()
+    prepare(vm)
+    start = time.time()
+    steps = run(vm)
+    elapsed = time.time() - start
+    print("{}: {} steps in {:.3f}s ({:.0f} steps/s)".format(
+        name,
+        steps,
+        elapsed,
+        steps / elapsed
+    ))
+    return vm
+
+
+def run_once_loop(vm):
+    steps = 0
+    while arb.run_vm_once(vm):
+        steps += 1
+    return steps
+
+
+if __name__ == '__main__':
+    bench("run_vm_once", run_once_loop)
+    vm = bench("run_vm", arb.run_vm)
+    print("fusion sites hits dispatches_saved")
+    for row in vm.decoded_program.fusion_report():
+        print("{} {} {} {}".format(*row))
+    vm = bench("run_blocks", arb.run_blocks, compile_blocks)
+    print("{} of {} blocks compiled".format(
+        vm.compiled_blocks.compiled_count,
+        vm.compiled_blocks.block_count
+    ))
@@ -0,0 +1,94 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Instructions removed from each contract by constant folding and dead code
+# removal, from vm.optimization_report.
+#
+# Usage: fold_bench.py [contracts.json]
+#
+# contracts.json is the truffle output read by arbc-truffle-compile. Without
+# it a set of contracts doing arithmetic on constants is generated.
+
+import contextlib
+import io
+import json
+import random
+import sys
+import time
+
+from pyevmasm import instruction_tables, assemble_hex, assemble_one
+import eth_utils
+
+from arbitrum.evm.contract import ArbContract, create_evm_vm
+
+CONTRACT_COUNT = 8
+OPS = ["ADD", "MUL", "SUB", "DIV", "MOD", "LT", "EQ", "AND", "EXP"]
+
+
+def make_contracts():
+    table = instruction_tables['byzantium']
+    contracts = []
+    for i in range(CONTRACT_COUNT):
+        code = []
+        for j in range(30):
+            code += [
+                assemble_one("PUSH1 {}".format(hex(j + 1))),
+                assemble_one("PUSH1 {}".format(hex(i + 2))),
+                table[OPS[(i + j) % len(OPS)]],
+                assemble_one("PUSH1 {}".format(hex(j))),
+                table["SSTORE"]
+            ]
+        code += [table["STOP"]]
+        contracts.append(ArbContract({
+            "address": eth_utils.to_checksum_address(
+                random.getrandbits(8*20).to_bytes(20, byteorder="big").hex()
+            ),
+            "abi": [],
+            "name": "Contract{}".format(i),
+            "code": assemble_hex(code),
+            "storage": {}
+        }))
+    return contracts
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as json_file:
+            contracts = [ArbContract(contract) for contract in json.load(json_file)]
+    else:
+        contracts = make_contracts()
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm = create_evm_vm(contracts)
+    elapsed = time.time() - start
+
+    total_before = 0
+    total_after = 0
+    for group, before, after in vm.optimization_report:
+        total_before += before
+        total_after += after
+        if group.startswith("EVMContract("):
+            print("{}: {} -> {} instructions ({:.1%} removed)".format(
+                group,
+                before,
+                after,
+                (before - after) / before
+            ))
+    print("program: {} -> {} instructions ({:.1%} removed), compiled in {:.1f}s".format(
+        total_before,
+        total_after,
+        (total_before - total_after) / total_before,
+        elapsed
+    ))
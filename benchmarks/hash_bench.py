@@ -0,0 +1,136 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Hashes the EVM chain_state register after every SSTORE of a contract.
+# value_hash reuses the hashes cached on unchanged tuples, this compares it
+# to hashing a fresh copy of the same tree where nothing is cached.
+
+import contextlib
+import io
+import random
+import time
+
+from pyevmasm import instruction_tables, assemble_hex, assemble_one
+import eth_utils
+
+import arbitrum as arb
+from arbitrum import value
+from arbitrum.evm.contract import ArbContract, create_evm_vm
+
+ADDRESS = "0x895521964D724c8362A36608AAf09A3D7d0A0445"
+STORE_COUNT = 100
+
+
+def make_contract():
+    table = instruction_tables['byzantium']
+    code = []
+    for i in range(STORE_COUNT):
+        code += [
+            assemble_one("PUSH2 {}".format(hex(i + 1))),
+            assemble_one("PUSH2 {}".format(hex(i))),
+            table["SSTORE"]
+        ]
+    code += [
+        assemble_one("PUSH1 0x00"),
+        assemble_one("PUSH1 0x00"),
+        table['MSTORE'],
+        assemble_one("PUSH1 0x20"),
+        assemble_one("PUSH1 0x00"),
+        table['RETURN'],
+    ]
+    return ArbContract({
+        "address": ADDRESS,
+        "abi": [{
+            "constant": False,
+            "inputs": [],
+            "name": "testMethod",
+            "outputs": [{"name": "", "type": "uint256"}],
+            "payable": False,
+            "stateMutability": "nonpayable",
+            "type": "function"
+        }],
+        "name": "TestContract",
+        "code": assemble_hex(code),
+        "storage": {}
+    })
+
+
+def make_vm(contract):
+    contracts = [contract]
+    for _ in range(10):
+        contracts.append(ArbContract({
+            "address": eth_utils.to_checksum_address(
+                random.getrandbits(8*20).to_bytes(20, byteorder="big").hex()
+            ),
+            "abi": [],
+            "name": "TestContract",
+            "code": "0x00",
+            "storage": {}
+        }))
+    with contextlib.redirect_stdout(io.StringIO()):
+        return create_evm_vm(contracts)
+
+
+def in_sstore(vm):
+    return any(str(frame).startswith("EthOp(SSTORE") for frame in vm.pc.path)
+
+
+def fresh_copy(val):
+    if isinstance(val, value.Tuple):
+        return value.Tuple([fresh_copy(item) for item in val])
+    return val
+
+
+def stored_states(vm):
+    # chain_state after every SSTORE, once execution is back in EVM code
+    states = []
+    stored = False
+    while arb.run_vm_once(vm):
+        if in_sstore(vm):
+            stored = True
+        elif stored and any(str(frame).startswith("EthOp(") for frame in vm.pc.path):
+            states.append(vm.register)
+            stored = False
+    return states
+
+
+def bench(name, states, prepare):
+    trees = [prepare(state) for state in states]
+    start = time.time()
+    hashes = [value.value_hash(tree) for tree in trees]
+    elapsed = time.time() - start
+    print("{}: {} hashes in {:.3f}s ({:.2f}ms per hash)".format(
+        name,
+        len(trees),
+        elapsed,
+        elapsed / len(trees) * 1000
+    ))
+    return hashes
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    contract = make_contract()
+    vm = make_vm(contract)
+    vm.env.send_message([
+        value.Tuple([contract.testMethod(4), 0, 0, 0]),
+        2345,
+        0,
+        0
+    ])
+    vm.env.deliver_pending()
+    states = stored_states(vm)
+    full = bench("full rehash", states, fresh_copy)
+    cached = bench("cached rehash", states, lambda state: state)
+    assert full == cached
@@ -0,0 +1,126 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Steps run by a contract with storage reads and writes, compiled without
+# and with a profile of its own run for profile guided inlining.
+#
+# Usage: inline_bench.py [inline budget]
+
+import contextlib
+import io
+import random
+import sys
+
+from pyevmasm import instruction_tables, assemble_hex, assemble_one
+import eth_utils
+
+from arbitrum import value
+from arbitrum.compiler import INLINE_BUDGET
+from arbitrum.evm.contract import ArbContract, create_evm_vm
+from arbitrum.profiler import Profiler
+
+ADDRESS = "0x895521964D724c8362A36608AAf09A3D7d0A0445"
+STORE_COUNT = 50
+
+
+def make_contracts():
+    table = instruction_tables['byzantium']
+    code = []
+    for i in range(STORE_COUNT):
+        code += [
+            assemble_one("PUSH2 {}".format(hex(i))),
+            table["SLOAD"],
+            assemble_one("PUSH2 {}".format(hex(i + 1))),
+            table["ADD"],
+            assemble_one("PUSH2 {}".format(hex(i))),
+            table["SSTORE"]
+        ]
+    code += [
+        assemble_one("PUSH1 0x00"),
+        assemble_one("PUSH1 0x00"),
+        table['MSTORE'],
+        assemble_one("PUSH1 0x20"),
+        assemble_one("PUSH1 0x00"),
+        table['RETURN'],
+    ]
+    contracts = [ArbContract({
+        "address": ADDRESS,
+        "abi": [{
+            "constant": False,
+            "inputs": [],
+            "name": "testMethod",
+            "outputs": [{"name": "", "type": "uint256"}],
+            "payable": False,
+            "stateMutability": "nonpayable",
+            "type": "function"
+        }],
+        "name": "TestContract",
+        "code": assemble_hex(code),
+        "storage": {}
+    })]
+    for _ in range(10):
+        contracts.append(ArbContract({
+            "address": eth_utils.to_checksum_address(
+                random.getrandbits(8*20).to_bytes(20, byteorder="big").hex()
+            ),
+            "abi": [],
+            "name": "TestContract",
+            "code": "0x00",
+            "storage": {}
+        }))
+    return contracts
+
+
+def profile_run(vm, contract):
+    vm.env.send_message([
+        value.Tuple([contract.testMethod(4), 0, 0, 0]),
+        2345,
+        0,
+        0
+    ])
+    vm.env.deliver_pending()
+    profiler = Profiler()
+    with contextlib.redirect_stdout(io.StringIO()):
+        steps = profiler.run(vm)
+    return profiler, steps
+
+
+if __name__ == '__main__':
+    budget = int(sys.argv[1]) if len(sys.argv) > 1 else INLINE_BUDGET
+    random.seed(0)
+    contracts = make_contracts()
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm = create_evm_vm(contracts)
+    profiler, steps = profile_run(vm, contracts[0])
+    print("without profile: {} code points, {} steps".format(len(vm.code), steps))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm = create_evm_vm(
+            contracts,
+            profile=profiler.call_counts(),
+            inline_budget=budget
+        )
+    expected = 0
+    for name, sites, calls, added, saved in vm.inline_report:
+        print("  inlined {}: {} sites, {} calls, {} instructions added, {} steps saved".format(
+            name, sites, calls, added, saved
+        ))
+        expected += saved
+    _, new_steps = profile_run(vm, contracts[0])
+    print("with profile: {} code points, {} steps ({} saved, {} expected)".format(
+        len(vm.code),
+        new_steps,
+        steps - new_steps,
+        expected
+    ))
@@ -0,0 +1,197 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Time to write the .ao file of a multi contract EVM program, with the
+# recursive marshaller marshall_vm used before Marshaller as the baseline,
+# and its size with and without the DAG extension. Also the time to fetch
+# random ops from the file with and without the index extension.
+#
+# Usage: marshall_bench.py [contracts.json]
+#
+# contracts.json is the truffle output read by arbc-truffle-compile. Without
+# it a set of contracts with code and storage is generated.
+
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from pyevmasm import instruction_tables, assemble_hex, assemble_one
+import eth_abi
+import eth_utils
+
+from arbitrum import value
+from arbitrum.ast import AVMLabeledCodePoint, BasicOp, ImmediateOp
+from arbitrum.evm.contract import ArbContract, create_evm_vm
+from arbitrum.marshall import (
+    marshall_vm,
+    unmarshall_vm,
+    dag_extension,
+    index_extension,
+    CodeIndex,
+    AO_VERSION,
+    CODE_POINT_TYPE_CODE,
+    INT_TYPE_CODE,
+    TUPLE_TYPE_CODE
+)
+
+CONTRACT_COUNT = 8
+STORAGE_SIZE = 200
+REPEAT = 5
+FETCH_COUNT = 1000
+
+
+def make_contracts():
+    table = instruction_tables['byzantium']
+    contracts = []
+    for i in range(CONTRACT_COUNT):
+        code = []
+        for j in range(50):
+            code += [
+                assemble_one("PUSH2 {}".format(hex(i * 100 + j))),
+                assemble_one("PUSH1 {}".format(hex(j))),
+                table["SSTORE"]
+            ]
+        code += [table["STOP"]]
+        contracts.append(ArbContract({
+            "address": eth_utils.to_checksum_address(
+                random.getrandbits(8*20).to_bytes(20, byteorder="big").hex()
+            ),
+            "abi": [],
+            "name": "Contract{}".format(i),
+            "code": assemble_hex(code),
+            "storage": {
+                hex(key): hex(random.getrandbits(256))
+                for key in range(STORAGE_SIZE)
+            }
+        }))
+    return contracts
+
+
+# The recursive marshaller, writing every field straight to the file
+
+def recursive_marshall_op(val, file):
+    if isinstance(val, BasicOp):
+        file.write((0).to_bytes(1, byteorder='big', signed=False))
+        file.write(val.op_code.to_bytes(1, byteorder='big', signed=False))
+    elif isinstance(val, int):
+        file.write((0).to_bytes(1, byteorder='big', signed=False))
+        file.write(val.to_bytes(1, byteorder='big', signed=False))
+    else:
+        file.write((1).to_bytes(1, byteorder='big', signed=False))
+        file.write(val.get_op().to_bytes(1, byteorder='big', signed=False))
+        recursive_marshall_value(val.val, file)
+
+
+def recursive_marshall_value(val, file):
+    if isinstance(val, value.Tuple):
+        file.write((TUPLE_TYPE_CODE + len(val)).to_bytes(
+            1,
+            byteorder='big',
+            signed=False
+        ))
+        for item in val:
+            recursive_marshall_value(item, file)
+    elif isinstance(val, int):
+        file.write(INT_TYPE_CODE.to_bytes(1, byteorder='big', signed=False))
+        file.write(eth_abi.encode_single("uint256", val))
+    else:
+        if isinstance(val, AVMLabeledCodePoint):
+            val = val.pc
+        file.write(CODE_POINT_TYPE_CODE.to_bytes(1, byteorder='big', signed=False))
+        file.write(val.pc.to_bytes(8, byteorder='big', signed=True))
+        recursive_marshall_op(val.op, file)
+        file.write(b'0' * (32 - len(val.next_hash)) + val.next_hash)
+
+
+def recursive_marshall_vm(vm, file, extensions=[]):
+    file.write(AO_VERSION.to_bytes(4, byteorder='big', signed=False))
+    file.write((0).to_bytes(4, byteorder='big', signed=False))
+    file.write(len(vm.code).to_bytes(8, byteorder='big', signed=False))
+    for instr in vm.code:
+        recursive_marshall_op(instr.op, file)
+    recursive_marshall_value(vm.static, file)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as json_file:
+            contracts = [ArbContract(contract) for contract in json.load(json_file)]
+    else:
+        contracts = make_contracts()
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm = create_evm_vm(contracts)
+
+    plain_size = None
+    outputs = {}
+    for name, marshall, extensions in [
+            ("recursive", recursive_marshall_vm, []),
+            ("plain", marshall_vm, []),
+            ("dag", marshall_vm, [dag_extension()])
+    ]:
+        best = None
+        for _ in range(REPEAT):
+            data = io.BytesIO()
+            start = time.time()
+            marshall(vm, data, extensions)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        outputs[name] = data.getvalue()
+        size = len(data.getvalue())
+        if plain_size is None:
+            plain_size = size
+        print("{}: {} code points, {:.2f}MB ({:.0%}) in {:.3f}s ({:.1f}MB/s)".format(
+            name,
+            len(vm.code),
+            size / 1e6,
+            size / plain_size,
+            best,
+            size / 1e6 / best
+        ))
+    assert outputs["plain"] == outputs["recursive"]
+
+    pcs = [random.randrange(len(vm.code)) for _ in range(FETCH_COUNT)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "program.ao")
+        with open(path, "wb") as f:
+            marshall_vm(vm, f)
+        start = time.time()
+        loaded = unmarshall_vm(path)
+        ops = [loaded.code[pc].op for pc in pcs]
+        print("unmarshall_vm: {} ops in {:.3f}s".format(FETCH_COUNT, time.time() - start))
+        for name, extensions in [
+                ("scan", []),
+                ("index", [index_extension(vm)])
+        ]:
+            with open(path, "wb") as f:
+                marshall_vm(vm, f, extensions)
+            start = time.time()
+            index = CodeIndex(path)
+            opened = time.time() - start
+            ops = [index.op(pc) for pc in pcs]
+            elapsed = time.time() - start
+            print("{}: {:.2f}MB, {} ops in {:.3f}s ({:.3f}s to open)".format(
+                name,
+                os.path.getsize(path) / 1e6,
+                FETCH_COUNT,
+                elapsed,
+                opened
+            ))
+            index.data.close()
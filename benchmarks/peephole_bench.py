@@ -0,0 +1,76 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Time of the peephole optimizations on a flat program of 500k ops, with
+# rewrite_code and with the slice assignment rewriter it replaced.
+# rewrite_code also rechecks the ops before a rewrite, like the swaps around
+# swap2 swap2 in swap1 swap2 swap2 swap1, so it can remove a few more ops.
+#
+# Usage: peephole_bench.py [op count]
+
+import random
+import sys
+import time
+
+from arbitrum import ast, instructions
+from arbitrum.compiler import PEEPHOLE_RULES, rewrite_code
+
+OP_COUNT = 500000
+OP_NAMES = ["add", "swap1", "swap1", "swap2", "dup0", "pop", "tget", "pcpush"]
+
+
+def make_code(op_count):
+    code = []
+    while len(code) < op_count:
+        if random.random() < 0.3:
+            code.append(ast.ImmediateOp(
+                ast.BasicOp(instructions.OPS["nop"]),
+                random.getrandbits(16)
+            ))
+        else:
+            code.append(ast.BasicOp(instructions.OPS[random.choice(OP_NAMES)]))
+    return code
+
+
+def slice_rewrite(code, rule):
+    # The rewriter used before rewrite_code, each rewrite moves the rest of
+    # the list
+    code = list(code)
+    i = 0
+    while i + rule.window - 1 < len(code):
+        ops = code[i:i + rule.window]
+        new_code = rule.rewrite(ops, i)
+        if new_code is None:
+            i += 1
+        else:
+            code[i:i + rule.window] = new_code
+    return code
+
+
+def bench(name, code, rewrite):
+    start = time.time()
+    for rule in PEEPHOLE_RULES:
+        code = rewrite(code, rule)
+    elapsed = time.time() - start
+    print("{}: {} ops to {} in {:.3f}s".format(name, OP_COUNT, len(code), elapsed))
+    return code
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        OP_COUNT = int(sys.argv[1])
+    random.seed(0)
+    code = make_code(OP_COUNT)
+    bench("rewrite_code", code, lambda code, rule: rewrite_code(code, [rule]))
+    bench("slice assignment", code, slice_rewrite)
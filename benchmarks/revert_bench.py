@@ -0,0 +1,126 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Throughput of a message stream where most transactions fail inside the
+# VM and go through the error handler to invalid_tx.
+
+import contextlib
+import io
+import random
+import time
+
+from pyevmasm import instruction_tables, assemble_hex, assemble_one
+import eth_utils
+
+import arbitrum as arb
+from arbitrum import value
+from arbitrum.evm.contract import ArbContract, create_evm_vm
+
+ADDRESS = "0x895521964D724c8362A36608AAf09A3D7d0A0445"
+MESSAGE_COUNT = 200
+SUCCESS_EVERY = 10
+
+
+def make_contract(target):
+    table = instruction_tables['byzantium']
+    code = [
+        assemble_one("PUSH20 " + target),
+        table["EXTCODESIZE"],
+        assemble_one("PUSH1 0x00"),
+        table['MSTORE'],
+        assemble_one("PUSH1 0x20"),
+        assemble_one("PUSH1 0x00"),
+        table['RETURN'],
+    ]
+    return ArbContract({
+        "address": ADDRESS,
+        "abi": [{
+            "constant": False,
+            "inputs": [],
+            "name": "testMethod",
+            "outputs": [{"name": "", "type": "uint256"}],
+            "payable": False,
+            "stateMutability": "view",
+            "type": "function"
+        }],
+        "name": "TestContract",
+        "code": assemble_hex(code),
+        "storage": {}
+    })
+
+
+def make_vm(contract):
+    contracts = [contract]
+    for _ in range(10):
+        contracts.append(ArbContract({
+            "address": eth_utils.to_checksum_address(
+                random.getrandbits(8*20).to_bytes(20, byteorder="big").hex()
+            ),
+            "abi": [],
+            "name": "TestContract",
+            "code": "0x00",
+            "storage": {}
+        }))
+    with contextlib.redirect_stdout(io.StringIO()):
+        return create_evm_vm(contracts)
+
+
+def run_stream(programs, verbose):
+    steps = 0
+    faults = 0
+    for i in range(MESSAGE_COUNT):
+        # One in SUCCESS_EVERY messages succeeds, the rest fail
+        contract, vm, initial = programs[i % SUCCESS_EVERY == 0]
+        vm.restore(initial)
+        vm.verbose_errors = verbose
+        vm.env.send_message([
+            value.Tuple([contract.testMethod(4), 0, 0, 0]),
+            2345,
+            0,
+            0
+        ])
+        vm.env.deliver_pending()
+        steps += arb.run_vm(vm)
+        faults += len(vm.faults)
+        vm.faults.clear()
+    return steps, faults
+
+
+def bench(name, programs, verbose):
+    out = io.StringIO()
+    start = time.time()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        steps, faults = run_stream(programs, verbose)
+    elapsed = time.time() - start
+    print("{}: {} messages, {} steps, {} faults in {:.3f}s ({:.1f} messages/s, {} bytes printed)".format(
+        name,
+        MESSAGE_COUNT,
+        steps,
+        faults,
+        elapsed,
+        MESSAGE_COUNT / elapsed,
+        len(out.getvalue())
+    ))
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    programs = []
+    for target in ["0x9999", ADDRESS]:
+        contract = make_contract(target)
+        vm = make_vm(contract)
+        arb.vm_runner.decode_program(vm)
+        programs.append((contract, vm, vm.checkpoint()))
+    bench("fault records", programs, False)
+    bench("verbose errors", programs, True)
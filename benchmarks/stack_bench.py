@@ -0,0 +1,55 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import timeit
+
+import arbitrum as arb
+from arbitrum import value
+
+ITEM_COUNT = 10000
+
+
+def vm_push_pop(vm):
+    for i in range(ITEM_COUNT):
+        vm.push(i)
+    for _ in range(ITEM_COUNT):
+        vm.pop()
+
+
+def aux_push_pop(vm):
+    for i in range(ITEM_COUNT):
+        vm.push(i)
+        vm.auxpush()
+    for _ in range(ITEM_COUNT):
+        vm.auxpop()
+        vm.pop()
+
+
+def type_push_pop(stack):
+    for _ in range(ITEM_COUNT):
+        stack.push(value.IntType())
+    for _ in range(ITEM_COUNT):
+        stack.pop(value.IntType())
+
+
+if __name__ == '__main__':
+    vm = arb.VM()
+    type_stack = value.TypeStack()
+    for name, run in [
+            ("stack", lambda: vm_push_pop(vm)),
+            ("aux stack", lambda: aux_push_pop(vm)),
+            ("type stack", lambda: type_push_pop(type_stack))
+    ]:
+        elapsed = min(timeit.repeat(run, number=1, repeat=5))
+        print("{}: {} push/pop pairs in {:.4f}s".format(name, ITEM_COUNT, elapsed))
@@ -0,0 +1,113 @@
+# Copyright 2019, Offchain Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Memory and time used to build large values with set_static, with and
+# without hash consing of tuples. The size of the tuple objects is compared
+# to the baseline of the same tuples as objects with a __dict__ and a list
+# of items, like Tuple was before it used __slots__.
+#
+# Hash consing only pays off when a value has many equal subtrees, like the
+# zeroed leaves of bigtuple_int. A keyvalue_int_int with distinct keys has
+# almost none, so the table is pure overhead there: it retains about twice
+# the memory and takes about 3x as long to build.
+
+import sys
+import time
+import tracemalloc
+
+from arbitrum import value
+from arbitrum.std import bigtuple_int, keyvalue_int_int
+
+ITEM_COUNT = 20000
+
+
+def build_keyvalue():
+    kvs = keyvalue_int_int.make()
+    for i in range(ITEM_COUNT):
+        kvs = keyvalue_int_int.set_static(kvs, i, i + 1)
+    return kvs
+
+
+def build_bigtuple():
+    # Mostly repeated leaves, like zeroed memory
+    tup = bigtuple_int.make()
+    for i in range(ITEM_COUNT):
+        tup = bigtuple_int.set_static(tup, i, i % 2)
+    return tup
+
+
+class UnslottedTuple:
+    def __init__(self, val):
+        self.val = val
+        self.merkle_hash = None
+
+
+def unique_tuples(val):
+    tuples = {}
+    vals = [val]
+    while vals:
+        val = vals.pop()
+        if isinstance(val, value.Tuple) and id(val) not in tuples:
+            tuples[id(val)] = val
+            vals.extend(val.val)
+    return tuples.values()
+
+
+def tuple_sizes(result):
+    # Bytes taken by the tuple objects themselves, and by the same tuples
+    # as UnslottedTuples
+    slotted = 0
+    unslotted = 0
+    for tup in unique_tuples(result):
+        slotted += sys.getsizeof(tup) + sys.getsizeof(tup.val)
+        old = UnslottedTuple(list(tup.val))
+        unslotted += (
+            sys.getsizeof(old) +
+            sys.getsizeof(old.__dict__) +
+            sys.getsizeof(old.val)
+        )
+    return slotted, unslotted
+
+
+def bench(name, build, enabled):
+    with value.hash_consing(enabled):
+        tracemalloc.start()
+        start = time.time()
+        result = build()
+        elapsed = time.time() - start
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    print("{}{}: {} items in {:.3f}s: {:.2f}MB retained, {:.2f}MB peak".format(
+        name,
+        " (hash consing)" if enabled else "",
+        ITEM_COUNT,
+        elapsed,
+        size / 1e6,
+        peak / 1e6
+    ))
+    return result
+
+
+if __name__ == '__main__':
+    for name, build in [
+            ("keyvalue_int_int", build_keyvalue),
+            ("bigtuple_int", build_bigtuple)
+    ]:
+        slotted, unslotted = tuple_sizes(bench(name, build, False))
+        print("{} tuple objects: {:.2f}MB, {:.2f}MB unslotted baseline".format(
+            name,
+            slotted / 1e6,
+            unslotted / 1e6
+        ))
+        bench(name, build, True)
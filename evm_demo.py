@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import sys
-from collections import Counter
 import hashlib
 
 import web3
@@ -21,39 +20,19 @@ import solcx
 import eth_utils
 
 import arbitrum as arb
-from arbitrum.instructions import OPS
+from arbitrum.vm_runner import STOP_ERROR
 from arbitrum.evm import constructor
 from arbitrum.evm.contract import ArbContract, create_evm_vm
 
 
 def run_until_halt(vm):
     log = []
-    i = 0
-    push_counts = Counter()
-    while True:
-        # if (
-        #         vm.pc.op.get_op() == OPS["auxpush"] or
-        #         vm.pc.op.get_op() == OPS["auxpop"]
-        # ):
-        #     print(vm.pc, vm.aux_stack[:])
-        # print(vm.pc, vm.stack[:])
-        # log.append((vm.pc, vm.stack[:]))
-        # print(vm.pc, vm.stack.items[:5])
-        try:
-            if vm.pc.op.get_op() == OPS["spush"]:
-                push_counts[vm.pc.path[-1][5:-1]] += 1
-            keep_going = arb.run_vm_once(vm)
-            if not keep_going:
-                break
-            i += 1
-        except Exception as err:
-            print("Error at", vm.pc.pc - 1, vm.code[vm.pc.pc - 1])
-            print("Context", vm.code[vm.pc.pc - 6: vm.pc.pc + 4])
-            raise err
-        if vm.halted:
-            break
-    print("Ran VM for {} steps".format(i))
-    # print(push_counts)
+    result = arb.run_until(vm)
+    if result.reason == STOP_ERROR:
+        print("Error at", result.pc.pc, result.pc)
+        print("Context", vm.code[result.pc.pc - 5: result.pc.pc + 5])
+        raise result.error
+    print("Ran VM for {} steps".format(result.steps))
     return log
 
 
@@ -15,36 +15,36 @@
 import json
 import arbitrum as arb
 import eth_utils
-from collections import Counter
-from arbitrum.instructions import OPS
+from arbitrum.vm_runner import STOP_BLOCKED, STOP_ERROR
+from arbitrum.profiler import Profiler
 import sys
 from arbitrum.evm.contract import ArbContract, create_evm_vm
 
 
+def run_profiled(vm, profiler, profile_path):
+    steps = profiler.run(vm)
+    for log in vm.logs:
+        vm.output_handler(log)
+    vm.logs = []
+    print("Ran VM for {} steps".format(steps))
+    profiler.print_summary()
+    profiler.write_collapsed_stacks(profile_path)
+    print("Wrote collapsed stacks to", profile_path)
+
+
 def run_until_halt(vm):
     log = []
-    i = 0
-    push_counts = Counter()
-    while True:
-        try:
-            if vm.pc.op.get_op() == OPS["spush"]:
-                push_counts[vm.pc.path[-1][5:-1]] += 1
-            run = arb.run_vm_once(vm)
-            if not run:
-                print("Hit blocked insn")
-                break
-            i += 1
-        except Exception as err:
-            print("Error at", vm.pc.pc - 1, vm.code[vm.pc.pc - 1])
-            print("Context", vm.code[vm.pc.pc - 6: vm.pc.pc + 4])
-            raise err
-        if vm.halted:
-            break
+    result = arb.run_until(vm)
+    if result.reason == STOP_ERROR:
+        print("Error at", result.pc.pc, result.pc)
+        print("Context", vm.code[result.pc.pc - 5: result.pc.pc + 5])
+        raise result.error
+    if result.reason == STOP_BLOCKED:
+        print("Hit blocked insn")
     for log in vm.logs:
         vm.output_handler(log)
     vm.logs = []
-    print("Ran VM for {} steps".format(i))
-    # print(push_counts)
+    print("Ran VM for {} steps".format(result.steps))
     return log
 
 
@@ -70,8 +70,10 @@ def make_msg_val(calldata):
     return arb.value.Tuple([calldata, 0, 0, 0])
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        raise Exception("Call as truffle_runner.py [compiled.json]")
+    if len(sys.argv) not in [2, 3]:
+        raise Exception(
+            "Call as truffle_runner.py [compiled.json] [profile.folded]"
+        )
 
     with open(sys.argv[1]) as json_file:
         raw_contracts = json.load(json_file)
@@ -98,7 +100,10 @@ if __name__ == '__main__':
     vm.env.send_message([make_msg_val(fib.generateFib(2, 10 )), 1234, 100000000, 0])
     # vm.env.send_message([make_msg_val(fib.getFib(3, 19)), 2345, 0, 0])
     vm.env.deliver_pending()
-    run_until_halt(vm)
+    if len(sys.argv) == 3:
+        run_profiled(vm, Profiler(), sys.argv[2])
+    else:
+        run_until_halt(vm)
 
     # person_a = '0x1000000000000000000000000000000000000000'
     # person_b = '0x2222222222222222222222222222222222222222'